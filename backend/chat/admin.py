@@ -1,30 +1,164 @@
 from django.contrib import admin
+from django.contrib.auth.models import User
+from django.core.paginator import EmptyPage, Paginator
+from django.db import connection
+from django.db.models import Max, Prefetch, Q
+from django.db.models.expressions import RawSQL
+from django.urls import reverse
+from django.utils.functional import cached_property
+from django.utils.html import format_html
+from chat import purge, search
 from chat.models import Thread, Message
+from chat.serializers import MessageSerializer
+from chat.views import messages_changed, messages_posted
+
+
+class EstimatedCountPaginator(Paginator):
+    """
+    Changelist paginator that never counts a whole large table. Without filters the count is
+    estimated from the statistics of the last ``ANALYZE``, or else from the highest id, which
+    ignores deleted and archived rows; filtered counts stop at ``max_count``, past it the last
+    pages are not linked. An estimate off either way gives empty or unlinked pages, not errors.
+    """
+    max_count = 10000
+
+    @cached_property
+    def count(self):
+        query = self.object_list.query
+        if not query.where and not query.distinct:
+            estimate = analyzed_count(self.object_list.model._meta.db_table)
+            if estimate is None:
+                estimate = self.object_list.aggregate(estimate=Max('pk'))['estimate'] or 0
+            return estimate
+        return self.object_list.order_by()[:self.max_count].count()
+
+    def validate_number(self, number):
+        try:
+            return super().validate_number(number)
+        except EmptyPage:
+            if int(number) < 1:
+                raise
+            return int(number)  # Past the estimate
+
+    def page(self, number):
+        number = self.validate_number(number)
+        # Sliced by the page size only, past the estimate the page is empty or holds the rows it missed
+        bottom = (number - 1) * self.per_page
+        return self._get_page(self.object_list[bottom:bottom + self.per_page], number, self)
+
+
+def analyzed_count(table):
+    """Row count of ``table`` in ``sqlite_stat1``, None before it was analyzed."""
+    if connection.vendor != 'sqlite':
+        return None
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'sqlite_stat1'")
+        if cursor.fetchone() is None:
+            return None
+        # The first number of an index's statistics is the row count of its table
+        cursor.execute('SELECT stat FROM sqlite_stat1 WHERE tbl = %s LIMIT 1', [table])
+        row = cursor.fetchone()
+    return int(row[0].split()[0]) if row else None
 
 
 class MessageInline(admin.TabularInline):
+    """The latest messages of the thread, the others are listed by the Messages admin."""
     model = Message
     extra = 1
-    fields = ['sender', 'text', 'is_read', 'created']
+    max_shown = 20
+    fields = ['sender', 'text', 'created']
     readonly_fields = ['created', ]
+    raw_id_fields = ['sender']
+    ordering = ['-id']
+
+    def get_queryset(self, request):
+        queryset = super().get_queryset(request).select_related('sender')
+        thread_id = request.resolver_match.kwargs.get('object_id')
+        if thread_id is None:
+            return queryset.none()
+        latest = Message.objects.filter(thread_id=thread_id).order_by('-id').values('id')[:self.max_shown]
+        return queryset.filter(id__in=latest)
 
 
 class ThreadAdmin(admin.ModelAdmin):
     list_display = ['id', 'get_participants', 'created', 'updated']
     list_display_links = ['id', 'get_participants']
     search_fields = ['participants__username', ]
+    readonly_fields = ['get_messages']
+    autocomplete_fields = ['participants']
     inlines = [MessageInline]
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
+
+    def get_queryset(self, request):
+        return super().get_queryset(request).prefetch_related(
+            Prefetch('participants', queryset=User.objects.only('id', 'username'))
+        )
+
+    def save_formset(self, request, form, formset, change):
+        super().save_formset(request, form, formset, change)
+        if formset.new_objects:
+            messages_posted(formset.new_objects, MessageSerializer(formset.new_objects, many=True).data)
+        if formset.deleted_objects:
+            messages_changed([form.instance.pk])
+
+    def get_deleted_objects(self, objs, request):
+        # Only the threads go away now, listing the messages would load every one of them
+        objs = list(objs)
+        return [str(obj) for obj in objs], {Thread._meta.verbose_name_plural: len(objs)}, set(), []
+
+    def delete_model(self, request, obj):
+        purge.soft_delete(obj)
+
+    def delete_queryset(self, request, queryset):
+        for thread in queryset:
+            purge.soft_delete(thread)
 
     def get_participants(self, obj):
         return ", ".join([user.username for user in obj.participants.all()])
     get_participants.short_description = 'Participants'
 
+    def get_messages(self, obj):
+        if obj.pk is None:
+            return '-'
+        url = reverse('admin:chat_message_changelist') + f'?thread={obj.pk}'
+        return format_html('<a href="{}">All messages of the thread</a>', url)
+    get_messages.short_description = 'Messages'
+
 
 class MessageAdmin(admin.ModelAdmin):
-    list_display = ['id', 'text', 'sender', 'thread', 'is_read', 'created']
+    list_display = ['id', 'text', 'sender', 'thread', 'created']
     list_display_links = ['id', 'text']
     search_fields = ['sender__username', 'thread__id', 'text']
-    list_filter = ['is_read', 'created']
+    list_select_related = ['sender', 'thread']
+    raw_id_fields = ['sender', 'thread']
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
+
+    def get_search_results(self, request, queryset, search_term):
+        # The text is searched through the full-text index instead of a LIKE scan of every message,
+        # senders and threads through the indexes of their foreign keys
+        subquery = search.matching_ids(search_term) if search.is_supported() else None
+        if subquery is None:
+            return super().get_search_results(request, queryset, search_term)
+        condition = Q(id__in=RawSQL(*subquery)) | Q(sender__in=User.objects.filter(username__icontains=search_term))
+        if search_term.strip().isdigit():
+            condition |= Q(thread_id=int(search_term))
+        return queryset.filter(condition), False
+
+    def save_model(self, request, obj, form, change):
+        super().save_model(request, obj, form, change)
+        if not change:
+            messages_posted([obj], [MessageSerializer(obj).data])
+
+    def delete_model(self, request, obj):
+        super().delete_model(request, obj)
+        messages_changed([obj.thread_id])
+
+    def delete_queryset(self, request, queryset):
+        thread_ids = set(queryset.values_list('thread_id', flat=True))
+        super().delete_queryset(request, queryset)
+        messages_changed(thread_ids)
 
 
 admin.site.register(Thread, ThreadAdmin)
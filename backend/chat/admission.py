@@ -0,0 +1,185 @@
+"""
+Admission control of the write endpoints.
+
+SQLite runs one write at a time. Past the rate it sustains, more writers only queue on the write
+lock: latency climbs for every request until they fail with lock timeouts. ``AdmissionMiddleware``
+admits the write requests to the views named in ``CHAT_ADMISSION['URL_NAMES']`` through
+
+- a token bucket per user,
+- a global token bucket, the write rate the database sustains,
+- at most ``MAX_IN_FLIGHT`` writes at once per process, a request waits up to ``QUEUE_TIMEOUT``
+  seconds for one of them to finish.
+
+The user is resolved from the token cache first, without a query once their token is known.
+Requests that do not authenticate are left to the view, which answers ``401``: they take nothing
+from the buckets, so made up tokens can neither get fresh buckets nor drain the global one.
+A request that is not admitted gets a ``429`` with a ``Retry-After`` before its view runs.
+Buckets live in process memory, so every process admits its own share of the rates; with
+``CACHE_ALIAS`` they live in that Django cache, shared by all processes. Updates of a shared
+bucket are not atomic, concurrent requests may be admitted a little over the rate.
+"""
+import asyncio
+import math
+import threading
+import time
+import weakref
+from django.conf import settings
+from django.core.cache import caches
+from django.http import JsonResponse
+from rest_framework.exceptions import AuthenticationFailed
+from chat import metrics
+from chat.authentication import aauthenticate_request, authenticate_request
+from chat.cache import LRUCache
+
+WRITE_URL_NAMES = [
+    'thread_create', 'message_create', 'message_batch_create', 'message_read_change', 'thread_read',
+    'async_thread_create', 'async_message_create',
+]
+
+controllers = weakref.WeakSet()
+
+
+def get_settings():
+    return {'ENABLED': False, 'URL_NAMES': WRITE_URL_NAMES, 'USER_RATE': 5, 'USER_BURST': 20, 'GLOBAL_RATE': 200,
+            'GLOBAL_BURST': 400, 'MAX_IN_FLIGHT': 4, 'QUEUE_TIMEOUT': 0.5, 'MAX_ENTRIES': 10000, 'CACHE_ALIAS': None,
+            **getattr(settings, 'CHAT_ADMISSION', {})}
+
+
+class TokenBuckets:
+    """Token buckets of ``rate`` tokens per second holding at most ``burst``, one per key."""
+
+    def __init__(self, name, rate, burst, max_entries, cache_alias=None):
+        self.name = name
+        self.rate = rate
+        self.burst = burst
+        # An idle bucket is full again after this long, as if it was never used
+        self.timeout = burst / rate
+        self.local = LRUCache(max_entries, self.timeout)
+        self.shared = caches[cache_alias] if cache_alias else None
+        self.lock = threading.Lock()
+
+    def take(self, key):
+        """Take a token from the bucket ``key``, return 0 or the seconds until one is available."""
+        with self.lock:
+            now = time.time()
+            cache_key = f'chat:admission:{self.name}:{key}'
+            state = self.shared.get(cache_key) if self.shared is not None else self.local.get(key)
+            tokens, updated = state if state is not None else (self.burst, now)
+            tokens = min(self.burst, tokens + (now - updated) * self.rate)
+            wait = 0.0 if tokens >= 1 else (1 - tokens) / self.rate
+            if not wait:
+                tokens -= 1
+            if self.shared is not None:
+                self.shared.set(cache_key, (tokens, now), math.ceil(self.timeout))
+            else:
+                self.local.set(key, (tokens, now))
+            return wait
+
+
+class Controller:
+    """Admission state of one middleware instance: its buckets and in-flight writes."""
+
+    def __init__(self, options):
+        self.url_names = set(options['URL_NAMES'])
+        self.users = TokenBuckets('user', options['USER_RATE'], options['USER_BURST'], options['MAX_ENTRIES'],
+                                  options['CACHE_ALIAS'])
+        self.everyone = TokenBuckets('global', options['GLOBAL_RATE'], options['GLOBAL_BURST'], 1,
+                                     options['CACHE_ALIAS'])
+        self.max_in_flight = options['MAX_IN_FLIGHT']
+        self.queue_timeout = options['QUEUE_TIMEOUT']
+        self.slots = threading.BoundedSemaphore(self.max_in_flight)
+        self.in_flight = 0
+        self.waiting = 0
+        self.lock = threading.Lock()
+        controllers.add(self)
+
+    def check_rates(self, user_id, view):
+        """The rejection of a request of ``user_id`` if a bucket is empty, None when it may go on."""
+        for reason, buckets, key in [
+            ('user_rate', self.users, user_id),
+            ('global_rate', self.everyone, ''),
+        ]:
+            wait = buckets.take(key)
+            if wait:
+                return reject(view, reason, wait)
+        return None
+
+    def acquire(self, view):
+        """Take an in-flight slot, waiting for one up to the queue timeout, return whether it was taken."""
+        if self.slots.acquire(blocking=False):
+            return self.admitted(view, 0.0)
+        started = time.monotonic()
+        self.count_waiting(1)
+        try:
+            acquired = self.queue_timeout > 0 and self.slots.acquire(timeout=self.queue_timeout)
+        finally:
+            self.count_waiting(-1)
+        return acquired and self.admitted(view, time.monotonic() - started)
+
+    async def aacquire(self, view):
+        if self.slots.acquire(blocking=False):
+            return self.admitted(view, 0.0)
+        started = time.monotonic()
+        self.count_waiting(1)
+        try:
+            # Polled, a blocking acquire would hold up the event loop
+            while time.monotonic() - started < self.queue_timeout:
+                await asyncio.sleep(0.005)
+                if self.slots.acquire(blocking=False):
+                    return self.admitted(view, time.monotonic() - started)
+            return False
+        finally:
+            self.count_waiting(-1)
+
+    def admitted(self, view, waited):
+        metrics.admission_wait.observe((view,), waited)
+        self.count_in_flight(1)
+        return True
+
+    def release(self):
+        self.count_in_flight(-1)
+        self.slots.release()
+
+    def count_in_flight(self, delta):
+        with self.lock:
+            self.in_flight += delta
+
+    def count_waiting(self, delta):
+        with self.lock:
+            self.waiting += delta
+
+
+def user_id(request):
+    """Id of the user the request authenticates as, None without valid credentials."""
+    try:
+        user = authenticate_request(request)
+    except AuthenticationFailed:
+        return None
+    return user.pk if user is not None else None
+
+
+async def auser_id(request):
+    try:
+        user = await aauthenticate_request(request)
+    except AuthenticationFailed:
+        return None
+    return user.pk if user is not None else None
+
+
+def reject(view, reason, wait):
+    metrics.admission_rejected.inc((view, reason))
+    retry_after = max(1, math.ceil(wait))
+    response = JsonResponse({'detail': f'Too many writes, retry in {retry_after} seconds.'}, status=429)
+    response['Retry-After'] = str(retry_after)
+    return response
+
+
+def collect():
+    """Metrics collector of the writes in flight and waiting for a slot in this process."""
+    live = list(controllers)
+    yield '# HELP chat_admission_in_flight Admitted write requests being served by this process.'
+    yield '# TYPE chat_admission_in_flight gauge'
+    yield f'chat_admission_in_flight {sum(controller.in_flight for controller in live)}'
+    yield '# HELP chat_admission_waiting Write requests waiting for an in-flight slot in this process.'
+    yield '# TYPE chat_admission_waiting gauge'
+    yield f'chat_admission_waiting {sum(controller.waiting for controller in live)}'
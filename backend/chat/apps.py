@@ -4,3 +4,17 @@ from django.apps import AppConfig
 class ChatConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'chat'
+
+    def ready(self):
+        from django.db.backends.signals import connection_created
+        from django.db.models.signals import post_migrate
+        from chat import admission, jobs, membership, metrics, page_cache, purge, search, signals  # noqa: F401
+        from chat.authentication import token_cache
+
+        connection_created.connect(metrics.install_query_wrapper)
+        post_migrate.connect(search.restore_triggers, sender=self)
+        metrics.cache_collector('token', token_cache.stats)
+        metrics.cache_collector('membership', lambda: membership.get_local_cache().stats())
+        metrics.cache_collector('message_page', page_cache.stats)
+        metrics.registry.register_collector(jobs.collect)
+        metrics.registry.register_collector(admission.collect)
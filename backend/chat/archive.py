@@ -0,0 +1,111 @@
+"""
+Archive of the old messages.
+
+Messages older than ``CHAT_ARCHIVE['AGE_DAYS']`` that every recipient has read are moved from
+``Message`` to ``ArchivedMessage``, their text compressed, so that the message table and its
+indexes only hold what is still written, counted and searched. An archived message keeps its id
+and position: the messages list pages over both tables in one ``UNION ALL`` query and clients
+scrolling back do not notice where the archive starts. Archived messages are no longer found by
+search and can not be marked unread, so archiving only runs once ``CHAT_ARCHIVE['ENABLED']`` opts
+in to that.
+
+The last message of a thread is never archived, and ids grow with the creation time, so the
+``archive_messages`` command walks the message table by id in short batches and stops at the
+first batch without any message older than the cutoff. It can be stopped and run again at any time.
+It ends with a sampled ``ANALYZE`` of the message table, whose row count the admin shows.
+"""
+import time
+import zlib
+from datetime import timedelta
+from django.conf import settings
+from django.db import connection, transaction
+from django.utils import timezone
+from chat import metrics, reads
+from chat.membership import participants_of
+from chat.models import Thread, ArchivedMessage, Message
+
+RAW, COMPRESSED = b'r', b'z'
+
+
+def get_settings():
+    return {'ENABLED': False, 'AGE_DAYS': 90, 'BATCH_SIZE': 1000, 'PAUSE': 0.05, 'ANALYSIS_LIMIT': 1000,
+            **getattr(settings, 'CHAT_ARCHIVE', {})}
+
+
+def pack(text):
+    """Archived form of a message text, compressed unless that makes it longer, as short texts do."""
+    data = text.encode('utf-8')
+    compressed = zlib.compress(data, 9)
+    return COMPRESSED + compressed if len(compressed) < len(data) else RAW + data
+
+
+def unpack(data):
+    data = bytes(data)
+    return (zlib.decompress(data[1:]) if data[:1] == COMPRESSED else data[1:]).decode('utf-8')
+
+
+def archive_batch(after, before, batch_size):
+    """
+    Archive what can be among the ``batch_size`` messages following the id ``after`` and created
+    before ``before``. Return ``(last id looked at, archived, done)``.
+    """
+    with transaction.atomic():
+        rows = list(Message.objects.filter(id__gt=after).order_by('id').values_list(
+            'id', 'sender_id', 'thread_id', 'text', 'created', named=True
+        )[:batch_size])
+        old = [row for row in rows if row.created < before]
+        if not old:
+            return after, 0, True
+
+        thread_ids = {row.thread_id for row in old}
+        last_messages = dict(Thread.objects.filter(id__in=thread_ids).values_list('id', 'last_message_id'))
+        participants = participants_of(thread_ids)
+        watermarks = reads.thread_watermarks(thread_ids)
+        archived = [
+            ArchivedMessage(id=row.id, sender_id=row.sender_id, thread_id=row.thread_id, text=pack(row.text),
+                            created=row.created)
+            for row in old
+            # Deleted threads are left to their purge
+            if row.thread_id in last_messages and row.id != last_messages[row.thread_id] and all(
+                watermarks[row.thread_id].get(user_id, 0) >= row.id
+                for user_id in participants[row.thread_id] if user_id != row.sender_id
+            )
+        ]
+        if archived:
+            ArchivedMessage.objects.bulk_create(archived)
+            Message.objects.filter(id__in=[message.id for message in archived]).delete()
+    metrics.archived_messages.inc(amount=len(archived))
+    return rows[-1].id, len(archived), len(rows) < batch_size
+
+
+def archive(age_days=None, batch_size=None, pause=None, progress=None):
+    """
+    Archive every message that can be, return how many were. ``progress`` is called after each
+    batch with the last id looked at and the number archived so far.
+    """
+    options = get_settings()
+    if not options['ENABLED']:
+        raise ValueError('Archived messages are no longer found by search, set CHAT_ARCHIVE["ENABLED"] to archive.')
+    before = timezone.now() - timedelta(days=options['AGE_DAYS'] if age_days is None else age_days)
+    batch_size = batch_size or options['BATCH_SIZE']
+    pause = options['PAUSE'] if pause is None else pause
+    after, archived = 0, 0
+    while True:
+        after, count, done = archive_batch(after, before, batch_size)
+        archived += count
+        if progress is not None:
+            progress(after, archived)
+        if done:
+            analyze(options['ANALYSIS_LIMIT'])
+            return archived
+        if pause:
+            time.sleep(pause)  # Lets the other writers take the lock
+
+
+def analyze(analysis_limit):
+    """Refresh the statistics of the message table, from about ``analysis_limit`` rows per index."""
+    if connection.vendor != 'sqlite':
+        return
+    with connection.cursor() as cursor:
+        cursor.execute(f'PRAGMA analysis_limit = {int(analysis_limit)}')
+        cursor.execute(f'ANALYZE {connection.ops.quote_name(Message._meta.db_table)}')
@@ -0,0 +1,177 @@
+"""
+Async versions of the thread and message endpoints, served natively by ASGI servers (``config.asgi``).
+
+They keep the authentication, permissions, validation and response bodies of the DRF views in
+``chat.views``, but wait on the database without holding a worker thread: reads go through the
+async ORM and the caches are consulted in the event loop. Writes run their transaction in a
+single ``sync_to_async`` call, since a transaction can not span awaits.
+"""
+import json
+from functools import wraps
+from asgiref.sync import sync_to_async
+from django.contrib.auth.models import User
+from django.db import transaction
+from django.db.models import Prefetch
+from django.http import HttpResponse
+from django.views.decorators.csrf import csrf_exempt
+from rest_framework import exceptions, status
+from rest_framework.relations import PrimaryKeyRelatedField
+from rest_framework.request import Request
+from chat import counters, membership, page_cache, purge, reads, routers
+from chat.authentication import aauthenticate_request
+from chat.models import Thread, ArchivedMessage, Message
+from chat.pagination import DefaultSetPagination, MessageCursorPagination
+from chat.renderers import FastJSONRenderer
+from chat.serializers import (
+    MessageBatchItemSerializer, MessageSerializer, ThreadSerializer, MESSAGE_ROW_FIELDS, serialize_message_rows
+)
+from chat.views import create_thread, messages_posted
+
+THREAD_NOT_FOUND = 'No Thread matches the given query.'
+
+
+def json_response(data, status_code=status.HTTP_200_OK):
+    return HttpResponse(FastJSONRenderer().render(data), status=status_code, content_type='application/json')
+
+
+def error_response(exc):
+    data = exc.detail if isinstance(exc.detail, (list, dict)) else {'detail': exc.detail}
+    response = json_response(data, exc.status_code)
+    if isinstance(exc, (exceptions.NotAuthenticated, exceptions.AuthenticationFailed)):
+        response['WWW-Authenticate'] = 'Token'
+    return response
+
+
+def api_view(*methods):
+    """
+    Allowed methods, token authentication, ``IsAuthenticated`` and API exceptions rendered as
+    JSON, like DRF's ``APIView`` does for the sync views.
+    """
+    def decorator(view):
+        @wraps(view)
+        async def wrapper(request, *args, **kwargs):
+            try:
+                if request.method not in methods:
+                    raise exceptions.MethodNotAllowed(request.method)
+                user = await aauthenticate_request(request)
+                if user is None:
+                    raise exceptions.NotAuthenticated()
+                request.user = user
+                return await view(request, *args, **kwargs)
+            except exceptions.APIException as exc:
+                return error_response(exc)
+        return csrf_exempt(wrapper)  # Token authentication, as for the DRF views
+    return decorator
+
+
+def parse_json(request):
+    try:
+        return json.loads(request.body or b'{}')
+    except ValueError as exc:
+        raise exceptions.ParseError(f'JSON parse error - {exc}')
+
+
+def with_participants(queryset):
+    return queryset.prefetch_related(Prefetch('participants', queryset=User.objects.only('id')))
+
+
+@sync_to_async
+def validate_thread(data):
+    serializer = ThreadSerializer(data=data)
+    serializer.is_valid(raise_exception=True)
+    return serializer.data['participants']
+
+
+@api_view('POST')
+async def thread_create(request):
+    participants_ids = await validate_thread(parse_json(request))
+    if request.user.id not in participants_ids:
+        message = 'One of participants must be user that made request.'
+        return json_response({'detail': message}, status.HTTP_400_BAD_REQUEST)
+
+    threads = with_participants(Thread.objects.all())
+    thread = await threads.filter(participants_key=Thread.make_participants_key(participants_ids)).afirst()
+    response_status = status.HTTP_200_OK
+    if thread is None:
+        thread, created = await sync_to_async(create_thread)(participants_ids)
+        thread = await threads.aget(pk=thread.pk)
+        if created:
+            response_status = status.HTTP_201_CREATED
+    return json_response(ThreadSerializer(thread).data, response_status)
+
+
+@api_view('DELETE')
+async def thread_delete(request, pk):
+    try:
+        thread = await Thread.objects.filter(participants=request.user).aget(pk=pk)
+    except Thread.DoesNotExist:
+        raise exceptions.NotFound(THREAD_NOT_FOUND)
+    await sync_to_async(purge.soft_delete)(thread)
+    return HttpResponse(status=status.HTTP_204_NO_CONTENT)
+
+
+@api_view('GET')
+async def thread_list(request):
+    paginator = DefaultSetPagination()
+    with routers.reading_from_replica(request.user.pk):
+        threads = with_participants(Thread.objects.filter(participants=request.user))
+        page = await paginator.apaginate_queryset(threads, Request(request))
+    return json_response(paginator.get_paginated_response(ThreadSerializer(page, many=True).data).data)
+
+
+@sync_to_async
+def post_message(user, thread_id, text):
+    with transaction.atomic():
+        message = Message.objects.create(sender=user, thread_id=thread_id, text=text)
+        data = MessageSerializer(message).data
+        messages_posted([message], [data])
+    return data
+
+
+@api_view('POST')
+async def message_create(request):
+    serializer = MessageBatchItemSerializer(data=parse_json(request))
+    serializer.is_valid(raise_exception=True)
+    thread_id = serializer.validated_data['thread']
+
+    # Checked in the database like the sync view's serializer does: the membership cache of another
+    # process may still list the participants of a thread deleted meanwhile
+    if not await Thread.objects.filter(id=thread_id).aexists():
+        message = PrimaryKeyRelatedField.default_error_messages['does_not_exist'].format(pk_value=thread_id)
+        raise exceptions.ValidationError({'thread': [message]})
+    if not await membership.ais_participant(request.user.id, thread_id):
+        raise exceptions.PermissionDenied('You do not have permission to post in this thread.')
+
+    data = await post_message(request.user, thread_id, serializer.validated_data['text'])
+    return json_response(data, status.HTTP_201_CREATED)
+
+
+@api_view('GET')
+async def messages_list(request, thread_id):
+    paginator = MessageCursorPagination()
+    with routers.reading_from_replica(request.user.pk):
+        if not await membership.ais_participant(request.user.id, thread_id):
+            if not await Thread.objects.filter(id=thread_id).aexists():
+                raise exceptions.NotFound(THREAD_NOT_FOUND)
+            raise exceptions.PermissionDenied('You do not have permission to access messages in this thread.')
+        drf_request = Request(request)
+        key = await page_cache.aget_key(thread_id, paginator, drf_request)
+        cached = await page_cache.aget_page(key)
+        if cached is not None:
+            results, state, _ = cached
+            paginator.restore_page(drf_request, state)
+            return json_response(paginator.get_paginated_response(results).data)
+
+        messages = Message.objects.filter(thread_id=thread_id).values_list(*MESSAGE_ROW_FIELDS, named=True)
+        archived = ArchivedMessage.objects.filter(thread_id=thread_id).values_list(*MESSAGE_ROW_FIELDS, named=True)
+        page = await paginator.apaginate_queryset(messages, drf_request, tiers=[archived])
+        results = serialize_message_rows(page, await reads.athread_watermarks([thread_id]))
+        await page_cache.aset_page(key, (results, paginator.get_page_state(), None))
+    return json_response(paginator.get_paginated_response(results).data)
+
+
+@api_view('GET')
+async def unread_messages_count(request):
+    with routers.reading_from_replica(request.user.pk):
+        unread_count = await counters.aunread_total(request.user)
+    return json_response({'unread_messages_count': unread_count})
@@ -0,0 +1,115 @@
+import copy
+import hashlib
+import threading
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.cache import caches
+from rest_framework.authentication import TokenAuthentication, get_authorization_header
+from rest_framework.request import Request
+from rest_framework.settings import api_settings
+from chat.cache import LRUCache
+
+
+class TokenCache:
+    """
+    Resolved token -> (user, token) pairs, in a per-process LRU, or in the Django cache named by
+    ``CACHE_ALIAS`` and only there, so that every process sees an entry dropped by another.
+
+    Entries are dropped when the token is deleted or its user is saved (deactivated, renamed,
+    ...). Without a shared cache other processes drop their copy after ``TIMEOUT`` seconds.
+    """
+
+    def __init__(self):
+        self._local = None
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get_settings(self):
+        return {'MAX_ENTRIES': 10000, 'TIMEOUT': 300, 'CACHE_ALIAS': None, **getattr(settings, 'CHAT_TOKEN_CACHE', {})}
+
+    @property
+    def local(self):
+        if self._local is None:
+            options = self.get_settings()
+            self._local = LRUCache(options['MAX_ENTRIES'], options['TIMEOUT'])
+        return self._local
+
+    @property
+    def shared(self):
+        alias = self.get_settings()['CACHE_ALIAS']
+        return caches[alias] if alias else None
+
+    def cache_key(self, key):
+        return f'chat:token:{hashlib.sha256(key.encode()).hexdigest()}'
+
+    def get(self, key):
+        shared = self.shared
+        identity = self.local.get(key) if shared is None else shared.get(self.cache_key(key))
+        with self._lock:
+            if identity is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return identity
+
+    def set(self, key, user, token):
+        shared = self.shared
+        if shared is None:
+            self.local.set(key, (user, token))
+        else:
+            shared.set(self.cache_key(key), (user, token), self.get_settings()['TIMEOUT'])
+
+    def invalidate(self, key):
+        self.local.delete(key)
+        if self.shared is not None:
+            self.shared.delete(self.cache_key(key))
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / lookups if lookups else 0.0,
+            'size': len(self.local),
+        }
+
+
+token_cache = TokenCache()
+
+
+class CachedTokenAuthentication(TokenAuthentication):
+    """Drop-in ``TokenAuthentication`` that skips the token and user query for known tokens."""
+
+    def authenticate_credentials(self, key):
+        identity = token_cache.get(key)
+        if identity is None:
+            user, token = super().authenticate_credentials(key)
+            token_cache.set(key, user, token)
+            return user, token
+        user, token = identity
+        # Every request gets its own instances, so changes made by one never leak into another
+        return copy.copy(user), copy.copy(token)
+
+
+def authenticate_request(request):
+    """
+    Authenticate a plain Django request with the DRF authentication classes, for views that are
+    not DRF views. Return the user, None when no credentials were sent; raise ``AuthenticationFailed``.
+    """
+    drf_request = Request(request, authenticators=[auth() for auth in api_settings.DEFAULT_AUTHENTICATION_CLASSES])
+    user = drf_request.user
+    return user if user.is_authenticated else None
+
+
+async def aauthenticate_request(request):
+    """
+    Async ``authenticate_request``. Tokens in the local token cache are resolved in the event
+    loop, anything else goes through the authentication classes in a worker thread.
+    """
+    auth = get_authorization_header(request).split()
+    if len(auth) == 2 and auth[0].lower() == b'token' and token_cache.shared is None:
+        identity = token_cache.get(auth[1].decode('latin-1'))
+        if identity is not None:
+            return copy.copy(identity[0])
+    return await sync_to_async(authenticate_request)(request)
@@ -0,0 +1,126 @@
+"""
+Request scenarios for every chat route and the token endpoint.
+
+They are shared by the ``bench_api`` command, which reports latency percentiles, throughput
+and SQL query counts on a seeded database, and by the query budget tests, which fail when an
+endpoint starts issuing more queries than its budget (an N+1 regression, for instance).
+"""
+import math
+import time
+from collections import Counter, namedtuple
+from django.db import connection, transaction
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+from chat import sync
+
+Scenario = namedtuple('Scenario', ['name', 'method', 'path', 'data', 'writes'])
+
+# Most SQL queries one request may issue once the token is cached, transaction control aside.
+QUERY_BUDGETS = {
+    'api_token_auth': 2,
+    'thread_create': 4,
+    'thread_delete': 10,
+    'thread_list': 3,
+    'thread_inbox': 3,
+    'thread_read': 7,
+    'message_create': 6,
+    'message_batch_create': 6,
+    'messages_list': 2,
+    'message_search': 3,
+    'message_read_change': 6,
+    'unread_messages_count': 1,
+    'sync': 3,
+    'async_thread_create': 4,
+    'async_thread_delete': 10,
+    'async_thread_list': 3,
+    'async_message_create': 6,
+    'async_messages_list': 2,
+    'async_unread_messages_count': 1,
+}
+# Chat routes without a scenario, and why
+UNBUDGETED = {
+    'event_stream': 'a long lived stream, it queries once per event it sends',
+}
+
+
+def build_scenarios(user, password, thread, message, other_user):
+    """Requests of ``user`` in ``thread``, ``other_user`` is the other participant of the thread."""
+    return [
+        Scenario('api_token_auth', 'post', reverse('api_token_auth'),
+                 {'username': user.username, 'password': password}, False),
+        Scenario('thread_create', 'post', reverse('thread_create'),
+                 {'participants': [user.id, other_user.id]}, True),
+        Scenario('thread_delete', 'delete', reverse('thread_delete', kwargs={'pk': thread.id}), None, True),
+        Scenario('thread_list', 'get', reverse('thread_list'), {'limit': 50}, False),
+        Scenario('thread_inbox', 'get', reverse('thread_inbox'), {'limit': 50}, False),
+        Scenario('thread_read', 'post', reverse('thread_read', kwargs={'thread_id': thread.id}), {}, True),
+        Scenario('message_create', 'post', reverse('message_create'),
+                 {'thread': thread.id, 'text': 'Benchmark message'}, True),
+        Scenario('message_batch_create', 'post', reverse('message_batch_create'),
+                 {'messages': [{'thread': thread.id, 'text': f'Benchmark message {i}'} for i in range(20)]}, True),
+        Scenario('messages_list', 'get', reverse('messages_list', kwargs={'thread_id': thread.id}),
+                 {'limit': 50}, False),
+        Scenario('message_search', 'get', reverse('message_search'), {'q': 'message', 'limit': 50}, False),
+        Scenario('message_read_change', 'patch', reverse('message_read_change', kwargs={'pk': message.id}),
+                 {'is_read': True}, True),
+        Scenario('unread_messages_count', 'get', reverse('unread_messages_count'), None, False),
+        Scenario('sync', 'get', reverse('sync'), {'cursor': sync.encode_cursor(0, timezone.now()), 'limit': 100},
+                 False),
+        Scenario('async_thread_create', 'post', reverse('async_thread_create'),
+                 {'participants': [user.id, other_user.id]}, True),
+        Scenario('async_thread_delete', 'delete', reverse('async_thread_delete', kwargs={'pk': thread.id}), None,
+                 True),
+        Scenario('async_thread_list', 'get', reverse('async_thread_list'), {'limit': 50}, False),
+        Scenario('async_message_create', 'post', reverse('async_message_create'),
+                 {'thread': thread.id, 'text': 'Benchmark message'}, True),
+        Scenario('async_messages_list', 'get', reverse('async_messages_list', kwargs={'thread_id': thread.id}),
+                 {'limit': 50}, False),
+        Scenario('async_unread_messages_count', 'get', reverse('async_unread_messages_count'), None, False),
+    ]
+
+
+def percentile(values, percent):
+    """Nearest-rank percentile of ``values``."""
+    ordered = sorted(values)
+    return ordered[max(math.ceil(percent / 100 * len(ordered)) - 1, 0)]
+
+
+def is_transaction_control(sql):
+    return sql.startswith(('BEGIN', 'COMMIT', 'ROLLBACK', 'SAVEPOINT', 'RELEASE SAVEPOINT'))
+
+
+def send(client, scenario):
+    if scenario.method == 'get':
+        return client.get(scenario.path, scenario.data)
+    return getattr(client, scenario.method)(scenario.path, scenario.data, format='json')
+
+
+def run_scenario(client, scenario, iterations):
+    """Send the scenario request ``iterations`` times, writes are rolled back to keep the dataset as is."""
+    latencies, queries, statuses = [], [], Counter()
+    started = time.perf_counter()
+    for _ in range(iterations):
+        with CaptureQueriesContext(connection) as context:
+            request_started = time.perf_counter()
+            if scenario.writes:
+                with transaction.atomic():
+                    response = send(client, scenario)
+                    transaction.set_rollback(True)
+            else:
+                response = send(client, scenario)
+            latencies.append(time.perf_counter() - request_started)
+        queries.append(sum(1 for query in context.captured_queries if not is_transaction_control(query['sql'])))
+        statuses[response.status_code] += 1
+    elapsed = time.perf_counter() - started
+
+    return {
+        'name': scenario.name,
+        'requests': iterations,
+        'p50': percentile(latencies, 50),
+        'p95': percentile(latencies, 95),
+        'p99': percentile(latencies, 99),
+        'throughput': iterations / elapsed,
+        'queries': max(queries),
+        'statuses': dict(statuses),
+    }
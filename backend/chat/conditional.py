@@ -0,0 +1,44 @@
+"""
+Conditional GET for the endpoints polling clients call over and over.
+
+A view computes its validators with one cheap query, before anything is serialized, and a
+request whose ``If-None-Match`` (or ``If-Modified-Since``) still matches them gets an empty
+304 Not Modified instead of the listing.
+
+``Last-Modified`` has a one second resolution: a change later in the same second would not move
+it, and a client revalidating with ``If-Modified-Since`` alone would miss that change. It is only
+sent once its second is over, until then the response carries its ``ETag`` only.
+"""
+import hashlib
+from django.utils import timezone
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date, quote_etag
+
+
+def make_etag(request, *parts):
+    """ETag of the representation of ``request`` built from ``parts``, which must change with it."""
+    parts += (request.user.pk, request.accepted_renderer.format, request.get_full_path())
+    return quote_etag(hashlib.md5(repr(parts).encode('utf-8')).hexdigest())
+
+
+class ConditionalGetMixin:
+
+    def get_validators(self):
+        """Return ``(etag, last_modified)`` of the response, either may be None."""
+        raise NotImplementedError
+
+    def get(self, request, *args, **kwargs):
+        etag, last_modified = self.get_validators()
+        timestamp = int(last_modified.timestamp()) if last_modified is not None else None
+        response = get_conditional_response(request, etag=etag, last_modified=timestamp)
+        if response is None:
+            response = self.get_modified_response(request, *args, **kwargs)
+        if etag is not None:
+            response.headers.setdefault('ETag', etag)
+        if timestamp is not None and timestamp < int(timezone.now().timestamp()):
+            response.headers.setdefault('Last-Modified', http_date(timestamp))
+        return response
+
+    def get_modified_response(self, request, *args, **kwargs):
+        """The full response, when the client does not have it yet."""
+        return super().get(request, *args, **kwargs)
@@ -0,0 +1,108 @@
+from django.db.models import Count, F, OuterRef, Q, Subquery, Sum, Value
+from django.db.models.functions import Coalesce
+from django.utils import timezone
+from chat.models import Thread, Message, UnreadCounter, ReadWatermark
+
+
+def ensure_counters(thread, user_ids):
+    UnreadCounter.objects.bulk_create(
+        [UnreadCounter(user_id=user_id, thread=thread) for user_id in user_ids],
+        ignore_conflicts=True
+    )
+
+
+def messages_created(thread_id, sender_id, count=1):
+    """Count new messages as unread for every participant except the sender."""
+    updated = UnreadCounter.objects.filter(thread_id=thread_id).exclude(user_id=sender_id).update(
+        count=F('count') + count, updated=timezone.now()
+    )
+    if not updated:  # Thread created outside the API, build its counters from scratch
+        rebuild_counters(thread_ids=[thread_id])
+
+
+def refresh(thread_ids):
+    """
+    Recount the unread messages of every participant of ``thread_ids`` from their read watermarks,
+    in one statement: a concurrent read status change can not slip between reading and writing them.
+    """
+    last_read = ReadWatermark.objects.filter(
+        user_id=OuterRef(OuterRef('user_id')), thread_id=OuterRef(OuterRef('thread_id'))
+    ).values('last_read_message_id')[:1]
+    unread = Message.objects.filter(
+        thread_id=OuterRef('thread_id'), id__gt=Coalesce(Subquery(last_read), Value(0))
+    ).exclude(sender_id=OuterRef('user_id')).order_by().values('thread_id').annotate(count=Count('id')).values('count')
+    updated = UnreadCounter.objects.filter(thread_id__in=thread_ids).update(
+        count=Coalesce(Subquery(unread), Value(0)), updated=timezone.now()
+    )
+    if not updated:
+        rebuild_counters(thread_ids=thread_ids)
+
+
+def recount(user_id, thread_id, last_read_message_id):
+    """Recount the user's unread messages after their read watermark moved."""
+    count = Message.objects.filter(thread_id=thread_id, id__gt=last_read_message_id).exclude(sender_id=user_id).count()
+    updated = UnreadCounter.objects.filter(user_id=user_id, thread_id=thread_id).update(
+        count=count, updated=timezone.now()
+    )
+    if not updated:
+        UnreadCounter.objects.create(user_id=user_id, thread_id=thread_id, count=count)
+
+
+def unread_total(user):
+    return UnreadCounter.objects.filter(user=user).aggregate(total=Sum('count'))['total'] or 0
+
+
+async def aunread_total(user):
+    return (await UnreadCounter.objects.filter(user=user).aaggregate(total=Sum('count')))['total'] or 0
+
+
+def compute_counters(thread_ids=None):
+    """Count unread messages per (user_id, thread_id) from the messages and read watermarks."""
+    memberships = Thread.participants.through.objects.all()
+    if thread_ids is not None:
+        memberships = memberships.filter(thread_id__in=thread_ids)
+    last_read = ReadWatermark.objects.filter(
+        user_id=OuterRef('user_id'), thread_id=OuterRef('thread_id')
+    ).values('last_read_message_id')[:1]
+    unread = Q(thread__messages__id__gt=F('last_read')) & ~Q(thread__messages__sender_id=F('user_id'))
+    rows = memberships.annotate(last_read=Coalesce(Subquery(last_read), Value(0))).values(
+        'user_id', 'thread_id'
+    ).annotate(count=Count('thread__messages', filter=unread))
+    return {(row['user_id'], row['thread_id']): row['count'] for row in rows}
+
+
+def stored_counters(thread_ids=None):
+    counters = UnreadCounter.objects.all()
+    if thread_ids is not None:
+        counters = counters.filter(thread_id__in=thread_ids)
+    rows = counters.values_list('user_id', 'thread_id', 'count')
+    return {(user_id, thread_id): count for user_id, thread_id, count in rows}
+
+
+def diff_counters(thread_ids=None):
+    """Return ``{(user_id, thread_id): (stored, expected)}`` for every counter that is off."""
+    expected = compute_counters(thread_ids)
+    stored = stored_counters(thread_ids)
+    return {
+        key: (stored.get(key), expected.get(key))
+        for key in expected.keys() | stored.keys()
+        if stored.get(key) != expected.get(key)
+    }
+
+
+def rebuild_counters(thread_ids=None):
+    expected = compute_counters(thread_ids)
+    stale = stored_counters(thread_ids).keys() - expected.keys()
+    now = timezone.now()
+    UnreadCounter.objects.bulk_create(
+        [
+            UnreadCounter(user_id=user_id, thread_id=thread_id, count=count, updated=now)
+            for (user_id, thread_id), count in expected.items()
+        ],
+        update_conflicts=True,
+        unique_fields=['user', 'thread'],
+        update_fields=['count', 'updated'],
+    )
+    for user_id, thread_id in stale:
+        UnreadCounter.objects.filter(user_id=user_id, thread_id=thread_id).delete()
+    return len(expected), len(stale)
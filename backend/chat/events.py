@@ -0,0 +1,33 @@
+from chat import counters
+from chat.membership import participant_ids
+from chat.pubsub import get_broker, user_channel
+
+
+def publish(user_ids, event_type, data):
+    broker = get_broker()
+    for channel in broker.subscribed([user_channel(user_id) for user_id in user_ids]):
+        broker.publish(channel, {'type': event_type, 'data': data})
+
+
+def listening(user_ids):
+    channels = set(get_broker().subscribed([user_channel(user_id) for user_id in user_ids]))
+    return [user_id for user_id in user_ids if user_channel(user_id) in channels]
+
+
+def message_created(message_data, unread_counts=True):
+    """Push a committed message to the thread participants and new unread counts to the recipients."""
+    user_ids = listening(participant_ids(message_data['thread']))
+    publish(user_ids, 'message', message_data)
+    if unread_counts:
+        unread_count_changed([user_id for user_id in user_ids if user_id != message_data['sender']])
+
+
+def thread_read(thread_id, user_id, last_read_message_id):
+    user_ids = listening(participant_ids(thread_id))
+    publish(user_ids, 'read', {'thread': thread_id, 'user': user_id, 'last_read_message_id': last_read_message_id})
+    unread_count_changed([user_id])
+
+
+def unread_count_changed(user_ids):
+    for user_id in listening(user_ids):
+        publish([user_id], 'unread_count', {'unread_messages_count': counters.unread_total(user_id)})
@@ -0,0 +1,226 @@
+"""
+Background jobs queued in the database, for side effects that do not have to delay the response.
+
+``enqueue`` writes jobs in the current transaction: workers see them once it commits and they
+vanish if it rolls back, without a write transaction of their own after the commit.
+Workers claim the due jobs of one name at a time, up to ``CHAT_JOBS['BATCH_SIZE']`` of them, and
+pass all their payloads to the handler registered under that name in one call, so a handler
+can coalesce many jobs into one write. When that call raises, the payloads are run again one at a
+time, so that only the jobs that fail on their own are retried, with an exponential backoff, and
+kept as failed after ``MAX_ATTEMPTS``. A job claimed by a worker that died is claimed again after
+``CLAIM_TIMEOUT`` seconds; handlers that may run longer call ``heartbeat`` as they go. Handlers may
+run a payload more than once, they have to be idempotent.
+
+With ``LOCAL_WORKER`` the process that queued jobs runs them in a background thread right after
+the commit. The ``run_jobs`` command runs dedicated workers on a thread or process pool; it also
+runs the retries, which the local worker leaves until it is woken up again.
+"""
+import logging
+import threading
+import time
+import traceback
+import uuid
+from datetime import timedelta
+from django.conf import settings
+from django.db import connection, transaction
+from django.db.models import Count, F, Q
+from django.utils import timezone
+from chat import metrics
+from chat.models import Job
+
+logger = logging.getLogger('chat.jobs')
+
+handlers = {}
+batch_sizes = {}
+
+_worker = None
+_rerun = False
+_worker_lock = threading.Lock()
+_claim = threading.local()
+
+
+def get_settings():
+    return {'LOCAL_WORKER': True, 'BATCH_SIZE': 100, 'MAX_ATTEMPTS': 5, 'RETRY_DELAY': 10, 'CLAIM_TIMEOUT': 300,
+            'POLL_INTERVAL': 1.0, 'DEFER_UNREAD_COUNTERS': False, **getattr(settings, 'CHAT_JOBS', {})}
+
+
+def register(name, batch_size=None):
+    """
+    Decorator registering the handler of the jobs ``name``, it is called with a list of payloads,
+    of at most ``batch_size`` jobs when it is given.
+    """
+    def decorator(handler):
+        handlers[name] = handler
+        if batch_size is not None:
+            batch_sizes[name] = batch_size
+        return handler
+    return decorator
+
+
+def enqueue(name, *payloads):
+    """Queue a job ``name`` per payload, to run once the current transaction commits."""
+    Job.objects.bulk_create([Job(name=name, payload=payload) for payload in payloads])
+    transaction.on_commit(wake)
+
+
+def due(now):
+    stale = now - timedelta(seconds=get_settings()['CLAIM_TIMEOUT'])
+    return Job.objects.filter(
+        Q(claimed_at__isnull=True) | Q(claimed_at__lt=stale), failed_at__isnull=True, run_after__lte=now
+    )
+
+
+def claim():
+    """Claim the next due jobs, all of the same name, return them or an empty list."""
+    now = timezone.now()
+    name = due(now).order_by('run_after', 'id').values_list('name', flat=True).first()
+    if name is None:
+        return []
+    token = uuid.uuid4().hex
+    batch_size = min(batch_sizes.get(name, get_settings()['BATCH_SIZE']), get_settings()['BATCH_SIZE'])
+    ids = list(due(now).filter(name=name).order_by('run_after', 'id').values_list('id', flat=True)[:batch_size])
+    # Claimed by whoever updates them first, another worker may have raced for the same ids
+    due(now).filter(id__in=ids).update(claimed_at=now, claimed_by=token, attempts=F('attempts') + 1)
+    return list(Job.objects.filter(id__in=ids, claimed_by=token))
+
+
+def run_batch():
+    """Run the next batch of due jobs, return how many were run."""
+    jobs = claim()
+    if not jobs:
+        return 0
+    name = jobs[0].name
+    started = time.perf_counter()
+    _claim.token, _claim.renewed = jobs[0].claimed_by, time.monotonic()
+    try:
+        error = handle(name, jobs)
+        if error is None:
+            done(jobs)
+        elif len(jobs) == 1 or name not in handlers:
+            failed(jobs, error)
+        else:
+            # One bad payload must not fail the others with it, they are told apart one at a time
+            for job in jobs:
+                error = handle(name, [job])
+                if error is None:
+                    done([job])
+                else:
+                    failed([job], error)
+    finally:
+        _claim.token = None
+    metrics.job_batch_duration.observe((name,), time.perf_counter() - started)
+    return len(jobs)
+
+
+def handle(name, jobs):
+    """Pass the payloads of ``jobs`` to the handler of ``name``, return the traceback if it raised."""
+    try:
+        if name not in handlers:
+            raise LookupError(f'No handler registered for the jobs {name!r}')
+        handlers[name]([job.payload for job in jobs])
+    except Exception:
+        logger.exception('%s %s jobs failed.', len(jobs), name)
+        return traceback.format_exc()
+    return None
+
+
+def heartbeat():
+    """
+    Renew the claim of the jobs the current thread is running, so that a handler running longer
+    than ``CLAIM_TIMEOUT`` keeps them. Writes at most every quarter of the timeout, does nothing
+    outside of a job.
+    """
+    token = getattr(_claim, 'token', None)
+    if token is None or time.monotonic() - _claim.renewed < get_settings()['CLAIM_TIMEOUT'] / 4:
+        return
+    Job.objects.filter(claimed_by=token).update(claimed_at=timezone.now())
+    _claim.renewed = time.monotonic()
+
+
+def done(jobs):
+    # Not those claimed again meanwhile by another worker, which deletes them once it is done
+    Job.objects.filter(id__in=[job.id for job in jobs], claimed_by=jobs[0].claimed_by).delete()
+    metrics.jobs_total.inc((jobs[0].name, 'done'), len(jobs))
+
+
+def failed(jobs, error):
+    options = get_settings()
+    now = timezone.now()
+    for job in jobs:
+        if job.attempts >= options['MAX_ATTEMPTS']:
+            Job.objects.filter(id=job.id).update(failed_at=now, last_error=error)
+            metrics.jobs_total.inc((job.name, 'failed'))
+        else:
+            retry_at = now + timedelta(seconds=options['RETRY_DELAY'] * 2 ** (job.attempts - 1))
+            Job.objects.filter(id=job.id).update(run_after=retry_at, claimed_at=None, claimed_by='', last_error=error)
+            metrics.jobs_total.inc((job.name, 'retried'))
+
+
+def work(stop=None, once=False):
+    """Run jobs until ``stop`` is set, or until none is due when ``once``."""
+    poll_interval = get_settings()['POLL_INTERVAL']
+    while stop is None or not stop.is_set():
+        if run_batch():
+            continue
+        if once:
+            return
+        if stop is None:
+            time.sleep(poll_interval)
+        else:
+            stop.wait(poll_interval)
+
+
+def wake():
+    """Start the local worker of this process, or have it look again once it is done."""
+    global _worker, _rerun
+    if not get_settings()['LOCAL_WORKER']:
+        return
+    with _worker_lock:
+        if _worker is not None:
+            _rerun = True
+            return
+        _rerun = False
+        _worker = threading.Thread(target=run_local_worker, name='chat-jobs', daemon=True)
+        _worker.start()
+
+
+def run_local_worker():
+    global _worker, _rerun
+    try:
+        while True:
+            work(once=True)
+            with _worker_lock:
+                if not _rerun:  # Checked and cleared under the lock, a wake() can not fall in between
+                    _worker = None
+                    return
+                _rerun = False
+    except Exception:
+        with _worker_lock:
+            _worker = None
+        logger.exception('The local job worker stopped, the run_jobs command picks up what is left.')
+    finally:
+        connection.close()
+
+
+def queue_stats():
+    """``{name: (queued, failed)}`` of the jobs in the database."""
+    stats = {}
+    rows = Job.objects.values('name').annotate(
+        queued=Count('id', filter=Q(failed_at__isnull=True)), failed=Count('id', filter=Q(failed_at__isnull=False))
+    ).order_by('name')
+    for row in rows:
+        stats[row['name']] = (row['queued'], row['failed'])
+    return stats
+
+
+def collect():
+    """Metrics collector of the queue depth, shared by every process."""
+    stats = queue_stats()
+    yield '# HELP chat_jobs_queued Jobs waiting in the queue, retries included, by name.'
+    yield '# TYPE chat_jobs_queued gauge'
+    for name, (queued, _) in stats.items():
+        yield f'chat_jobs_queued{metrics.format_labels([("name", name)])} {queued}'
+    yield '# HELP chat_jobs_failed Jobs that used up their attempts, by name.'
+    yield '# TYPE chat_jobs_failed gauge'
+    for name, (_, failed_count) in stats.items():
+        yield f'chat_jobs_failed{metrics.format_labels([("name", name)])} {failed_count}'
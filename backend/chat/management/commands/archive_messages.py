@@ -0,0 +1,24 @@
+from django.core.management.base import BaseCommand, CommandError
+from chat import archive
+
+
+class Command(BaseCommand):
+    help = 'Move the old messages read by every recipient to the compressed archive, in short batches.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--age-days', type=int, help='Archive messages older than this, '
+                                                         'CHAT_ARCHIVE["AGE_DAYS"] by default.')
+        parser.add_argument('--batch-size', type=int, help='Messages looked at per transaction, '
+                                                           'CHAT_ARCHIVE["BATCH_SIZE"] by default.')
+        parser.add_argument('--pause', type=float, help='Seconds between batches, CHAT_ARCHIVE["PAUSE"] by default.')
+
+    def handle(self, *args, **options):
+        def progress(last_id, archived):
+            if options['verbosity'] > 1:
+                self.stdout.write(f'Up to message {last_id}: {archived} archived.')
+
+        try:
+            archived = archive.archive(options['age_days'], options['batch_size'], options['pause'], progress)
+        except ValueError as error:
+            raise CommandError(error)
+        self.stdout.write(self.style.SUCCESS(f'Archived {archived} messages.'))
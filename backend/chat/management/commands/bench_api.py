@@ -0,0 +1,57 @@
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.db.models import Count
+from rest_framework.authtoken.models import Token
+from rest_framework.test import APIClient
+from chat.benchmarks import QUERY_BUDGETS, build_scenarios, run_scenario
+from chat.models import Thread, Message
+
+
+class Command(BaseCommand):
+    help = 'Benchmark every chat endpoint in-process: latency percentiles, throughput and SQL queries.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--iterations', type=int, default=100, help='Requests per endpoint.')
+        parser.add_argument('--thread', type=int, help='Thread to use, the one with most messages by default.')
+        parser.add_argument('--password', default='password', help='Password of the thread participants.')
+        parser.add_argument('--endpoint', action='append', dest='endpoints', help='Only benchmark this URL name.')
+
+    def handle(self, *args, **options):
+        thread = self.get_thread(options['thread'])
+        user, other_user = User.objects.filter(threads=thread).order_by('id')[:2]
+        message = Message.objects.filter(thread=thread).exclude(sender=user).order_by('-id').first()
+        if message is None:
+            raise CommandError(f'{thread} has no message from {other_user}.')
+        token, _ = Token.objects.get_or_create(user=user)
+
+        client = APIClient(HTTP_HOST='localhost')
+        client.credentials(HTTP_AUTHORIZATION=f'Token {token.key}')
+        scenarios = build_scenarios(user, options['password'], thread, message, other_user)
+        if options['endpoints']:
+            scenarios = [scenario for scenario in scenarios if scenario.name in options['endpoints']]
+
+        self.stdout.write(f'{thread} with {Message.objects.filter(thread=thread).count()} messages, '
+                          f'{options["iterations"]} requests per endpoint.')
+        self.stdout.write(f'{"endpoint":<30}{"p50 ms":>9}{"p95 ms":>9}{"p99 ms":>9}{"req/s":>9}'
+                          f'{"queries":>9}{"budget":>8}  statuses')
+        for scenario in scenarios:
+            run_scenario(client, scenario, 1)  # Warm up the caches
+            result = run_scenario(client, scenario, options['iterations'])
+            budget = QUERY_BUDGETS.get(scenario.name)
+            line = (f'{result["name"]:<30}{result["p50"] * 1000:>9.2f}{result["p95"] * 1000:>9.2f}'
+                    f'{result["p99"] * 1000:>9.2f}{result["throughput"]:>9.1f}{result["queries"]:>9}'
+                    f'{budget if budget is not None else "-":>8}  {result["statuses"]}')
+            if budget is not None and result['queries'] > budget:
+                line = self.style.ERROR(line)
+            self.stdout.write(line)
+
+    def get_thread(self, thread_id):
+        if thread_id is not None:
+            try:
+                return Thread.objects.get(pk=thread_id)
+            except Thread.DoesNotExist:
+                raise CommandError(f'Thread {thread_id} does not exist.')
+        busiest = Message.objects.values('thread_id').annotate(count=Count('id')).order_by('-count').first()
+        if busiest is None:
+            raise CommandError('There are no messages, run the seed_chat command first.')
+        return Thread.objects.get(pk=busiest['thread_id'])
@@ -0,0 +1,128 @@
+import asyncio
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlencode
+from django.core.handlers.asgi import ASGIHandler
+from django.core.handlers.wsgi import WSGIHandler
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+from django.db.models import Count
+from django.test import RequestFactory
+from django.urls import reverse
+from rest_framework.authtoken.models import Token
+from chat.benchmarks import percentile
+from chat.models import Thread, Message
+
+ENDPOINTS = ['messages_list', 'thread_list', 'unread_messages_count']
+
+
+class Command(BaseCommand):
+    help = ('Compare the throughput of concurrent connections: sync views on a threaded WSGI server, '
+            'the same views under ASGI and the async views under ASGI.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--concurrency', type=int, default=50, help='Connections in flight.')
+        parser.add_argument('--requests', type=int, default=1000, help='Requests per endpoint and stack.')
+        parser.add_argument('--endpoint', action='append', dest='endpoints', choices=ENDPOINTS,
+                            help='Only benchmark this URL name.')
+
+    def handle(self, *args, **options):
+        busiest = Message.objects.values('thread_id').annotate(count=Count('id')).order_by('-count').first()
+        if busiest is None:
+            raise CommandError('There are no messages, run the seed_chat command first.')
+        thread = Thread.objects.get(pk=busiest['thread_id'])
+        token, _ = Token.objects.get_or_create(user=thread.participants.order_by('id').first())
+        connections.close_all()
+
+        self.stdout.write(f'{options["concurrency"]} concurrent connections, {options["requests"]} requests per run.')
+        self.stdout.write(f'{"endpoint":<24}{"stack":<12}{"req/s":>9}{"p50 ms":>9}{"p95 ms":>9}{"p99 ms":>9}  statuses')
+        for name in options['endpoints'] or ENDPOINTS:
+            kwargs = {'thread_id': thread.id} if name == 'messages_list' else {}
+            query = urlencode({'limit': 50}) if name != 'unread_messages_count' else ''
+            runs = [
+                ('wsgi', self.run_wsgi, reverse(name, kwargs=kwargs)),
+                ('asgi-sync', self.run_asgi, reverse(name, kwargs=kwargs)),
+                ('asgi-async', self.run_asgi, reverse(f'async_{name}', kwargs=kwargs)),
+            ]
+            for stack, run, path in runs:
+                started = time.perf_counter()
+                latencies, statuses = run(path, query, token.key, options['concurrency'], options['requests'])
+                elapsed = time.perf_counter() - started
+                self.stdout.write(
+                    f'{name:<24}{stack:<12}{len(latencies) / elapsed:>9.1f}{percentile(latencies, 50) * 1000:>9.2f}'
+                    f'{percentile(latencies, 95) * 1000:>9.2f}{percentile(latencies, 99) * 1000:>9.2f}  {statuses}'
+                )
+                connections.close_all()
+
+    def run_wsgi(self, path, query, key, concurrency, requests):
+        """A thread per connection, like a threaded WSGI server."""
+        handler = WSGIHandler()
+        factory = RequestFactory()
+
+        def send(_):
+            environ = factory.get(path, QUERY_STRING=query, HTTP_AUTHORIZATION=f'Token {key}',
+                                  HTTP_HOST='localhost').environ
+            started = time.perf_counter()
+            status = []
+            body = handler(environ, lambda status_line, headers: status.append(int(status_line[:3])))
+            b''.join(body)
+            body.close()
+            return time.perf_counter() - started, status[0]
+
+        def worker(count):
+            try:
+                return [send(i) for i in range(count)]
+            finally:
+                connections.close_all()
+
+        with ThreadPoolExecutor(concurrency) as executor:
+            shares = [requests // concurrency + (i < requests % concurrency) for i in range(concurrency)]
+            results = [result for chunk in executor.map(worker, shares) for result in chunk]
+        return self.summarize(results)
+
+    def run_asgi(self, path, query, key, concurrency, requests):
+        """Coroutines on one event loop, like an ASGI server."""
+        handler = ASGIHandler()
+        scope = {
+            'type': 'http', 'asgi': {'version': '3.0'}, 'http_version': '1.1', 'scheme': 'http',
+            'method': 'GET', 'path': path, 'raw_path': path.encode(), 'root_path': '',
+            'query_string': query.encode(), 'server': ('localhost', 80), 'client': ('127.0.0.1', 0),
+            'headers': [(b'host', b'localhost'), (b'authorization', f'Token {key}'.encode())],
+        }
+
+        async def send_request():
+            disconnected = asyncio.Event()
+            messages = iter([{'type': 'http.request', 'body': b'', 'more_body': False}])
+            status = []
+
+            async def receive():
+                message = next(messages, None)
+                if message is None:  # The client stays connected until the response is sent
+                    await disconnected.wait()
+                    return {'type': 'http.disconnect'}
+                return message
+
+            async def send(message):
+                if message['type'] == 'http.response.start':
+                    status.append(message['status'])
+
+            started = time.perf_counter()
+            await handler(dict(scope), receive, send)
+            disconnected.set()
+            return time.perf_counter() - started, status[0]
+
+        async def worker(count):
+            return [await send_request() for _ in range(count)]
+
+        async def main():
+            shares = [requests // concurrency + (i < requests % concurrency) for i in range(concurrency)]
+            chunks = await asyncio.gather(*(worker(share) for share in shares))
+            return [result for chunk in chunks for result in chunk]
+
+        return self.summarize(asyncio.run(main()))
+
+    def summarize(self, results):
+        statuses = {}
+        for _, status in results:
+            statuses[status] = statuses.get(status, 0) + 1
+        return [latency for latency, _ in results], statuses
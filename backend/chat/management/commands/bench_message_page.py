@@ -0,0 +1,56 @@
+import time
+from django.core.management.base import BaseCommand, CommandError
+from django.db.models import Count
+from rest_framework.renderers import JSONRenderer
+from chat import reads
+from chat.models import Message
+from chat.renderers import FastJSONRenderer, orjson
+from chat.serializers import MessageSerializer, MESSAGE_ROW_FIELDS, serialize_message_rows
+
+
+class Command(BaseCommand):
+    help = 'Compare the CPU time of building one messages page through MessageSerializer and through the fast path.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rows', type=int, default=100, help='Messages per page.')
+        parser.add_argument('--iterations', type=int, default=200)
+
+    def handle(self, *args, **options):
+        busiest = Message.objects.values('thread_id').annotate(count=Count('id')).order_by('-count').first()
+        if busiest is None:
+            raise CommandError('There are no messages, run the seed_chat command first.')
+        thread_id, rows = busiest['thread_id'], options['rows']
+        messages = Message.objects.filter(thread_id=thread_id).order_by('-created', '-id')
+        watermarks = reads.thread_watermarks([thread_id])
+
+        paths = [
+            ('ModelSerializer', lambda: list(messages[:rows]),
+             lambda page: MessageSerializer(page, many=True, context={'watermarks': watermarks}).data,
+             JSONRenderer().render),
+            ('fast path', lambda: list(messages.values_list(*MESSAGE_ROW_FIELDS, named=True)[:rows]),
+             lambda page: serialize_message_rows(page, watermarks),
+             FastJSONRenderer().render),
+        ]
+        if len({render(serialize(fetch())) for _, fetch, serialize, render in paths}) != 1:
+            raise CommandError('The fast path renders a different page.')
+
+        self.stdout.write(f'{rows} messages of thread {thread_id} per page, {options["iterations"]} iterations, '
+                          f'orjson {"installed" if orjson else "not installed"}. CPU ms per page:')
+        self.stdout.write(f'{"path":<20}{"fetch":>10}{"serialize":>14}{"render":>11}{"total":>10}')
+        results = {}
+        for name, fetch, serialize, render in paths:
+            timings = [0.0, 0.0, 0.0]
+            for _ in range(options['iterations']):
+                started = time.process_time()
+                page = fetch()
+                fetched = time.process_time()
+                data = serialize(page)
+                serialized = time.process_time()
+                render(data)
+                timings[0] += fetched - started
+                timings[1] += serialized - fetched
+                timings[2] += time.process_time() - serialized
+            timings = [timing / options['iterations'] * 1000 for timing in timings]
+            results[name] = sum(timings)
+            self.stdout.write(f'{name:<20}{timings[0]:>10.3f}{timings[1]:>14.3f}{timings[2]:>11.3f}{sum(timings):>10.3f}')
+        self.stdout.write(f'CPU time per page cut by {1 - results["fast path"] / results["ModelSerializer"]:.0%}.')
@@ -0,0 +1,135 @@
+import importlib
+import sqlite3
+import tempfile
+import multiprocessing
+import time
+from collections import defaultdict
+from pathlib import Path
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.db import OperationalError, connections
+from django.db.models import Count
+from django.urls import reverse
+from rest_framework.authtoken.models import Token
+from rest_framework.test import APIClient
+from chat.benchmarks import percentile
+from chat.models import Message
+
+
+class Command(BaseCommand):
+    help = ('Compare concurrent message writes and reads on copies of the SQLite database '
+            'with the default and the production database settings, one process per client like web workers.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--writers', type=int, default=4, help='Processes posting messages.')
+        parser.add_argument('--readers', type=int, default=4, help='Processes listing messages.')
+        parser.add_argument('--duration', type=float, default=10, help='Seconds each profile runs.')
+        parser.add_argument('--production-settings', default='config.settings_production',
+                            help='Settings module holding the production DATABASES.')
+
+    def handle(self, *args, **options):
+        database = settings.DATABASES['default']
+        if database['ENGINE'] not in ('django.db.backends.sqlite3', 'config.sqlite3'):
+            raise CommandError('The default database is not SQLite.')
+        busiest = Message.objects.values('thread_id').annotate(count=Count('id')).order_by('-count').first()
+        if busiest is None:
+            raise CommandError('There are no messages, run the seed_chat command first.')
+        thread_id = busiest['thread_id']
+        keys = dict(Token.objects.filter(user__in=User.objects.filter(threads=thread_id)).values_list('user_id', 'key'))
+        if len(keys) < 2:
+            raise CommandError(f'The participants of thread {thread_id} need tokens.')
+
+        production = importlib.import_module(options['production_settings']).DATABASES['default']
+        profiles = [
+            ('default', {'ENGINE': 'django.db.backends.sqlite3', 'OPTIONS': {}, 'CONN_MAX_AGE': 0,
+                         'CONN_HEALTH_CHECKS': False}, 'DELETE'),
+            ('production', {key: production[key] for key in ('ENGINE', 'OPTIONS', 'CONN_MAX_AGE', 'CONN_HEALTH_CHECKS')
+                            if key in production}, None),
+        ]
+
+        self.stdout.write(f'{options["writers"]} writers and {options["readers"]} readers on thread {thread_id}, '
+                          f'{options["duration"]}s per profile.')
+        self.stdout.write(f'{"profile":<12}{"role":<8}{"requests":>10}{"req/s":>9}{"p50 ms":>9}{"p95 ms":>9}'
+                          f'{"p99 ms":>9}{"locked":>8}')
+        original = dict(database)
+        self.reset_connection()
+        # Next to the database, on the same disk, so fsync costs what they cost in production
+        with tempfile.TemporaryDirectory(dir=Path(original['NAME']).parent) as directory:
+            try:
+                for name, profile, journal_mode in profiles:
+                    path = Path(directory) / f'{name}.sqlite3'
+                    self.copy_database(original['NAME'], path, journal_mode)
+                    database.update(original, NAME=path, **profile)
+                    self.reset_connection()
+                    results = self.run_profile(thread_id, list(keys.values()), options)
+                    for role in ('write', 'read'):
+                        self.write_result(name, role, results[role], options['duration'])
+            finally:
+                self.reset_connection()
+                database.clear()
+                database.update(original)
+
+    def reset_connection(self):
+        """Drop the connection of this thread, the next one is built from the updated settings."""
+        connections['default'].close()
+        del connections['default']
+
+    def copy_database(self, source, target, journal_mode):
+        """Copy through the backup API, which also picks up changes still in a WAL file."""
+        with sqlite3.connect(source) as source_connection, sqlite3.connect(target) as target_connection:
+            source_connection.backup(target_connection)
+            if journal_mode is not None:
+                target_connection.execute(f'PRAGMA journal_mode={journal_mode}')
+        source_connection.close()
+        target_connection.close()
+
+    def run_profile(self, thread_id, keys, options):
+        context = multiprocessing.get_context('fork')  # Children inherit the configured Django and settings
+        queue = context.Queue()
+
+        def work(role, key):
+            client = APIClient(HTTP_HOST='localhost')
+            client.credentials(HTTP_AUTHORIZATION=f'Token {key}')
+            latencies, locked = [], 0
+            deadline = time.monotonic() + options['duration']
+            try:
+                while time.monotonic() < deadline:
+                    started = time.perf_counter()
+                    try:
+                        if role == 'write':
+                            client.post(reverse('message_create'), {'thread': thread_id, 'text': 'Benchmark'},
+                                        format='json')
+                        else:
+                            client.get(reverse('messages_list', kwargs={'thread_id': thread_id}), {'limit': 50})
+                    except OperationalError:
+                        locked += 1
+                        continue
+                    latencies.append(time.perf_counter() - started)
+            finally:
+                connections.close_all()
+                queue.put((role, latencies, locked))
+
+        roles = ['write'] * options['writers'] + ['read'] * options['readers']
+        workers = [context.Process(target=work, args=(role, keys[i % len(keys)])) for i, role in enumerate(roles)]
+        for worker in workers:
+            worker.start()
+        results = defaultdict(lambda: {'latencies': [], 'locked': 0})
+        for _ in workers:
+            role, latencies, locked = queue.get()
+            results[role]['latencies'] += latencies
+            results[role]['locked'] += locked
+        for worker in workers:
+            worker.join()
+        return results
+
+    def write_result(self, name, role, result, duration):
+        latencies = result['latencies']
+        if not latencies:
+            self.stdout.write(f'{name:<12}{role:<8}{0:>10}{"-":>9}{"-":>9}{"-":>9}{"-":>9}{result["locked"]:>8}')
+            return
+        self.stdout.write(
+            f'{name:<12}{role:<8}{len(latencies):>10}{len(latencies) / duration:>9.1f}'
+            f'{percentile(latencies, 50) * 1000:>9.2f}{percentile(latencies, 95) * 1000:>9.2f}'
+            f'{percentile(latencies, 99) * 1000:>9.2f}{result["locked"]:>8}'
+        )
@@ -0,0 +1,72 @@
+import json
+import os
+import subprocess
+import sys
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from chat.benchmarks import percentile
+
+# Run in a fresh interpreter per sample: loads the WSGI application and every view like a worker booting,
+# then serves the schema once. RSS is read from /proc on Linux, elsewhere the peak RSS is used (bytes on macOS).
+WORKER = '''
+import json, resource, sys, time
+
+def rss():
+    try:
+        with open('/proc/self/status') as status:
+            return next(int(line.split()[1]) * 1024 for line in status if line.startswith('VmRSS:'))
+    except OSError:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+started = time.perf_counter()
+from django.core.wsgi import get_wsgi_application
+application = get_wsgi_application()
+from django.urls import get_resolver
+get_resolver().url_patterns
+startup = time.perf_counter() - started
+startup_rss = rss()
+modules = len(sys.modules)
+from django.test import Client
+client = Client(SERVER_NAME='localhost')
+started = time.perf_counter()
+status = client.get('/api/schema/').status_code
+schema = time.perf_counter() - started
+print(json.dumps({'startup': startup, 'rss': startup_rss, 'modules': modules, 'schema': schema, 'schema_status': status,
+                  'schema_rss': rss()}))
+'''
+
+
+class Command(BaseCommand):
+    help = 'Compare the startup time, memory and first schema request of a worker booting with each settings profile.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--profiles', nargs='+',
+                            default=['config.settings', 'config.settings_production', 'config.settings_api'],
+                            help='Settings modules to compare.')
+        parser.add_argument('--iterations', type=int, default=10, help='Worker processes started per profile.')
+
+    def handle(self, *args, **options):
+        self.stdout.write(f'{options["iterations"]} workers per profile, median values. Build the schema with '
+                          f'build_schema first, profiles without it generate it or answer 404.')
+        self.stdout.write(f'{"profile":<30}{"startup ms":>12}{"RSS MiB":>10}{"modules":>9}{"schema ms":>11}'
+                          f'{"status":>8}{"RSS after":>11}')
+        for profile in options['profiles']:
+            samples = [self.run_worker(profile) for _ in range(options['iterations'])]
+
+            def median(key):
+                return percentile([sample[key] for sample in samples], 50)
+
+            self.stdout.write(
+                f'{profile:<30}{median("startup") * 1000:>12.1f}{median("rss") / 2 ** 20:>10.1f}'
+                f'{median("modules"):>9}{median("schema") * 1000:>11.1f}{samples[0]["schema_status"]:>8}'
+                f'{median("schema_rss") / 2 ** 20:>11.1f}'
+            )
+
+    def run_worker(self, profile):
+        result = subprocess.run(
+            [sys.executable, '-c', WORKER], cwd=settings.BASE_DIR, capture_output=True, text=True,
+            env={**os.environ, 'DJANGO_SETTINGS_MODULE': profile}
+        )
+        if result.returncode:
+            raise CommandError(f'The {profile} worker failed:\n{result.stderr}')
+        return json.loads(result.stdout.strip().splitlines()[-1])
@@ -0,0 +1,19 @@
+from django.core.management.base import BaseCommand, CommandError
+from chat import schema
+
+
+class Command(BaseCommand):
+    help = 'Write the OpenAPI schema to CHAT_SCHEMA["FILE"] as YAML and next to it as JSON, for the schema view.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--validate', action='store_true',
+                            help='Check the schema against the OpenAPI specification.')
+
+    def handle(self, *args, **options):
+        try:
+            paths = schema.build(options['validate'])
+        except ValueError as error:
+            raise CommandError(error)
+        for path in paths:
+            self.stdout.write(f'Wrote {path} ({path.stat().st_size} bytes).')
+        self.stdout.write(self.style.SUCCESS('Schema built.'))
@@ -0,0 +1,16 @@
+from datetime import timedelta
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+from chat import sync
+
+
+class Command(BaseCommand):
+    help = 'Delete the sync events older than CHAT_SYNC["RETENTION_DAYS"], cursors that old are refused anyway.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000, help='Events deleted per query.')
+
+    def handle(self, *args, **options):
+        before = timezone.now() - timedelta(days=sync.get_settings()['RETENTION_DAYS'])
+        deleted = sync.prune(before, options['batch_size'])
+        self.stdout.write(self.style.SUCCESS(f'Deleted {deleted} sync events.'))
@@ -0,0 +1,25 @@
+from django.core.management.base import BaseCommand
+from chat import purge
+
+
+class Command(BaseCommand):
+    help = 'Delete the messages, then the rows, of the deleted threads, in short batches.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, help='Messages deleted per transaction, '
+                                                             'CHAT_THREAD_PURGE["BATCH_SIZE"] by default.')
+        parser.add_argument('--pause', type=float, help='Seconds between batches, '
+                                                        'CHAT_THREAD_PURGE["PAUSE"] by default.')
+        parser.add_argument('--status', action='store_true', help='Only show what is left to purge.')
+
+    def handle(self, *args, **options):
+        threads, messages = purge.status()
+        self.stdout.write(f'{threads} deleted threads with {messages} messages left to purge.')
+        if options['status']:
+            return
+        purged = 0
+        for thread_id in list(purge.pending().values_list('id', flat=True)):
+            messages = purge.purge_thread(thread_id, options['batch_size'], options['pause'])
+            purged += 1
+            self.stdout.write(f'Purged thread {thread_id}: {messages} messages, {threads - purged} threads left.')
+        self.stdout.write(self.style.SUCCESS(f'Purged {purged} threads.'))
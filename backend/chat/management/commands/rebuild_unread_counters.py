@@ -0,0 +1,37 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from chat import counters
+from chat.models import Thread
+
+
+class Command(BaseCommand):
+    help = 'Rebuild or verify the per-thread unread message counters from the messages and read watermarks.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--verify', action='store_true', help='Only report counters that are off.')
+        parser.add_argument('--thread', type=int, action='append', dest='threads', help='Limit to the given thread id.')
+        parser.add_argument('--batch-size', type=int, default=500, help='Threads processed per transaction.')
+
+    def handle(self, *args, **options):
+        thread_ids = options['threads'] or list(Thread.objects.order_by('id').values_list('id', flat=True))
+        batch_size = options['batch_size']
+        mismatches = rebuilt = removed = 0
+
+        for start in range(0, len(thread_ids), batch_size):
+            batch = thread_ids[start:start + batch_size]
+            if options['verify']:
+                for (user_id, thread_id), (stored, expected) in sorted(counters.diff_counters(batch).items()):
+                    mismatches += 1
+                    self.stdout.write(f'user {user_id} thread {thread_id}: stored {stored}, expected {expected}')
+            else:
+                with transaction.atomic():
+                    batch_rebuilt, batch_removed = counters.rebuild_counters(batch)
+                rebuilt += batch_rebuilt
+                removed += batch_removed
+
+        if options['verify']:
+            if mismatches:
+                raise CommandError(f'{mismatches} unread counters are off.')
+            self.stdout.write(self.style.SUCCESS('All unread counters are correct.'))
+        else:
+            self.stdout.write(self.style.SUCCESS(f'Rebuilt {rebuilt} unread counters, removed {removed}.'))
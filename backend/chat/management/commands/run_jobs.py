@@ -0,0 +1,44 @@
+import threading
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from django.core.management.base import BaseCommand
+from django.db import connection, connections
+from chat import jobs
+
+
+def run_worker(stop=None, once=False):
+    try:
+        jobs.work(stop, once)
+    finally:
+        connection.close()
+
+
+class Command(BaseCommand):
+    help = 'Run the queued background jobs on a pool of worker threads or processes.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=1)
+        parser.add_argument('--pool', choices=['thread', 'process'], default='thread',
+                            help='Threads share the process, processes also run the handlers in parallel on CPUs.')
+        parser.add_argument('--once', action='store_true', help='Exit once no job is due instead of waiting for more.')
+
+    def handle(self, *args, **options):
+        for name, (queued, failed) in jobs.queue_stats().items():
+            self.stdout.write(f'{name}: {queued} queued, {failed} failed.')
+        self.stdout.write(f'Running jobs on {options["workers"]} {options["pool"]} workers.')
+        if options['pool'] == 'process':
+            connections.close_all()  # Forked workers open their own connections
+            executor = ProcessPoolExecutor(options['workers'])
+            stop = None  # Ctrl-C reaches the worker processes as well
+        else:
+            executor = ThreadPoolExecutor(options['workers'])
+            stop = threading.Event()
+        futures = [executor.submit(run_worker, stop, options['once']) for _ in range(options['workers'])]
+        try:
+            for future in futures:
+                future.result()
+        except KeyboardInterrupt:
+            if stop is not None:
+                stop.set()
+        finally:
+            executor.shutdown()
+        self.stdout.write(self.style.SUCCESS('Stopped.'))
@@ -0,0 +1,151 @@
+import random
+from contextlib import contextmanager
+from datetime import timedelta
+from itertools import accumulate
+from django.contrib.auth.hashers import make_password
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.db.models import OuterRef, Subquery
+from django.db.models.functions import Coalesce
+from django.utils import timezone
+from rest_framework.authtoken.models import Token
+from chat import counters
+from chat.models import Thread, Message, ReadWatermark
+
+
+@contextmanager
+def explicit_created():
+    """Let bulk_create keep the generated ``created`` values instead of stamping them with now()."""
+    field = Message._meta.get_field('created')
+    field.auto_now_add = False
+    try:
+        yield
+    finally:
+        field.auto_now_add = True
+
+
+class Command(BaseCommand):
+    help = 'Fill the database with a synthetic chat dataset for load tests and benchmarks.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=1000)
+        parser.add_argument('--threads', type=int, default=5000)
+        parser.add_argument('--messages', type=int, default=200000)
+        parser.add_argument('--skew', type=float, default=1.1,
+                            help='Zipf exponent of the messages per thread distribution, 0 for uniform.')
+        parser.add_argument('--days', type=int, default=365, help='Time span the messages are spread over.')
+        parser.add_argument('--read-ratio', type=float, default=0.8,
+                            help='Share of participants that have read their threads to the end.')
+        parser.add_argument('--password', default='password', help='Password of every generated user.')
+        parser.add_argument('--prefix', default='bench', help='Prefix of the generated usernames.')
+        parser.add_argument('--batch-size', type=int, default=5000)
+        parser.add_argument('--seed', type=int, default=0, help='Random seed, the same seed builds the same dataset.')
+
+    def handle(self, *args, **options):
+        rng = random.Random(options['seed'])
+        batch_size = options['batch_size']
+        users_count, threads_count = options['users'], options['threads']
+        if users_count < 2:
+            raise CommandError('At least 2 users are needed.')
+        if threads_count > users_count * (users_count - 1) // 2:
+            raise CommandError('Too many threads, every pair of users has at most one thread.')
+
+        users = self.create_users(options, batch_size)
+        threads = self.create_threads(rng, users, threads_count, batch_size)
+        self.create_messages(rng, threads, options, batch_size)
+        self.finish_threads(rng, sorted(thread_id for thread_id, _ in threads), options['read_ratio'], batch_size)
+
+        self.stdout.write(self.style.SUCCESS(
+            f'Created {len(users)} users, {len(threads)} threads and {options["messages"]} messages.'
+        ))
+
+    def create_users(self, options, batch_size):
+        password = make_password(options['password'])  # Hashed once, hashing per user would dominate the run
+        prefix = options['prefix']
+        with transaction.atomic():
+            User.objects.bulk_create(
+                [User(username=f'{prefix}_user_{i}', password=password) for i in range(options['users'])],
+                batch_size=batch_size
+            )
+            users = list(User.objects.filter(username__startswith=f'{prefix}_user_').values_list('id', flat=True))
+            Token.objects.bulk_create(
+                [Token(key=Token.generate_key(), user_id=user_id) for user_id in users],
+                batch_size=batch_size, ignore_conflicts=True
+            )
+        self.stdout.write(f'{len(users)} users ready.')
+        return users
+
+    def create_threads(self, rng, users, threads_count, batch_size):
+        pairs = set()
+        while len(pairs) < threads_count:
+            first, second = rng.sample(users, 2)
+            pairs.add((min(first, second), max(first, second)))
+
+        keys = [Thread.make_participants_key(pair) for pair in pairs]
+        with transaction.atomic():
+            Thread.objects.bulk_create([Thread(participants_key=key) for key in keys], batch_size=batch_size)
+            threads = {}
+            for start in range(0, len(keys), batch_size):
+                threads.update(Thread.objects.filter(participants_key__in=keys[start:start + batch_size]).values_list(
+                    'participants_key', 'id'
+                ))
+            participants = []
+            for pair, key in zip(pairs, keys):
+                participants += [
+                    Thread.participants.through(thread_id=threads[key], user_id=user_id) for user_id in pair
+                ]
+            Thread.participants.through.objects.bulk_create(participants, batch_size=batch_size)
+        self.stdout.write(f'{len(threads)} threads ready.')
+        return [(threads[key], pair) for pair, key in zip(pairs, keys)]
+
+    def create_messages(self, rng, threads, options, batch_size):
+        # Thread popularity follows a Zipf law: a few threads hold most of the messages
+        rng.shuffle(threads)
+        weights = list(accumulate(1 / (rank ** options['skew']) for rank in range(1, len(threads) + 1)))
+        total = options['messages']
+        start = timezone.now() - timedelta(days=options['days'])
+        step = timedelta(days=options['days']) / max(total, 1)
+
+        created = 0
+        with explicit_created():
+            while created < total:
+                size = min(batch_size, total - created)
+                picked = rng.choices(threads, cum_weights=weights, k=size)
+                messages = []
+                for offset, (thread_id, pair) in enumerate(picked):
+                    # Timestamps grow with the insertion order, so ids and ``created`` agree
+                    moment = start + step * (created + offset)
+                    messages.append(Message(
+                        thread_id=thread_id, sender_id=rng.choice(pair), text=f'Message {created + offset}',
+                        created=moment, updated=moment
+                    ))
+                with transaction.atomic():
+                    Message.objects.bulk_create(messages, batch_size=batch_size)
+                created += size
+                self.stdout.write(f'{created}/{total} messages.')
+
+    def finish_threads(self, rng, thread_ids, read_ratio, batch_size):
+        last_message = Message.objects.filter(thread=OuterRef('pk')).order_by('-id')
+        for start in range(0, len(thread_ids), batch_size):
+            batch = thread_ids[start:start + batch_size]
+            with transaction.atomic():
+                threads = Thread.objects.filter(id__in=batch)
+                threads.update(
+                    last_message=Subquery(last_message.values('id')[:1]),
+                    updated=Coalesce(Subquery(last_message.values('created')[:1]), 'updated'),
+                )
+
+                last_message_ids = dict(threads.values_list('id', 'last_message_id'))
+                watermarks = []
+                memberships = Thread.participants.through.objects.filter(thread_id__in=batch)
+                for thread_id, user_id in memberships.values_list('thread_id', 'user_id'):
+                    last_read_message_id = last_message_ids[thread_id] or 0
+                    if rng.random() >= read_ratio:
+                        last_read_message_id = max(last_read_message_id - rng.randint(1, 1000), 0)
+                    watermarks.append(ReadWatermark(
+                        thread_id=thread_id, user_id=user_id, last_read_message_id=last_read_message_id
+                    ))
+                ReadWatermark.objects.bulk_create(watermarks, batch_size=batch_size)
+                counters.rebuild_counters(batch)
+        self.stdout.write('Last messages, read watermarks and unread counters ready.')
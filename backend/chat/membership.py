@@ -0,0 +1,94 @@
+"""
+Thread membership lookups shared by the message endpoints.
+
+Participants of a thread never change after it is created, so the participant ids are
+cached per thread in a per-process LRU and, when ``CHAT_MEMBERSHIP_CACHE['CACHE_ALIAS']``
+names a Django cache, in that cache too. Entries are invalidated when a thread is created
+or deleted; other processes drop their local copy after ``TIMEOUT`` seconds.
+"""
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.cache import caches
+from chat.cache import LRUCache
+from chat.models import Thread
+
+_local = None
+
+
+def get_settings():
+    return {'MAX_ENTRIES': 10000, 'TIMEOUT': 60, 'CACHE_ALIAS': None, **getattr(settings, 'CHAT_MEMBERSHIP_CACHE', {})}
+
+
+def get_local_cache():
+    global _local
+    if _local is None:
+        options = get_settings()
+        _local = LRUCache(options['MAX_ENTRIES'], options['TIMEOUT'])
+    return _local
+
+
+def get_shared_cache():
+    alias = get_settings()['CACHE_ALIAS']
+    return caches[alias] if alias else None
+
+
+def cache_key(thread_id):
+    return f'chat:participants:{thread_id}'
+
+
+def participant_ids(thread_id):
+    """Return the ids of the thread participants, empty if the thread does not exist."""
+    local = get_local_cache()
+    participants = local.get(thread_id)
+    if participants is not None:
+        return participants
+
+    shared = get_shared_cache()
+    if shared is not None:
+        participants = shared.get(cache_key(thread_id))
+    if participants is None:
+        participants = frozenset(
+            Thread.participants.through.objects.filter(thread_id=thread_id).values_list('user_id', flat=True)
+        )
+        if not participants:  # The thread may be created later, never cache a miss
+            return participants
+        if shared is not None:
+            shared.set(cache_key(thread_id), participants, get_settings()['TIMEOUT'])
+    local.set(thread_id, participants)
+    return participants
+
+
+def participants_of(thread_ids):
+    """``{thread_id: participant ids}`` of many threads, with one query for those not cached locally."""
+    local = get_local_cache()
+    participants = {thread_id: local.get(thread_id) for thread_id in set(thread_ids)}
+    missing = [thread_id for thread_id, user_ids in participants.items() if user_ids is None]
+    if missing:
+        loaded = {thread_id: set() for thread_id in missing}
+        rows = Thread.participants.through.objects.filter(thread_id__in=missing).values_list('thread_id', 'user_id')
+        for thread_id, user_id in rows:
+            loaded[thread_id].add(user_id)
+        for thread_id, user_ids in loaded.items():
+            participants[thread_id] = frozenset(user_ids)
+            if user_ids:
+                local.set(thread_id, participants[thread_id])
+    return participants
+
+
+def is_participant(user_id, thread_id):
+    return user_id in participant_ids(thread_id)
+
+
+async def ais_participant(user_id, thread_id):
+    """Async ``is_participant``, answered in the event loop when the local cache has the thread."""
+    participants = get_local_cache().get(thread_id)
+    if participants is None:
+        participants = await sync_to_async(participant_ids)(thread_id)
+    return user_id in participants
+
+
+def invalidate(thread_id):
+    get_local_cache().delete(thread_id)
+    shared = get_shared_cache()
+    if shared is not None:
+        shared.delete(cache_key(thread_id))
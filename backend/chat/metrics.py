@@ -0,0 +1,217 @@
+"""
+In-process request and SQL metrics, rendered in the Prometheus text format.
+
+Values live in the memory of each worker process, so every worker has to be scraped on
+its own (or behind a per-process port).
+"""
+import contextvars
+import threading
+import time
+from django.conf import settings
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+QUERY_COUNT_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100)
+SIZE_BUCKETS = (100, 1000, 10000, 100000, 1000000)
+
+_lock = threading.Lock()
+
+
+def escape_label_value(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def format_labels(labels):
+    labels = list(labels)
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{name}="{escape_label_value(value)}"' for name, value in labels) + '}'
+
+
+class Counter:
+
+    def __init__(self, name, documentation, label_names=()):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(label_names)
+        self.values = {}
+
+    def inc(self, label_values=(), amount=1):
+        with _lock:
+            self.values[label_values] = self.values.get(label_values, 0) + amount
+
+    def collect(self):
+        yield f'# HELP {self.name} {self.documentation}'
+        yield f'# TYPE {self.name} counter'
+        with _lock:
+            values = list(self.values.items())
+        for label_values, value in values:
+            yield f'{self.name}{format_labels(zip(self.label_names, label_values))} {value}'
+
+
+class Histogram:
+
+    def __init__(self, name, documentation, buckets, label_names=()):
+        self.name = name
+        self.documentation = documentation
+        self.buckets = tuple(buckets)
+        self.label_names = tuple(label_names)
+        self.values = {}  # label values -> [count per bucket..., sum, count]
+
+    def observe(self, label_values, value):
+        with _lock:
+            series = self.values.get(label_values)
+            if series is None:
+                series = self.values[label_values] = [0] * (len(self.buckets) + 2)
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[index] += 1
+                    break
+            series[-2] += value
+            series[-1] += 1
+
+    def collect(self):
+        yield f'# HELP {self.name} {self.documentation}'
+        yield f'# TYPE {self.name} histogram'
+        with _lock:
+            values = [(label_values, list(series)) for label_values, series in self.values.items()]
+        for label_values, series in values:
+            labels = list(zip(self.label_names, label_values))
+            cumulative = 0
+            for bound, count in zip(self.buckets, series):
+                cumulative += count
+                yield f'{self.name}_bucket{format_labels(labels + [("le", bound)])} {cumulative}'
+            yield f'{self.name}_bucket{format_labels(labels + [("le", "+Inf")])} {series[-1]}'
+            yield f'{self.name}_sum{format_labels(labels)} {series[-2]}'
+            yield f'{self.name}_count{format_labels(labels)} {series[-1]}'
+
+
+class Registry:
+
+    def __init__(self):
+        self.metrics = []
+        self.collectors = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def register_collector(self, collector):
+        """``collector`` is called on every scrape and yields ready made exposition lines."""
+        self.collectors.append(collector)
+        return collector
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.collect())
+        for collector in self.collectors:
+            lines.extend(collector())
+        return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
+
+requests_total = registry.register(Counter(
+    'chat_http_requests_total', 'HTTP requests by view, method and status code.', ['view', 'method', 'status']
+))
+request_duration = registry.register(Histogram(
+    'chat_http_request_duration_seconds', 'HTTP request latency by view.', LATENCY_BUCKETS, ['view']
+))
+response_size = registry.register(Histogram(
+    'chat_http_response_size_bytes', 'HTTP response body size by view.', SIZE_BUCKETS, ['view']
+))
+request_queries = registry.register(Histogram(
+    'chat_db_queries_per_request', 'SQL queries per HTTP request by view.', QUERY_COUNT_BUCKETS, ['view']
+))
+request_query_duration = registry.register(Histogram(
+    'chat_db_query_duration_seconds', 'Time spent in SQL per HTTP request by view.', LATENCY_BUCKETS, ['view']
+))
+jobs_total = registry.register(Counter(
+    'chat_jobs_total', 'Background jobs run by this process, by name and outcome.', ['name', 'outcome']
+))
+job_batch_duration = registry.register(Histogram(
+    'chat_job_batch_duration_seconds', 'Time the handler took for one batch of jobs, by name.', LATENCY_BUCKETS,
+    ['name']
+))
+admission_rejected = registry.register(Counter(
+    'chat_admission_rejected_total', 'Write requests rejected with a 429 by admission control, by view and reason.',
+    ['view', 'reason']
+))
+admission_wait = registry.register(Histogram(
+    'chat_admission_wait_seconds', 'Time admitted write requests waited for an in-flight slot, by view.',
+    LATENCY_BUCKETS, ['view']
+))
+archived_messages = registry.register(Counter(
+    'chat_archived_messages_total', 'Messages moved to the archive by this process.'
+))
+purged_messages = registry.register(Counter(
+    'chat_purged_messages_total', 'Messages of deleted threads purged by this process.'
+))
+purged_threads = registry.register(Counter(
+    'chat_purged_threads_total', 'Deleted threads purged by this process, messages first.'
+))
+purge_batch_duration = registry.register(Histogram(
+    'chat_purge_batch_duration_seconds', 'Time each purge batch held the database write lock.', LATENCY_BUCKETS
+))
+
+
+def cache_collector(name, get_stats):
+    """Export the hit/miss counters of one of the chat caches."""
+    def collect():
+        stats = get_stats()
+        yield from (
+            f'chat_cache_hits_total{{cache="{name}"}} {stats["hits"]}',
+            f'chat_cache_misses_total{{cache="{name}"}} {stats["misses"]}',
+            f'chat_cache_hit_ratio{{cache="{name}"}} {stats["hit_rate"]}',
+            f'chat_cache_entries{{cache="{name}"}} {stats["size"]}',
+        )
+    return registry.register_collector(collect)
+
+
+class QueryStats:
+    """SQL queries run while serving one request."""
+
+    def __init__(self, keep_queries=False):
+        self.count = 0
+        self.duration = 0.0
+        self.queries = [] if keep_queries else None
+
+    def record(self, sql, duration):
+        self.count += 1
+        self.duration += duration
+        if self.queries is not None and len(self.queries) < 100:
+            self.queries.append((duration, sql))
+
+
+current_stats = contextvars.ContextVar('chat_query_stats', default=None)
+
+
+def query_wrapper(execute, sql, params, many, context):
+    """Database execute wrapper, installed on every connection, that feeds the current request's stats."""
+    stats = current_stats.get()
+    if stats is None:
+        return execute(sql, params, many, context)
+    started = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        stats.record(sql, time.perf_counter() - started)
+
+
+def install_query_wrapper(sender, connection, **kwargs):
+    """``connection_created`` receiver."""
+    if query_wrapper not in connection.execute_wrappers:
+        connection.execute_wrappers.append(query_wrapper)
+
+
+def get_settings():
+    return {'ENABLED': True, 'SLOW_REQUEST_THRESHOLD': None, **getattr(settings, 'CHAT_METRICS', {})}
+
+
+def observe_request(view, method, status_code, duration, size, stats):
+    requests_total.inc((view, method, status_code))
+    request_duration.observe((view,), duration)
+    if size is not None:
+        response_size.observe((view,), size)
+    request_queries.observe((view,), stats.count)
+    request_query_duration.observe((view,), stats.duration)
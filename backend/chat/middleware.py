@@ -0,0 +1,166 @@
+import logging
+import time
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.urls import Resolver404, resolve
+from rest_framework.permissions import SAFE_METHODS
+from chat import admission, metrics, routers
+
+slow_request_logger = logging.getLogger('chat.slow_requests')
+
+
+class MetricsMiddleware:
+    """
+    Records latency, SQL query count and time, and response size of every request by view name.
+
+    Requests slower than ``CHAT_METRICS['SLOW_REQUEST_THRESHOLD']`` seconds are logged to the
+    ``chat.slow_requests`` logger together with their slowest queries.
+    """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        options = metrics.get_settings()
+        self.enabled = options['ENABLED']
+        self.slow_request_threshold = options['SLOW_REQUEST_THRESHOLD']
+        if iscoroutinefunction(self.get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        if not self.enabled:
+            return self.get_response(request)
+        stats, token, started = self.start()
+        try:
+            response = self.get_response(request)
+        finally:
+            metrics.current_stats.reset(token)
+        self.finish(request, response, stats, started)
+        return response
+
+    async def __acall__(self, request):
+        if not self.enabled:
+            return await self.get_response(request)
+        stats, token, started = self.start()
+        try:
+            response = await self.get_response(request)
+        finally:
+            metrics.current_stats.reset(token)
+        self.finish(request, response, stats, started)
+        return response
+
+    def start(self):
+        stats = metrics.QueryStats(keep_queries=self.slow_request_threshold is not None)
+        return stats, metrics.current_stats.set(stats), time.perf_counter()
+
+    def finish(self, request, response, stats, started):
+        duration = time.perf_counter() - started
+        view = request.resolver_match.view_name if request.resolver_match else 'unresolved'
+        size = None if response.streaming else len(response.content)
+        metrics.observe_request(view, request.method, response.status_code, duration, size, stats)
+
+        if self.slow_request_threshold is not None and duration >= self.slow_request_threshold:
+            slowest = sorted(stats.queries, key=lambda query: query[0], reverse=True)[:10]
+            slow_request_logger.warning(
+                'Slow request %s %s (%s): %.3fs, %d queries in %.3fs\n%s',
+                request.method, request.path, view, duration, stats.count, stats.duration,
+                '\n'.join(f'{query_duration:.4f}s {sql}' for query_duration, sql in slowest),
+            )
+
+
+class AdmissionMiddleware:
+    """
+    Rejects write requests with a ``429`` when their user or all users write faster than
+    ``CHAT_ADMISSION`` allows, and caps the writes served at once, see ``chat.admission``.
+    """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        options = admission.get_settings()
+        self.controller = admission.Controller(options) if options['ENABLED'] else None
+        if iscoroutinefunction(self.get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        view = self.admitted_view(request)
+        user_id = admission.user_id(request) if view is not None else None
+        if user_id is None:
+            return self.get_response(request)  # Unauthenticated writes get their 401 from the view
+        rejection = self.controller.check_rates(user_id, view)
+        if rejection is not None:
+            return rejection
+        if not self.controller.acquire(view):
+            return admission.reject(view, 'in_flight', self.controller.queue_timeout)
+        try:
+            return self.get_response(request)
+        finally:
+            self.controller.release()
+
+    async def __acall__(self, request):
+        view = self.admitted_view(request)
+        user_id = await admission.auser_id(request) if view is not None else None
+        if user_id is None:
+            return await self.get_response(request)
+        rejection = self.controller.check_rates(user_id, view)
+        if rejection is not None:
+            return rejection
+        if not await self.controller.aacquire(view):
+            return admission.reject(view, 'in_flight', self.controller.queue_timeout)
+        try:
+            return await self.get_response(request)
+        finally:
+            self.controller.release()
+
+    def admitted_view(self, request):
+        """The view name of a write request subject to admission control, None for any other request."""
+        if self.controller is None or request.method in SAFE_METHODS:
+            return None
+        try:
+            match = resolve(request.path_info)
+        except Resolver404:
+            return None
+        if match.url_name not in self.controller.url_names:
+            return None
+        request.resolver_match = match  # Rejected requests are counted under their view by MetricsMiddleware
+        return match.view_name
+
+
+class ReplicaStickinessMiddleware:
+    """
+    Keep users on the primary database for a while after any successful write request, so
+    the replica reads that follow include what they have just written.
+
+    DRF sets the authenticated user on the Django request too, so token users are seen here.
+    """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.enabled = bool(routers.get_settings()['ALIASES'])
+        if iscoroutinefunction(self.get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        response = self.get_response(request)
+        self.process(request, response)
+        return response
+
+    async def __acall__(self, request):
+        response = await self.get_response(request)
+        self.process(request, response)
+        return response
+
+    def process(self, request, response):
+        if not self.enabled or request.method in SAFE_METHODS or response.status_code >= 400:
+            return
+        user = getattr(request, 'user', None)
+        if user is not None and user.is_authenticated:
+            routers.stick(user.pk)
@@ -0,0 +1,45 @@
+# Generated by Django 5.0.6 on 2026-10-18 16:28
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import Count, F, Q
+
+
+def build_counters(apps, schema_editor):
+    Thread = apps.get_model('chat', 'Thread')
+    UnreadCounter = apps.get_model('chat', 'UnreadCounter')
+    unread = Q(thread__messages__is_read=False) & ~Q(thread__messages__sender_id=F('user_id'))
+    rows = Thread.participants.through.objects.values('user_id', 'thread_id').annotate(
+        count=Count('thread__messages', filter=unread)
+    )
+    UnreadCounter.objects.bulk_create(
+        [UnreadCounter(user_id=row['user_id'], thread_id=row['thread_id'], count=row['count']) for row in rows],
+        batch_size=500
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0002_message_thread_created_index'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='UnreadCounter',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('count', models.PositiveIntegerField(default=0)),
+                ('updated', models.DateTimeField(auto_now=True)),
+                ('thread', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='unread_counters', to='chat.thread')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='unread_counters', to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name='unreadcounter',
+            constraint=models.UniqueConstraint(fields=('user', 'thread'), name='chat_unreadcounter_user_thread'),
+        ),
+        migrations.RunPython(build_counters, migrations.RunPython.noop),
+    ]
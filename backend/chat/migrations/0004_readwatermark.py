@@ -0,0 +1,68 @@
+# Generated by Django 5.0.6 on 2026-10-18 16:30
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import F, Max, Min, Q
+
+
+def build_watermarks(apps, schema_editor):
+    """Everything before the first message a participant has not read counts as read."""
+    Thread = apps.get_model('chat', 'Thread')
+    ReadWatermark = apps.get_model('chat', 'ReadWatermark')
+    UnreadCounter = apps.get_model('chat', 'UnreadCounter')
+    Message = apps.get_model('chat', 'Message')
+
+    from_others = ~Q(thread__messages__sender_id=F('user_id'))
+    rows = Thread.participants.through.objects.values('user_id', 'thread_id').annotate(
+        first_unread=Min('thread__messages__id', filter=from_others & Q(thread__messages__is_read=False)),
+        last_message=Max('thread__messages__id'),
+    )
+    watermarks = []
+    for row in rows:
+        if row['first_unread'] is not None:
+            last_read_message_id = row['first_unread'] - 1
+        else:
+            last_read_message_id = row['last_message'] or 0
+        watermarks.append(ReadWatermark(
+            user_id=row['user_id'], thread_id=row['thread_id'], last_read_message_id=last_read_message_id
+        ))
+    ReadWatermark.objects.bulk_create(watermarks, batch_size=500)
+
+    for watermark in watermarks:
+        count = Message.objects.filter(
+            thread_id=watermark.thread_id, id__gt=watermark.last_read_message_id
+        ).exclude(sender_id=watermark.user_id).count()
+        UnreadCounter.objects.update_or_create(
+            user_id=watermark.user_id, thread_id=watermark.thread_id, defaults={'count': count}
+        )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0003_unreadcounter'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ReadWatermark',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('last_read_message_id', models.BigIntegerField(default=0)),
+                ('updated', models.DateTimeField(auto_now=True)),
+                ('thread', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='read_watermarks', to='chat.thread')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='read_watermarks', to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name='readwatermark',
+            constraint=models.UniqueConstraint(fields=('user', 'thread'), name='chat_readwatermark_user_thread'),
+        ),
+        migrations.RunPython(build_watermarks, migrations.RunPython.noop),
+        migrations.RemoveField(
+            model_name='message',
+            name='is_read',
+        ),
+    ]
@@ -0,0 +1,37 @@
+# Generated by Django 5.0.6 on 2026-10-18 16:31
+
+from collections import defaultdict
+from django.db import migrations, models
+
+
+def build_participants_keys(apps, schema_editor):
+    """Key every two-participant thread, the oldest one wins when a pair has duplicates."""
+    Thread = apps.get_model('chat', 'Thread')
+    participants = defaultdict(list)
+    for thread_id, user_id in Thread.participants.through.objects.values_list('thread_id', 'user_id'):
+        participants[thread_id].append(user_id)
+
+    keys = set()
+    for thread_id in sorted(participants):
+        if len(participants[thread_id]) != 2:
+            continue
+        key = ':'.join(str(user_id) for user_id in sorted(participants[thread_id]))
+        if key not in keys:
+            keys.add(key)
+            Thread.objects.filter(pk=thread_id).update(participants_key=key)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0004_readwatermark'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='thread',
+            name='participants_key',
+            field=models.CharField(editable=False, max_length=64, null=True, unique=True),
+        ),
+        migrations.RunPython(build_participants_keys, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,33 @@
+# Generated by Django 5.0.6 on 2026-10-18 16:33
+
+import django.db.models.deletion
+from django.db import migrations, models
+from django.db.models import Max
+
+
+def set_last_messages(apps, schema_editor):
+    Thread = apps.get_model('chat', 'Thread')
+    Message = apps.get_model('chat', 'Message')
+    last_messages = Message.objects.values('thread_id').annotate(last_message_id=Max('id'))
+    for row in last_messages:
+        message = Message.objects.get(pk=row['last_message_id'])
+        thread = Thread.objects.get(pk=row['thread_id'])
+        Thread.objects.filter(pk=thread.pk).update(
+            last_message=message, updated=max(thread.updated, message.created)
+        )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0005_thread_participants_key'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='thread',
+            name='last_message',
+            field=models.ForeignKey(blank=True, editable=False, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='chat.message'),
+        ),
+        migrations.RunPython(set_last_messages, migrations.RunPython.noop),
+    ]
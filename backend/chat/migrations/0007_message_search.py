@@ -0,0 +1,55 @@
+from django.db import migrations
+
+# The SQL of chat.search as of this migration, later changes to that module must not alter it
+INSTALL = [
+    "CREATE VIRTUAL TABLE IF NOT EXISTS chat_message_fts USING fts5("
+    "text, thread_id, content='chat_message', content_rowid='id', tokenize='unicode61 remove_diacritics 2')",
+    "INSERT INTO chat_message_fts(chat_message_fts, rank) VALUES ('rank', 'bm25(1.0, 0.0)')",
+    """
+    CREATE TRIGGER IF NOT EXISTS chat_message_fts_insert AFTER INSERT ON chat_message BEGIN
+        INSERT INTO chat_message_fts(rowid, text, thread_id) VALUES (new.id, new.text, new.thread_id);
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS chat_message_fts_delete AFTER DELETE ON chat_message BEGIN
+        INSERT INTO chat_message_fts(chat_message_fts, rowid, text, thread_id)
+        VALUES ('delete', old.id, old.text, old.thread_id);
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS chat_message_fts_update AFTER UPDATE OF text, thread_id ON chat_message BEGIN
+        INSERT INTO chat_message_fts(chat_message_fts, rowid, text, thread_id)
+        VALUES ('delete', old.id, old.text, old.thread_id);
+        INSERT INTO chat_message_fts(rowid, text, thread_id) VALUES (new.id, new.text, new.thread_id);
+    END
+    """,
+    # Index the existing messages
+    "INSERT INTO chat_message_fts(chat_message_fts) VALUES ('rebuild')",
+]
+UNINSTALL = [
+    'DROP TRIGGER IF EXISTS chat_message_fts_insert',
+    'DROP TRIGGER IF EXISTS chat_message_fts_delete',
+    'DROP TRIGGER IF EXISTS chat_message_fts_update',
+    'DROP TABLE IF EXISTS chat_message_fts',
+]
+
+
+def run(statements):
+    def operation(apps, schema_editor):
+        # FTS5 is SQLite only, search is not supported on the other databases
+        if schema_editor.connection.vendor != 'sqlite':
+            return
+        for sql in statements:
+            schema_editor.execute(sql, params=None)
+    return operation
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0006_thread_last_message'),
+    ]
+
+    operations = [
+        migrations.RunPython(run(INSTALL), run(UNINSTALL)),
+    ]
@@ -0,0 +1,28 @@
+# Generated by Django 5.0.6 on 2026-10-18 17:09
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0007_message_search'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SyncEvent',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('kind', models.CharField(choices=[('message', 'Message'), ('read', 'Read'), ('thread_deleted', 'Thread deleted')], max_length=16)),
+                ('thread_id', models.BigIntegerField()),
+                ('message_id', models.BigIntegerField(help_text='The new message, or the last read message.', null=True)),
+                ('reader_id', models.BigIntegerField(help_text='Who read the thread.', null=True)),
+                ('created', models.DateTimeField(auto_now_add=True)),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='sync_events', to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+    ]
@@ -0,0 +1,24 @@
+# Generated by Django 5.0.6 on 2026-10-18 17:18
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0008_syncevent'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='thread',
+            name='deleted_at',
+            field=models.DateTimeField(blank=True, editable=False, help_text='Deleted, hidden until its messages are purged.', null=True),
+        ),
+        migrations.AddIndex(
+            model_name='thread',
+            index=models.Index(condition=models.Q(('deleted_at__isnull', False)), fields=['deleted_at'], name='chat_thread_deleted'),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.0.6 on 2026-10-18 17:50
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0011_archivedmessage'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='thread',
+            name='changed',
+            field=models.DateTimeField(blank=True, editable=False, help_text='Last edit or deletion of one of its messages, not activity.', null=True),
+        ),
+    ]
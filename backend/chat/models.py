@@ -1,11 +1,40 @@
 from django.db import models
 from django.contrib.auth.models import User
+from django.utils import timezone
+
+
+class ThreadManager(models.Manager):
+
+    def get_queryset(self):
+        return super().get_queryset().filter(deleted_at=None)
 
 
 class Thread(models.Model):
     participants = models.ManyToManyField(User, related_name='threads')
+    participants_key = models.CharField(max_length=64, unique=True, null=True, editable=False)
+    last_message = models.ForeignKey('Message', on_delete=models.SET_NULL, null=True, blank=True, editable=False,
+                                     related_name='+')
     created = models.DateTimeField(auto_now_add=True)
     updated = models.DateTimeField(auto_now=True)
+    changed = models.DateTimeField(null=True, blank=True, editable=False,
+                                   help_text='Last edit or deletion of one of its messages, not activity.')
+    deleted_at = models.DateTimeField(null=True, blank=True, editable=False,
+                                      help_text='Deleted, hidden until its messages are purged.')
+
+    objects = ThreadManager()  # Hides the deleted threads
+    all_objects = models.Manager()
+
+    class Meta:
+        indexes = [
+            # Only the deleted threads waiting for their purge
+            models.Index(fields=['deleted_at'], condition=models.Q(deleted_at__isnull=False),
+                         name='chat_thread_deleted'),
+        ]
+
+    @staticmethod
+    def make_participants_key(user_ids):
+        """Canonical key of a participants set, the same for any order of ids."""
+        return ':'.join(str(user_id) for user_id in sorted(user_ids))
 
     def __str__(self):
         return f'Thread {self.id}'
@@ -17,7 +46,109 @@ class Message(models.Model):
     text = models.TextField(verbose_name='Text')
     created = models.DateTimeField(auto_now_add=True)
     updated = models.DateTimeField(auto_now=True)
-    is_read = models.BooleanField(default=False)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['thread', 'created', 'id'], name='chat_message_thread_created'),
+        ]
 
     def __str__(self):
         return f"Message from {self.sender} in {self.thread}"
+
+
+class ArchivedMessage(models.Model):
+    """
+    A message moved out of ``Message`` once old and read by every recipient, see ``chat.archive``.
+    It keeps its id, the text is stored compressed.
+    """
+    id = models.BigIntegerField(primary_key=True)
+    sender = models.ForeignKey(User, on_delete=models.CASCADE, related_name='+')
+    # Served by the index below, like every lookup by thread
+    thread = models.ForeignKey(Thread, on_delete=models.CASCADE, related_name='archived_messages', db_index=False)
+    text = models.BinaryField()
+    created = models.DateTimeField()
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['thread', 'created', 'id'], name='chat_archived_thread_created'),
+        ]
+
+    def __str__(self):
+        return f'Archived message from {self.sender} in {self.thread}'
+
+
+class UnreadCounter(models.Model):
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='unread_counters')
+    thread = models.ForeignKey(Thread, on_delete=models.CASCADE, related_name='unread_counters')
+    count = models.PositiveIntegerField(default=0)
+    updated = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['user', 'thread'], name='chat_unreadcounter_user_thread'),
+        ]
+
+    def __str__(self):
+        return f'{self.count} unread for {self.user} in {self.thread}'
+
+
+class ReadWatermark(models.Model):
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='read_watermarks')
+    thread = models.ForeignKey(Thread, on_delete=models.CASCADE, related_name='read_watermarks')
+    last_read_message_id = models.BigIntegerField(default=0)
+    updated = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['user', 'thread'], name='chat_readwatermark_user_thread'),
+        ]
+
+    def __str__(self):
+        return f'{self.user} read {self.thread} up to message {self.last_read_message_id}'
+
+
+class SyncEvent(models.Model):
+    """
+    One change a user has to catch up with, in the order the changes happened. Thread and message
+    ids are plain columns: the log outlives what it points at.
+    """
+    MESSAGE = 'message'
+    READ = 'read'
+    THREAD_DELETED = 'thread_deleted'
+    KIND_CHOICES = [(MESSAGE, 'Message'), (READ, 'Read'), (THREAD_DELETED, 'Thread deleted')]
+
+    # The index of the foreign key also holds the row id, it serves "events of a user after an id" as is
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='sync_events')
+    kind = models.CharField(max_length=16, choices=KIND_CHOICES)
+    thread_id = models.BigIntegerField()
+    message_id = models.BigIntegerField(null=True, help_text='The new message, or the last read message.')
+    reader_id = models.BigIntegerField(null=True, help_text='Who read the thread.')
+    created = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return f'{self.kind} in thread {self.thread_id} for {self.user}'
+
+
+class Job(models.Model):
+    """
+    A side effect to run after the request that queued it, see ``chat.jobs``. The row is deleted
+    once the job succeeds and kept with ``failed_at`` set once it has used up its attempts.
+    """
+    name = models.CharField(max_length=100)
+    payload = models.JSONField(null=True)
+    attempts = models.PositiveSmallIntegerField(default=0)
+    run_after = models.DateTimeField(default=timezone.now)
+    claimed_at = models.DateTimeField(null=True, help_text='Taken by a worker, free again after CLAIM_TIMEOUT.')
+    claimed_by = models.CharField(max_length=32, blank=True)
+    failed_at = models.DateTimeField(null=True)
+    last_error = models.TextField(blank=True)
+    created = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        indexes = [
+            # The queue: jobs that have not failed, the next due first
+            models.Index(fields=['run_after', 'id'], condition=models.Q(failed_at__isnull=True), name='chat_job_queue'),
+        ]
+
+    def __str__(self):
+        return f'{self.name} job {self.id}'
@@ -0,0 +1,189 @@
+"""
+Cache of the messages list pages.
+
+A page is cached under the version of its thread, its limit and its cursor. Whatever changes
+what a page shows (a new message, a read status change, the thread deleted or recreated with
+the same id) gives the thread a new version, so the pages cached under the old one are never
+served again and simply age out of the LRU; nothing has to find and delete them.
+
+Versions and pages live in a per-process LRU, or in the Django cache named by
+``CHAT_MESSAGE_PAGE_CACHE['CACHE_ALIAS']`` so that every process sees the new version as soon
+as it changes. Without a shared cache each process has its own versions, which only suits a
+single process deployment.
+"""
+import hashlib
+import threading
+import uuid
+from django.conf import settings
+from django.core.cache import caches
+from django.db import transaction
+from chat import routers
+from chat.cache import LRUCache
+
+_local = None
+_versions = None
+_lock = threading.Lock()
+_counts = {'hits': 0, 'misses': 0}
+
+
+def get_settings():
+    return {'ENABLED': True, 'MAX_ENTRIES': 10000, 'TIMEOUT': 300, 'CACHE_ALIAS': None,
+            **getattr(settings, 'CHAT_MESSAGE_PAGE_CACHE', {})}
+
+
+def get_local_cache():
+    global _local
+    if _local is None:
+        options = get_settings()
+        _local = LRUCache(options['MAX_ENTRIES'], options['TIMEOUT'])
+    return _local
+
+
+def get_version_cache():
+    global _versions
+    if _versions is None:
+        _versions = LRUCache(get_settings()['MAX_ENTRIES'])
+    return _versions
+
+
+def get_shared_cache():
+    alias = get_settings()['CACHE_ALIAS']
+    return caches[alias] if alias else None
+
+
+def version_key(thread_id):
+    return f'chat:messages:version:{thread_id}'
+
+
+def new_version():
+    # Random rather than incremented, a version that was evicted is never handed out again
+    return uuid.uuid4().hex
+
+
+def get_version(thread_id):
+    shared = get_shared_cache()
+    if shared is None:
+        versions = get_version_cache()
+        version = versions.get(thread_id)
+        if version is None:
+            version = new_version()
+            versions.set(thread_id, version)
+        return version
+    version = shared.get(version_key(thread_id))
+    if version is None:
+        shared.add(version_key(thread_id), new_version(), None)
+        version = shared.get(version_key(thread_id))
+    return version
+
+
+async def aget_version(thread_id):
+    shared = get_shared_cache()
+    if shared is None:
+        return get_version(thread_id)
+    version = await shared.aget(version_key(thread_id))
+    if version is None:
+        await shared.aadd(version_key(thread_id), new_version(), None)
+        version = await shared.aget(version_key(thread_id))
+    return version
+
+
+def set_new_version(thread_id):
+    shared = get_shared_cache()
+    if shared is None:
+        get_version_cache().set(thread_id, new_version())
+    else:
+        shared.set(version_key(thread_id), new_version(), None)
+
+
+def invalidate(*thread_ids):
+    """Stop serving the cached pages of ``thread_ids``."""
+    if not get_settings()['ENABLED']:
+        return
+    # Right away and once more on commit, in case a concurrent request cached the old state under the new version
+    for thread_id in thread_ids:
+        set_new_version(thread_id)
+    transaction.on_commit(lambda: [set_new_version(thread_id) for thread_id in thread_ids])
+
+
+def cursor_digest(paginator, request):
+    # Cursors come from the client, hashed they are safe in the keys of any cache backend
+    params = paginator.before_query_param, paginator.after_query_param
+    cursors = [request.query_params.get(param) for param in params]
+    if cursors == [None, None]:
+        return 'latest'
+    return hashlib.md5(repr(cursors).encode('utf-8')).hexdigest()
+
+
+def page_key(thread_id, version, paginator, request):
+    return f'chat:messages:{thread_id}:{version}:{paginator.get_limit(request)}:{cursor_digest(paginator, request)}'
+
+
+def get_key(thread_id, paginator, request):
+    """Cache key of the requested page of ``thread_id``, None when the cache is disabled."""
+    if not get_settings()['ENABLED']:
+        return None
+    return page_key(thread_id, get_version(thread_id), paginator, request)
+
+
+async def aget_key(thread_id, paginator, request):
+    if not get_settings()['ENABLED']:
+        return None
+    return page_key(thread_id, await aget_version(thread_id), paginator, request)
+
+
+def count(page):
+    with _lock:
+        _counts['misses' if page is None else 'hits'] += 1
+    return page
+
+
+def get_page(key):
+    """The ``(results, paginator state, validators)`` cached under ``key``, None on a miss."""
+    if key is None:
+        return None
+    shared = get_shared_cache()
+    return count(get_local_cache().get(key) if shared is None else shared.get(key))
+
+
+async def aget_page(key):
+    if key is None:
+        return None
+    shared = get_shared_cache()
+    return count(get_local_cache().get(key) if shared is None else await shared.aget(key))
+
+
+def can_store(key):
+    # A replica may lag behind the version the page would be stored under
+    return key is not None and routers.current_read_alias() is None
+
+
+def set_page(key, page):
+    if not can_store(key):
+        return
+    shared = get_shared_cache()
+    if shared is None:
+        get_local_cache().set(key, page)
+    else:
+        shared.set(key, page, get_settings()['TIMEOUT'])
+
+
+async def aset_page(key, page):
+    if not can_store(key):
+        return
+    shared = get_shared_cache()
+    if shared is None:
+        get_local_cache().set(key, page)
+    else:
+        await shared.aset(key, page, get_settings()['TIMEOUT'])
+
+
+def stats():
+    with _lock:
+        hits, misses = _counts['hits'], _counts['misses']
+    lookups = hits + misses
+    return {
+        'hits': hits,
+        'misses': misses,
+        'hit_rate': hits / lookups if lookups else 0.0,
+        'size': len(get_local_cache()),
+    }
@@ -1,6 +1,284 @@
-from rest_framework.pagination import LimitOffsetPagination
+from base64 import b64decode, b64encode
+
+from django.core.exceptions import ValidationError as DjangoValidationError
+from django.db.models import Q
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import BasePagination, LimitOffsetPagination, _positive_int
+from rest_framework.response import Response
+from rest_framework.utils.urls import remove_query_param, replace_query_param
 
 
 class DefaultSetPagination(LimitOffsetPagination):
     default_limit = 10
     max_limit = 100
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.known_count = getattr(view, 'result_count', None)
+        return super().paginate_queryset(queryset, request, view)
+
+    def get_count(self, queryset):
+        """The count the view already has (``view.result_count``) or a count query."""
+        if getattr(self, 'known_count', None) is not None:
+            return self.known_count
+        return super().get_count(queryset)
+
+    async def apaginate_queryset(self, queryset, request, view=None):
+        """``paginate_queryset`` on the async ORM."""
+        self.request = request
+        self.limit = self.get_limit(request)
+        if self.limit is None:
+            return None
+        self.count = await queryset.acount()
+        self.offset = self.get_offset(request)
+        if self.count > self.limit and self.template is not None:
+            self.display_page_controls = True
+        if self.count == 0 or self.offset > self.count:
+            return []
+        return [item async for item in queryset[self.offset:self.offset + self.limit]]
+
+
+class KeysetPagination(BasePagination):
+    """
+    Keyset pagination over an ``(ordering field, id)`` pair.
+
+    Without a cursor the most recent page is returned. ``before`` returns rows older than
+    the cursor and ``after`` rows newer than it. Every page is a bounded range scan of the
+    matching composite index, so its cost does not depend on how deep the client scrolls.
+    """
+    ordering = ('created', 'id')
+    ascending = True  # order of rows inside a page
+    default_limit = 10
+    max_limit = 100
+    limit_query_param = 'limit'
+    before_query_param = 'before'
+    after_query_param = 'after'
+    invalid_cursor_message = 'Invalid cursor'
+
+    def paginate_queryset(self, queryset, request, view=None, tiers=()):
+        queryset = self.get_page_queryset(queryset, request, tiers)
+        return self.get_page(list(queryset[:self.limit + 1]))
+
+    async def apaginate_queryset(self, queryset, request, view=None, tiers=()):
+        """``paginate_queryset`` on the async ORM."""
+        queryset = self.get_page_queryset(queryset, request, tiers)
+        return self.get_page([row async for row in queryset[:self.limit + 1]])
+
+    def get_page_queryset(self, queryset, request, tiers=()):
+        """
+        The page of ``queryset``, ``limit + 1`` rows once sliced. ``tiers`` are querysets of the same
+        columns paged along with it, as if their rows were in ``queryset``: each one is filtered
+        like it and all are read in one ``UNION ALL`` query.
+        """
+        self.request = request
+        self.base_url = request.build_absolute_uri()
+        self.limit = self.get_limit(request)
+
+        field, pk = self.ordering
+        before = request.query_params.get(self.before_query_param)
+        after = request.query_params.get(self.after_query_param)
+        self.forward = after is not None
+
+        condition = Q()
+        if after is not None:
+            self.cursor = self.decode_cursor(after, queryset)
+            value, key = self.cursor
+            condition = Q(**{f'{field}__gte': value}) & (Q(**{f'{field}__gt': value}) | Q(**{f'{pk}__gt': key}))
+            ordering = field, pk
+        else:
+            self.cursor = self.decode_cursor(before, queryset) if before is not None else None
+            if self.cursor is not None:
+                value, key = self.cursor
+                condition = Q(**{f'{field}__lte': value}) & (Q(**{f'{field}__lt': value}) | Q(**{f'{pk}__lt': key}))
+            ordering = f'-{field}', f'-{pk}'
+
+        queryset = queryset.filter(condition)
+        if tiers:
+            queryset = queryset.union(*(tier.filter(condition) for tier in tiers), all=True)
+        return queryset.order_by(*ordering)
+
+    def get_page(self, rows):
+        """Trim the ``limit + 1`` fetched rows to the page and remember its neighbours."""
+        has_more = len(rows) > self.limit
+        rows = rows[:self.limit]
+        if not self.forward:
+            rows.reverse()
+
+        # ``rows`` is oldest first at this point.
+        if self.forward:
+            self.has_older, self.has_newer = True, has_more
+        else:
+            self.has_older, self.has_newer = has_more, self.cursor is not None
+        self.first_position = self.get_position(rows[0]) if rows else self.cursor
+        self.last_position = self.get_position(rows[-1]) if rows else self.cursor
+
+        if not self.ascending:
+            rows.reverse()
+        return rows
+
+    def get_limit(self, request):
+        try:
+            return _positive_int(
+                request.query_params[self.limit_query_param],
+                strict=True,
+                cutoff=self.max_limit
+            )
+        except (KeyError, ValueError):
+            return self.default_limit
+
+    def get_page_state(self):
+        """What the links of the current page are built from, to serve it again with ``restore_page``."""
+        return self.has_older, self.has_newer, self.first_position, self.last_position
+
+    def restore_page(self, request, state):
+        self.request = request
+        self.base_url = request.build_absolute_uri()
+        self.has_older, self.has_newer, self.first_position, self.last_position = state
+
+    def get_position(self, item):
+        field, pk = self.ordering
+        if isinstance(item, dict):
+            return item[field], item[pk]
+        return getattr(item, field), getattr(item, pk)
+
+    def encode_cursor(self, position):
+        value, key = position
+        value = value.isoformat() if hasattr(value, 'isoformat') else str(value)
+        return b64encode(f'{value}|{key}'.encode('utf-8')).decode('ascii')
+
+    def decode_cursor(self, encoded, queryset):
+        field, pk = self.ordering
+        try:
+            value, key = b64decode(encoded.encode('ascii'), validate=True).decode('utf-8').rsplit('|', 1)
+            value = queryset.model._meta.get_field(field).to_python(value)
+            key = queryset.model._meta.get_field(pk).to_python(key)
+        except (TypeError, ValueError, UnicodeError, DjangoValidationError):
+            raise NotFound(self.invalid_cursor_message)
+        if value is None or key is None:
+            raise NotFound(self.invalid_cursor_message)
+        return value, key
+
+    def get_older_link(self):
+        if not self.has_older or self.first_position is None:
+            return None
+        url = remove_query_param(self.base_url, self.after_query_param)
+        return replace_query_param(url, self.before_query_param, self.encode_cursor(self.first_position))
+
+    def get_newer_link(self):
+        if not self.has_newer or self.last_position is None:
+            return None
+        url = remove_query_param(self.base_url, self.before_query_param)
+        return replace_query_param(url, self.after_query_param, self.encode_cursor(self.last_position))
+
+    def get_next_link(self):
+        return self.get_newer_link() if self.ascending else self.get_older_link()
+
+    def get_previous_link(self):
+        return self.get_older_link() if self.ascending else self.get_newer_link()
+
+    def get_paginated_response(self, data):
+        return Response({
+            'next': self.get_next_link(),
+            'previous': self.get_previous_link(),
+            'results': data,
+        })
+
+    def get_paginated_response_schema(self, schema):
+        return {
+            'type': 'object',
+            'required': ['results'],
+            'properties': {
+                'next': {'type': 'string', 'nullable': True, 'format': 'uri'},
+                'previous': {'type': 'string', 'nullable': True, 'format': 'uri'},
+                'results': schema,
+            },
+        }
+
+    def get_schema_operation_parameters(self, view):
+        return [
+            {
+                'name': self.before_query_param,
+                'required': False,
+                'in': 'query',
+                'description': 'Cursor of the page with older results.',
+                'schema': {'type': 'string'},
+            },
+            {
+                'name': self.after_query_param,
+                'required': False,
+                'in': 'query',
+                'description': 'Cursor of the page with newer results.',
+                'schema': {'type': 'string'},
+            },
+            {
+                'name': self.limit_query_param,
+                'required': False,
+                'in': 'query',
+                'description': 'Number of results to return per page.',
+                'schema': {'type': 'integer'},
+            },
+        ]
+
+
+class MessageCursorPagination(KeysetPagination):
+    ordering = ('created', 'id')
+
+
+class ThreadInboxPagination(KeysetPagination):
+    ordering = ('updated', 'id')
+    ascending = False
+
+
+class MessageSearchPagination(KeysetPagination):
+    """
+    Forward only keyset pagination of search results over ``(rank, id)``, most relevant first.
+
+    Paginates a ``chat.search.MessageSearch`` instead of a queryset.
+    """
+    ordering = ('rank', 'id')
+    cursor_query_param = 'cursor'
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.request = request
+        self.base_url = request.build_absolute_uri()
+        self.limit = self.get_limit(request)
+
+        cursor = request.query_params.get(self.cursor_query_param)
+        self.cursor = self.decode_cursor(cursor, queryset) if cursor is not None else None
+        rows = queryset.fetch(self.limit + 1, self.cursor)
+        self.has_next = len(rows) > self.limit
+        rows = rows[:self.limit]
+        self.last_position = self.get_position(rows[-1]) if rows else None
+        return rows
+
+    def decode_cursor(self, encoded, queryset):
+        try:
+            rank, key = b64decode(encoded.encode('ascii'), validate=True).decode('utf-8').rsplit('|', 1)
+            return float(rank), int(key)
+        except (TypeError, ValueError, UnicodeError):
+            raise NotFound(self.invalid_cursor_message)
+
+    def get_next_link(self):
+        if not self.has_next:
+            return None
+        return replace_query_param(self.base_url, self.cursor_query_param, self.encode_cursor(self.last_position))
+
+    def get_previous_link(self):
+        return None
+
+    def get_schema_operation_parameters(self, view):
+        return [
+            {
+                'name': self.cursor_query_param,
+                'required': False,
+                'in': 'query',
+                'description': 'Cursor of the next page of results.',
+                'schema': {'type': 'string'},
+            },
+            {
+                'name': self.limit_query_param,
+                'required': False,
+                'in': 'query',
+                'description': 'Number of results to return per page.',
+                'schema': {'type': 'integer'},
+            },
+        ]
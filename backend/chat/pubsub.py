@@ -0,0 +1,109 @@
+import asyncio
+import threading
+from collections import defaultdict
+from django.conf import settings
+from django.utils.module_loading import import_string
+
+_broker = None
+_broker_lock = threading.Lock()
+
+
+def user_channel(user_id):
+    return f'user:{user_id}'
+
+
+def get_broker():
+    """Return the process wide broker configured by ``CHAT_PUBSUB_BROKER``."""
+    global _broker
+    if _broker is None:
+        with _broker_lock:
+            if _broker is None:
+                _broker = import_string(getattr(settings, 'CHAT_PUBSUB_BROKER', 'chat.pubsub.InMemoryBroker'))()
+    return _broker
+
+
+class BaseBroker:
+    """
+    Pub/sub transport between the views that commit changes and the open event streams.
+
+    ``publish`` may be called from any thread, ``subscribe`` is called from the event loop
+    that serves the stream.
+    """
+
+    def publish(self, channel, event):
+        raise NotImplementedError('subclasses of BaseBroker must provide a publish() method')
+
+    def subscribe(self, channels):
+        raise NotImplementedError('subclasses of BaseBroker must provide a subscribe() method')
+
+    def unsubscribe(self, subscription):
+        raise NotImplementedError('subclasses of BaseBroker must provide an unsubscribe() method')
+
+    def subscribed(self, channels):
+        """Return the channels that have listeners, so publishers can skip building events."""
+        return list(channels)
+
+
+class Subscription:
+
+    def __init__(self, broker, channels, max_size):
+        self.broker = broker
+        self.channels = list(channels)
+        self.loop = asyncio.get_running_loop()
+        self.queue = asyncio.Queue(max_size)
+
+    def put(self, event):
+        self.loop.call_soon_threadsafe(self._put, event)
+
+    def _put(self, event):
+        if self.queue.full():  # Slow consumer, drop the oldest event instead of blocking publishers
+            self.queue.get_nowait()
+        self.queue.put_nowait(event)
+
+    async def get(self, timeout=None):
+        """Return the next event, or ``None`` if nothing arrived within ``timeout`` seconds."""
+        try:
+            return await asyncio.wait_for(self.queue.get(), timeout)
+        except asyncio.TimeoutError:
+            return None
+
+    def close(self):
+        self.broker.unsubscribe(self)
+
+
+class InMemoryBroker(BaseBroker):
+    """Fanout within a single process, for one node deployments and tests."""
+    max_queue_size = 100
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._subscriptions = defaultdict(set)
+
+    def publish(self, channel, event):
+        with self._lock:
+            subscriptions = list(self._subscriptions.get(channel, ()))
+        for subscription in subscriptions:
+            try:
+                subscription.put(event)
+            except RuntimeError:  # The stream's event loop is already closed
+                subscription.close()
+
+    def subscribe(self, channels):
+        subscription = Subscription(self, channels, self.max_queue_size)
+        with self._lock:
+            for channel in subscription.channels:
+                self._subscriptions[channel].add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            for channel in subscription.channels:
+                subscriptions = self._subscriptions.get(channel)
+                if subscriptions is not None:
+                    subscriptions.discard(subscription)
+                    if not subscriptions:
+                        del self._subscriptions[channel]
+
+    def subscribed(self, channels):
+        with self._lock:
+            return [channel for channel in channels if channel in self._subscriptions]
@@ -0,0 +1,115 @@
+"""
+Thread deletion in two steps.
+
+Deleting a thread through Django's cascade loads and deletes all its messages in one
+transaction, holding the SQLite write lock, and stalling every other writer, for as long as
+that takes. ``soft_delete`` only marks the thread deleted and detaches its participants, which
+hides it from every endpoint at once. ``purge`` then deletes its messages in batches of
+``CHAT_THREAD_PURGE['BATCH_SIZE']``, each in its own short transaction with a pause in between
+for the other writers, and deletes the thread row once they are gone.
+
+The purge of each deleted thread is a ``purge_thread`` background job, run one thread at a time
+and renewing its claim between batches. The ``purge_threads`` command shows the backlog and drains
+it without the job workers; the jobs of the threads it purged find nothing left to do.
+"""
+import logging
+import time
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+from chat import jobs, membership, metrics, sync
+from chat.models import Thread, ArchivedMessage, Message, ReadWatermark, UnreadCounter
+
+logger = logging.getLogger('chat.purge')
+
+
+def get_settings():
+    return {'BATCH_SIZE': 500, 'PAUSE': 0.05, **getattr(settings, 'CHAT_THREAD_PURGE', {})}
+
+
+def soft_delete(thread):
+    """Hide ``thread`` right away and schedule the purge of its messages."""
+    with transaction.atomic():
+        sync.thread_deleted(thread.pk, membership.participant_ids(thread.pk))
+        # The participants key is free for a new thread of the same participants
+        Thread.all_objects.filter(pk=thread.pk).update(
+            deleted_at=timezone.now(), participants_key=None, last_message=None
+        )
+        UnreadCounter.objects.filter(thread=thread).delete()
+        ReadWatermark.objects.filter(thread=thread).delete()
+        thread.participants.clear()  # Drops the membership and message page caches through the signals
+        jobs.enqueue('purge_thread', thread.pk)
+
+
+def pending():
+    """Deleted threads waiting for their purge, oldest deletion first."""
+    return Thread.all_objects.filter(deleted_at__isnull=False).order_by('deleted_at', 'id')
+
+
+def status():
+    """``(threads, messages)`` left to purge."""
+    thread_ids = list(pending().values_list('id', flat=True))
+    if not thread_ids:
+        return 0, 0
+    messages = Message.objects.filter(thread_id__in=thread_ids).count()
+    return len(thread_ids), messages + ArchivedMessage.objects.filter(thread_id__in=thread_ids).count()
+
+
+def purge_batch(thread_id, batch_size):
+    """
+    Delete up to ``batch_size`` messages of the deleted thread ``thread_id``, or the thread itself
+    once it has none left. Return the number of messages deleted.
+    """
+    started = time.perf_counter()
+    with transaction.atomic():
+        # Walks the (thread, created, id) index, the batch is found without sorting the thread
+        ids = list(Message.objects.filter(thread_id=thread_id).order_by('created', 'id').values_list(
+            'id', flat=True
+        )[:batch_size])
+        if ids:
+            deleted = Message.objects.filter(id__in=ids).delete()[0]
+        else:
+            ids = list(ArchivedMessage.objects.filter(thread_id=thread_id).values_list('id', flat=True)[:batch_size])
+            deleted = ArchivedMessage.objects.filter(id__in=ids).delete()[0] if ids else 0
+        if not deleted:
+            Thread.all_objects.filter(pk=thread_id, deleted_at__isnull=False).delete()
+    metrics.purge_batch_duration.observe((), time.perf_counter() - started)
+    return deleted
+
+
+def purge_thread(thread_id, batch_size=None, pause=None):
+    """Purge the deleted thread ``thread_id`` batch by batch, return the number of messages deleted."""
+    options = get_settings()
+    batch_size = batch_size or options['BATCH_SIZE']
+    pause = options['PAUSE'] if pause is None else pause
+    if not pending().filter(pk=thread_id).exists():
+        return 0  # Purged already, by the command or an earlier run of its job
+    purged = 0
+    while True:
+        jobs.heartbeat()
+        deleted = purge_batch(thread_id, batch_size)
+        if not deleted:
+            metrics.purged_threads.inc()
+            logger.info('Purged thread %s, %s messages.', thread_id, purged)
+            return purged
+        purged += deleted
+        metrics.purged_messages.inc(amount=deleted)
+        if pause:
+            time.sleep(pause)  # Lets the other writers take the lock
+
+
+def purge(batch_size=None, pause=None):
+    """Purge every deleted thread, return ``(threads, messages)`` purged."""
+    threads = messages = 0
+    while True:
+        thread_id = pending().values_list('id', flat=True).first()
+        if thread_id is None:
+            return threads, messages
+        messages += purge_thread(thread_id, batch_size, pause)
+        threads += 1
+
+
+@jobs.register('purge_thread', batch_size=1)
+def purge_threads(thread_ids):
+    for thread_id in thread_ids:
+        purge_thread(thread_id)
@@ -0,0 +1,67 @@
+from django.utils import timezone
+from chat import counters, page_cache
+from chat.models import ReadWatermark
+
+
+def ensure_watermarks(thread, user_ids):
+    ReadWatermark.objects.bulk_create(
+        [ReadWatermark(user_id=user_id, thread=thread) for user_id in user_ids],
+        ignore_conflicts=True
+    )
+
+
+def advance_watermark(user_id, thread_id, message_id):
+    """Mark everything in the thread up to ``message_id`` as read by the user."""
+    advanced = ReadWatermark.objects.filter(
+        user_id=user_id, thread_id=thread_id, last_read_message_id__lt=message_id
+    ).update(last_read_message_id=message_id, updated=timezone.now())
+    if not advanced:
+        _, advanced = ReadWatermark.objects.get_or_create(
+            user_id=user_id, thread_id=thread_id, defaults={'last_read_message_id': message_id}
+        )
+    if advanced:
+        counters.recount(user_id, thread_id, message_id)
+        page_cache.invalidate(thread_id)
+    return bool(advanced)
+
+
+def rewind_watermark(user_id, thread_id, message_id):
+    """Mark ``message_id`` and everything after it in the thread as unread by the user."""
+    last_read_message_id = message_id - 1
+    rewound = ReadWatermark.objects.filter(
+        user_id=user_id, thread_id=thread_id, last_read_message_id__gt=last_read_message_id
+    ).update(last_read_message_id=last_read_message_id, updated=timezone.now())
+    if rewound:
+        counters.recount(user_id, thread_id, last_read_message_id)
+        page_cache.invalidate(thread_id)
+    return bool(rewound)
+
+
+def thread_watermarks(thread_ids):
+    """Return ``{thread_id: {user_id: last_read_message_id}}`` for the given threads."""
+    watermarks = {thread_id: {} for thread_id in thread_ids}
+    rows = ReadWatermark.objects.filter(thread_id__in=thread_ids).values_list(
+        'thread_id', 'user_id', 'last_read_message_id'
+    )
+    for thread_id, user_id, last_read_message_id in rows:
+        watermarks[thread_id][user_id] = last_read_message_id
+    return watermarks
+
+
+async def athread_watermarks(thread_ids):
+    """Async ``thread_watermarks``."""
+    watermarks = {thread_id: {} for thread_id in thread_ids}
+    rows = ReadWatermark.objects.filter(thread_id__in=thread_ids).values_list(
+        'thread_id', 'user_id', 'last_read_message_id'
+    )
+    async for thread_id, user_id, last_read_message_id in rows:
+        watermarks[thread_id][user_id] = last_read_message_id
+    return watermarks
+
+
+def is_read(message_id, sender_id, watermarks):
+    """A message is read once any participant but its sender has read up to it."""
+    return any(
+        last_read_message_id >= message_id
+        for user_id, last_read_message_id in watermarks.items() if user_id != sender_id
+    )
@@ -0,0 +1,35 @@
+"""
+JSON renderer for the hot list endpoints.
+
+Produces the same bytes as DRF's ``JSONRenderer`` with its default settings (compact, UTF-8,
+U+2028 and U+2029 escaped), through ``orjson`` when it is installed and the standard library
+encoder otherwise.
+"""
+import json
+from rest_framework.renderers import JSONRenderer
+from rest_framework.utils.encoders import JSONEncoder
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover - optional speedup
+    orjson = None
+
+
+class FastJSONRenderer(JSONRenderer):
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if data is None:
+            return b''
+        if self.get_indent(accepted_media_type, renderer_context or {}) is not None:
+            return super().render(data, accepted_media_type, renderer_context)
+
+        if orjson is not None:
+            # Dates and times go through DRF's encoder, which formats them its own way
+            content = orjson.dumps(data, default=JSONEncoder().default, option=orjson.OPT_PASSTHROUGH_DATETIME)
+        else:
+            content = json.dumps(data, cls=self.encoder_class, ensure_ascii=False, allow_nan=False,
+                                 separators=(',', ':')).encode('utf-8')
+        # Same as JSONRenderer: these are valid JSON but break JavaScript string literals
+        if b'\xe2\x80\xa8' in content or b'\xe2\x80\xa9' in content:
+            content = content.replace(b'\xe2\x80\xa8', b'\\u2028').replace(b'\xe2\x80\xa9', b'\\u2029')
+        return content
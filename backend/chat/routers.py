@@ -0,0 +1,105 @@
+"""
+Read replica routing for the read-heavy chat endpoints.
+
+Views that tolerate replication lag read inside ``reading_from_replica(user_id)``, or between
+``use_replica`` and ``release``; every other read and all writes go to the primary (``default``).
+A user who has just written (posted a message, marked messages read, ...) is "sticky" for
+``CHAT_READ_REPLICAS['STICKINESS']`` seconds and keeps reading from the primary, so their own
+writes are never missing from what they read next. Stickiness lives in a per-process LRU and,
+when ``CACHE_ALIAS`` names a Django cache, in that cache too, for the next request may be served
+by another process.
+"""
+import random
+from contextlib import contextmanager
+from contextvars import ContextVar
+from django.conf import settings
+from django.core.cache import caches
+from django.db import DEFAULT_DB_ALIAS
+from chat.cache import LRUCache
+
+_read_alias = ContextVar('chat_read_alias', default=None)
+_local = None
+
+
+def get_settings():
+    return {'ALIASES': [], 'STICKINESS': 5, 'MAX_ENTRIES': 10000, 'CACHE_ALIAS': None,
+            **getattr(settings, 'CHAT_READ_REPLICAS', {})}
+
+
+def get_local_cache():
+    global _local
+    if _local is None:
+        options = get_settings()
+        _local = LRUCache(options['MAX_ENTRIES'], options['STICKINESS'])
+    return _local
+
+
+def get_shared_cache():
+    alias = get_settings()['CACHE_ALIAS']
+    return caches[alias] if alias else None
+
+
+def cache_key(user_id):
+    return f'chat:sticky:{user_id}'
+
+
+def stick(user_id):
+    """Keep ``user_id`` on the primary for the stickiness window."""
+    get_local_cache().set(user_id, True)
+    shared = get_shared_cache()
+    if shared is not None:
+        shared.set(cache_key(user_id), True, get_settings()['STICKINESS'])
+
+
+def is_sticky(user_id):
+    if get_local_cache().get(user_id):
+        return True
+    shared = get_shared_cache()
+    return shared is not None and bool(shared.get(cache_key(user_id)))
+
+
+def choose_read_alias(user_id):
+    """A replica alias for the reads of ``user_id``, None when they have to go to the primary."""
+    aliases = get_settings()['ALIASES']
+    if not aliases or user_id is None or is_sticky(user_id):
+        return None
+    return random.choice(aliases)
+
+
+def use_replica(user_id):
+    """Route the reads that follow to a replica, returns the token to pass to ``release``."""
+    return _read_alias.set(choose_read_alias(user_id))
+
+
+def current_read_alias():
+    """The replica the reads go to right now, None for the primary."""
+    return _read_alias.get()
+
+
+def release(token):
+    _read_alias.reset(token)
+
+
+@contextmanager
+def reading_from_replica(user_id):
+    token = use_replica(user_id)
+    try:
+        yield current_read_alias()
+    finally:
+        release(token)
+
+
+class ReadReplicaRouter:
+    """Send reads to the replica picked by ``reading_from_replica``, everything else to the primary."""
+
+    def db_for_read(self, model, **hints):
+        return current_read_alias()
+
+    def db_for_write(self, model, **hints):
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        pool = {DEFAULT_DB_ALIAS, *get_settings()['ALIASES']}
+        if obj1._state.db in pool and obj2._state.db in pool:
+            return True
+        return None
@@ -0,0 +1,84 @@
+"""
+OpenAPI schema built ahead of time.
+
+Generating the schema introspects every view and serializer, which ``SpectacularAPIView`` does on
+every request. The ``build_schema`` command writes it once, as YAML to ``CHAT_SCHEMA['FILE']`` and
+as JSON next to it, and ``schema_view`` serves those files, read once per process. Without the files
+the schema is generated per request as before, when ``drf_spectacular`` is installed.
+
+Only ``build`` needs ``drf_spectacular``, the API workers of ``config.settings_api`` serve the files
+without loading it.
+"""
+from pathlib import Path
+from django.apps import apps
+from django.conf import settings
+from django.http import Http404, HttpResponse
+
+YAML_CONTENT_TYPE = 'application/vnd.oai.openapi'
+JSON_CONTENT_TYPE = 'application/vnd.oai.openapi+json'
+
+_files = {}
+
+
+def get_settings():
+    return {'FILE': None, **getattr(settings, 'CHAT_SCHEMA', {})}
+
+
+def get_paths():
+    """``(YAML path, JSON path)`` of the built schema, or None when it is generated per request."""
+    path = get_settings()['FILE']
+    if path is None:
+        return None
+    path = Path(path)
+    return path, path.with_suffix('.json')
+
+
+def build(validate=False):
+    """Generate the schema and write its files, return their paths."""
+    from drf_spectacular.generators import SchemaGenerator
+    from drf_spectacular.renderers import OpenApiJsonRenderer, OpenApiYamlRenderer
+    from drf_spectacular.settings import spectacular_settings
+    from drf_spectacular.validation import validate_schema
+
+    paths = get_paths()
+    if paths is None:
+        raise ValueError('CHAT_SCHEMA["FILE"] is not set.')
+    generator = spectacular_settings.DEFAULT_GENERATOR_CLASS()
+    schema = generator.get_schema(request=None, public=True)
+    if validate:
+        validate_schema(schema)
+    for path, renderer in zip(paths, (OpenApiYamlRenderer, OpenApiJsonRenderer)):
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_bytes(renderer().render(schema, renderer_context={}))
+    _files.clear()
+    return paths
+
+
+def read(path):
+    """Content of a schema file, None when it does not exist. Kept in memory until it changes."""
+    try:
+        modified = path.stat().st_mtime_ns
+    except FileNotFoundError:
+        return None
+    cached = _files.get(path)
+    if cached is None or cached[0] != modified:
+        cached = _files[path] = (modified, path.read_bytes())
+    return cached[1]
+
+
+def wants_json(request):
+    return request.GET.get('format') in ('json', 'openapi-json') or 'json' in request.headers.get('Accept', '')
+
+
+def schema_view(request, *args, **kwargs):
+    """The built schema, as JSON or YAML like ``SpectacularAPIView`` negotiates it."""
+    paths = get_paths()
+    if paths is not None:
+        as_json = wants_json(request)
+        content = read(paths[1] if as_json else paths[0])
+        if content is not None:
+            return HttpResponse(content, content_type=JSON_CONTENT_TYPE if as_json else YAML_CONTENT_TYPE)
+    if not apps.is_installed('drf_spectacular'):
+        raise Http404('The schema has not been built, run the build_schema command.')
+    from drf_spectacular.views import SpectacularAPIView
+    return SpectacularAPIView.as_view()(request, *args, **kwargs)
@@ -0,0 +1,133 @@
+"""
+Full-text message search on an SQLite FTS5 index.
+
+``chat_message_fts`` is an external content FTS5 table over ``chat_message``: it stores only
+the index, the text is read back from ``chat_message`` for snippets. Triggers keep it in sync
+on insert, update and delete, so bulk inserts and queryset updates are covered too.
+
+Besides the text the thread id is indexed, and every search is restricted to the threads of the
+user with a ``thread_id`` column filter. FTS5 then intersects the posting lists of the terms with
+those of the user's threads, so the cost grows with the user's matching messages rather than
+with the matches of the whole table. Results are ordered by bm25 relevance, the thread id column
+weighs nothing in it.
+"""
+import html
+import re
+from django.db import connection as default_connection
+from chat.models import Message
+
+TABLE = 'chat_message_fts'
+MAX_TERMS = 16
+SNIPPET_TOKENS = 12
+# Control characters mark the matches in snippets, they become <mark> tags once the text is escaped
+MATCH_START, MATCH_END = '\x02', '\x03'
+
+TRIGGERS = {
+    f'{TABLE}_insert': f"""
+        CREATE TRIGGER IF NOT EXISTS {TABLE}_insert AFTER INSERT ON chat_message BEGIN
+            INSERT INTO {TABLE}(rowid, text, thread_id) VALUES (new.id, new.text, new.thread_id);
+        END
+    """,
+    f'{TABLE}_delete': f"""
+        CREATE TRIGGER IF NOT EXISTS {TABLE}_delete AFTER DELETE ON chat_message BEGIN
+            INSERT INTO {TABLE}({TABLE}, rowid, text, thread_id) VALUES ('delete', old.id, old.text, old.thread_id);
+        END
+    """,
+    f'{TABLE}_update': f"""
+        CREATE TRIGGER IF NOT EXISTS {TABLE}_update AFTER UPDATE OF text, thread_id ON chat_message BEGIN
+            INSERT INTO {TABLE}({TABLE}, rowid, text, thread_id) VALUES ('delete', old.id, old.text, old.thread_id);
+            INSERT INTO {TABLE}(rowid, text, thread_id) VALUES (new.id, new.text, new.thread_id);
+        END
+    """,
+}
+
+
+def is_supported(connection=default_connection):
+    return connection.vendor == 'sqlite'
+
+
+def restore_triggers(using, **kwargs):
+    """
+    ``post_migrate`` receiver. SQLite migrations that alter ``chat_message`` rebuild the table,
+    which drops its triggers; recreate them and rebuild the index when that happened.
+    """
+    from django.db import connections
+
+    connection = connections[using]
+    if not is_supported(connection):
+        return
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT name FROM sqlite_master WHERE type = 'table' AND name = %s", [TABLE])
+        if cursor.fetchone() is None:
+            return
+        cursor.execute(
+            "SELECT name FROM sqlite_master WHERE type = 'trigger' AND tbl_name = 'chat_message' AND name LIKE %s",
+            [f'{TABLE}_%']
+        )
+        if {name for name, in cursor.fetchall()} == set(TRIGGERS):
+            return
+        for sql in TRIGGERS.values():
+            cursor.execute(sql)
+        cursor.execute(f"INSERT INTO {TABLE}({TABLE}) VALUES ('rebuild')")
+
+
+def quote(term):
+    return '"' + term.replace('"', '""') + '"'
+
+
+def build_query(terms, thread_ids=None):
+    """
+    FTS5 query matching every word of ``terms`` in the message text, a word ending with ``*``
+    matches as a prefix. None when ``terms`` has no word.
+    """
+    words = re.findall(r'(\w+)(\*?)', terms)[:MAX_TERMS]
+    if not words:
+        return None
+    query = '{text} : (' + ' '.join(quote(word) + prefix for word, prefix in words) + ')'
+    if thread_ids is not None:
+        query += ' AND {thread_id} : (' + ' OR '.join(quote(str(thread_id)) for thread_id in thread_ids) + ')'
+    return query
+
+
+def highlight(snippet):
+    return html.escape(snippet).replace(MATCH_START, '<mark>').replace(MATCH_END, '</mark>')
+
+
+class MessageSearch:
+    """Messages of ``thread_ids`` matching ``terms``, most relevant first."""
+
+    def __init__(self, terms, thread_ids):
+        self.thread_ids = list(thread_ids)
+        self.query = build_query(terms, self.thread_ids) if self.thread_ids else None
+
+    def fetch(self, limit, after=None):
+        """
+        Up to ``limit`` messages with ``rank`` and ``snippet`` attributes, following the
+        ``(rank, id)`` position ``after``.
+        """
+        if self.query is None:
+            return []
+        params = [MATCH_START, MATCH_END, SNIPPET_TOKENS, self.query]
+        where = ''
+        if after is not None:
+            rank, key = after
+            where = ' AND (f.rank > %s OR (f.rank = %s AND f.rowid < %s))'
+            params += [rank, rank, key]
+        messages = list(Message.objects.raw(
+            f"SELECT m.id, m.sender_id, m.thread_id, m.text, m.created, m.updated, f.rank AS rank, "
+            f"snippet({TABLE}, 0, %s, %s, '…', %s) AS snippet "
+            f"FROM {TABLE} f JOIN chat_message m ON m.id = f.rowid "
+            f"WHERE {TABLE} MATCH %s{where} ORDER BY f.rank, f.rowid DESC LIMIT %s",
+            params + [limit]
+        ))
+        for message in messages:
+            message.snippet = highlight(message.snippet)
+        return messages
+
+
+def matching_ids(terms):
+    """Subquery SQL and params of the ids of all messages matching ``terms``, for the admin."""
+    query = build_query(terms)
+    if query is None:
+        return None
+    return f'SELECT rowid FROM {TABLE} WHERE {TABLE} MATCH %s', [query]
@@ -1,5 +1,10 @@
-from rest_framework import serializers
-from chat.models import Thread, Message
+from django.conf import settings
+from django.utils import timezone
+from rest_framework import ISO_8601, serializers
+from rest_framework.settings import api_settings
+from chat import reads
+from chat.archive import unpack
+from chat.models import Thread, Message, SyncEvent
 
 
 class ThreadSerializer(serializers.ModelSerializer):
@@ -13,14 +18,23 @@ class ThreadSerializer(serializers.ModelSerializer):
 
     class Meta:
         model = Thread
-        fields = '__all__'
+        exclude = ['participants_key', 'last_message', 'changed', 'deleted_at']
 
 
 class MessageSerializer(serializers.ModelSerializer):
+    is_read = serializers.SerializerMethodField()
+
     class Meta:
         model = Message
         fields = ['id', 'sender', 'text', 'thread', 'created', 'is_read']
-        read_only_fields = ['id', 'sender', 'created', 'is_read']
+        read_only_fields = ['id', 'sender', 'created']
+
+    def get_is_read(self, obj) -> bool:
+        # Watermarks are loaded once per thread and shared by every message of a page
+        watermarks = self.context.setdefault('watermarks', {})
+        if obj.thread_id not in watermarks:
+            watermarks.update(reads.thread_watermarks([obj.thread_id]))
+        return reads.is_read(obj.id, obj.sender_id, watermarks[obj.thread_id])
 
     def create(self, validated_data):
         request = self.context.get('request')
@@ -28,7 +42,97 @@ class MessageSerializer(serializers.ModelSerializer):
         return super().create(validated_data)
 
 
-class MessageReadSerializer(serializers.ModelSerializer):
+# Columns of the rows ``serialize_message_rows`` takes, ``values_list(*MESSAGE_ROW_FIELDS, named=True)``
+MESSAGE_ROW_FIELDS = ('id', 'sender_id', 'text', 'thread_id', 'created')
+
+
+def datetime_formatter():
+    """``DateTimeField.to_representation``, inlined for the default ISO 8601 output with time zones on."""
+    field = serializers.DateTimeField()
+    if api_settings.DATETIME_FORMAT != ISO_8601 or not settings.USE_TZ:
+        return field.to_representation
+    current_timezone = timezone.get_current_timezone()
+
+    def format_datetime(value):
+        value = value.astimezone(current_timezone).isoformat()
+        return value[:-6] + 'Z' if value.endswith('+00:00') else value
+    return format_datetime
+
+
+def serialize_message_rows(rows, watermarks):
+    """
+    ``MessageSerializer`` output for rows of ``MESSAGE_ROW_FIELDS``, without building model
+    instances or going through the serializer fields one value at a time.
+    """
+    format_datetime = datetime_formatter()
+    return [
+        {
+            'id': row.id,
+            'sender': row.sender_id,
+            'text': row.text if isinstance(row.text, str) else unpack(row.text),  # Compressed when archived
+            'thread': row.thread_id,
+            'created': format_datetime(row.created),
+            'is_read': reads.is_read(row.id, row.sender_id, watermarks[row.thread_id]),
+        }
+        for row in rows
+    ]
+
+
+class MessageSearchResultSerializer(MessageSerializer):
+    snippet = serializers.CharField(read_only=True, help_text='Excerpt of the text, matches wrapped in <mark> tags, '
+                                                              'HTML escaped.')
+
+    class Meta(MessageSerializer.Meta):
+        fields = MessageSerializer.Meta.fields + ['snippet']
+
+
+class MessageBatchItemSerializer(serializers.Serializer):
+    thread = serializers.IntegerField(min_value=1)
+    text = serializers.CharField()
+
+
+class MessageBatchSerializer(serializers.Serializer):
+    messages = serializers.ListField(
+        child=serializers.DictField(), allow_empty=False,
+        max_length=getattr(settings, 'CHAT_MESSAGE_BATCH_MAX_SIZE', 500),
+        help_text='Messages to send, each one with a "thread" id and a "text".'
+    )
+
+
+class MessageBatchResultSerializer(serializers.Serializer):
+    status = serializers.IntegerField(help_text='HTTP status of the single message.')
+    message = MessageSerializer(required=False)
+    errors = serializers.DictField(required=False)
+
+
+class InboxThreadSerializer(serializers.ModelSerializer):
+    last_message = MessageSerializer(read_only=True)
+    unread_count = serializers.IntegerField(read_only=True)
+
     class Meta:
-        model = Message
-        fields = ['is_read']
+        model = Thread
+        fields = ['id', 'participants', 'created', 'updated', 'last_message', 'unread_count']
+
+
+class MessageReadSerializer(serializers.Serializer):
+    is_read = serializers.BooleanField()
+
+
+class ThreadReadSerializer(serializers.Serializer):
+    message_id = serializers.IntegerField(required=False, write_only=True, min_value=1,
+                                          help_text='Last read message. Defaults to the latest thread message.')
+    last_read_message_id = serializers.IntegerField(read_only=True)
+    unread_count = serializers.IntegerField(read_only=True)
+
+
+class SyncEventSerializer(serializers.Serializer):
+    id = serializers.IntegerField()
+    type = serializers.ChoiceField(choices=SyncEvent.KIND_CHOICES)
+    data = serializers.JSONField(help_text='A message for message events, {thread, user, last_read_message_id} '
+                                           'for read events and {thread} for thread_deleted events.')
+
+
+class SyncSerializer(serializers.Serializer):
+    events = SyncEventSerializer(many=True)
+    cursor = serializers.CharField(help_text='Cursor to send with the next request.')
+    has_more = serializers.BooleanField(help_text='More events are waiting, ask again right away.')
@@ -0,0 +1,76 @@
+from django.contrib.auth.models import User
+from django.db import transaction
+from django.db.models.signals import m2m_changed, post_delete, post_save, pre_delete
+from django.dispatch import receiver
+from rest_framework.authtoken.models import Token
+from chat import membership, page_cache, sync
+from chat.authentication import token_cache
+from chat.models import Thread, Message
+from chat.views import messages_changed
+
+
+@receiver(m2m_changed, sender=Thread.participants.through)
+def participants_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    if not action.startswith('post_'):
+        return
+    if not reverse:
+        invalidate_membership(instance.pk)
+        page_cache.invalidate(instance.pk)  # A new thread may reuse the id of a deleted one
+    elif pk_set:
+        for thread_id in pk_set:
+            invalidate_membership(thread_id)
+        page_cache.invalidate(*pk_set)
+    else:  # user.threads.clear(), the cleared threads are unknown
+        membership.get_local_cache().clear()
+
+
+@receiver(pre_delete, sender=Thread)
+def thread_deleting(sender, instance, **kwargs):
+    sync.thread_deleted(instance.pk, membership.participant_ids(instance.pk))
+
+
+@receiver(post_delete, sender=Thread)
+def thread_deleted(sender, instance, **kwargs):
+    invalidate_membership(instance.pk)
+    page_cache.invalidate(instance.pk)
+
+
+@receiver(post_save, sender=Message)
+def message_saved(sender, instance, created, **kwargs):
+    # New messages go through messages_posted. Deleted ones are handled where they are deleted,
+    # a post_delete receiver would run once per message when a thread is deleted
+    if not created:
+        messages_changed([instance.thread_id])
+
+
+@receiver(pre_delete, sender=User)
+def user_deleted(sender, instance, **kwargs):
+    # Their messages are deleted with them
+    thread_ids = Thread.participants.through.objects.filter(user=instance).values_list('thread_id', flat=True)
+    page_cache.invalidate(*thread_ids)
+
+
+def invalidate_membership(thread_id):
+    # Drop the entry right away and once more on commit, in case a concurrent request cached the old state
+    membership.invalidate(thread_id)
+    transaction.on_commit(lambda: membership.invalidate(thread_id))
+
+
+@receiver(post_save, sender=Token)
+@receiver(post_delete, sender=Token)
+def token_changed(sender, instance, **kwargs):
+    invalidate_token(instance.key)
+
+
+@receiver(post_save, sender=User)
+def user_saved(sender, instance, created, update_fields=None, **kwargs):
+    if created or update_fields == frozenset(['last_login']):
+        return
+    for key in Token.objects.filter(user=instance).values_list('key', flat=True):
+        invalidate_token(key)
+
+
+def invalidate_token(key):
+    # Once more on commit, in case a concurrent request cached the old state meanwhile
+    token_cache.invalidate(key)
+    transaction.on_commit(lambda: token_cache.invalidate(key))
@@ -0,0 +1,55 @@
+import json
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.http import JsonResponse, StreamingHttpResponse
+from rest_framework import exceptions
+from chat import counters
+from chat.authentication import aauthenticate_request
+from chat.pubsub import get_broker, user_channel
+
+
+async def authenticate(request):
+    # Browsers' EventSource can not send headers, so the token may come in the query string as well
+    if 'HTTP_AUTHORIZATION' not in request.META and 'token' in request.GET:
+        request.META['HTTP_AUTHORIZATION'] = f'Token {request.GET["token"]}'
+    return await aauthenticate_request(request)
+
+
+def format_event(event_type, data):
+    return f'event: {event_type}\ndata: {json.dumps(data, separators=(",", ":"))}\n\n'
+
+
+async def event_stream(request):
+    """
+    Server-Sent Events stream of the user's new messages, read receipts and unread counts.
+
+    Needs the ASGI entry point (``config.asgi``): every open stream is an idle coroutine
+    waiting on its subscription instead of a worker thread.
+    """
+    try:
+        user = await authenticate(request)
+    except exceptions.APIException as exc:
+        return JsonResponse({'detail': str(exc.detail)}, status=exc.status_code)
+    if user is None:
+        return JsonResponse({'detail': exceptions.NotAuthenticated.default_detail}, status=401)
+
+    keepalive = getattr(settings, 'CHAT_STREAM_KEEPALIVE', 15)
+
+    async def events():
+        subscription = get_broker().subscribe([user_channel(user.id)])
+        try:
+            unread_count = await sync_to_async(counters.unread_total)(user)
+            yield format_event('unread_count', {'unread_messages_count': unread_count})
+            while True:
+                event = await subscription.get(timeout=keepalive)
+                if event is None:
+                    yield ': keep-alive\n\n'
+                else:
+                    yield format_event(event['type'], event['data'])
+        finally:
+            subscription.close()
+
+    response = StreamingHttpResponse(events(), content_type='text/event-stream')
+    response['Cache-Control'] = 'no-cache'
+    response['X-Accel-Buffering'] = 'no'
+    return response
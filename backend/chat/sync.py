@@ -0,0 +1,124 @@
+"""
+Per-user change log behind the sync endpoint.
+
+Every new message, read status change and thread deletion is appended to the ``SyncEvent``
+log of each participant, in the transaction that makes the change. A client that comes back
+online asks for the events after its cursor, the id of the last event it has seen, and gets
+everything it missed in a few bounded batches, whatever the number of its threads.
+
+Event ids grow in commit order because SQLite has a single writer, so an event is never
+committed behind a cursor that was already handed out. Events older than
+``CHAT_SYNC['RETENTION_DAYS']`` are pruned by the ``prune_sync_events`` command; a cursor dated
+before that horizon is refused and the client has to load its threads again. A cursor is dated
+when it is issued once the client has caught up, and like its last event while more remain, so a
+client that stops halfway never silently misses events pruned in the meantime.
+"""
+from base64 import b64decode, b64encode
+from datetime import timedelta
+from django.conf import settings
+from django.utils import timezone
+from chat import reads
+from chat.membership import participant_ids, participants_of
+from chat.models import Message, SyncEvent
+from chat.serializers import MESSAGE_ROW_FIELDS, serialize_message_rows
+
+
+class CursorExpired(Exception):
+    pass
+
+
+def get_settings():
+    return {'RETENTION_DAYS': 30, 'MAX_EVENTS': 500, **getattr(settings, 'CHAT_SYNC', {})}
+
+
+def messages_created(messages):
+    participants = participants_of(message.thread_id for message in messages)
+    SyncEvent.objects.bulk_create([
+        SyncEvent(user_id=user_id, kind=SyncEvent.MESSAGE, thread_id=message.thread_id, message_id=message.id)
+        for message in messages for user_id in participants[message.thread_id]
+    ])
+
+
+def thread_read(thread_id, user_id, last_read_message_id):
+    SyncEvent.objects.bulk_create([
+        SyncEvent(user_id=participant_id, kind=SyncEvent.READ, thread_id=thread_id,
+                  message_id=last_read_message_id, reader_id=user_id)
+        for participant_id in participant_ids(thread_id)
+    ])
+
+
+def thread_deleted(thread_id, user_ids):
+    SyncEvent.objects.bulk_create([
+        SyncEvent(user_id=user_id, kind=SyncEvent.THREAD_DELETED, thread_id=thread_id) for user_id in user_ids
+    ])
+
+
+def encode_cursor(event_id, issued):
+    return b64encode(f'{event_id}|{int(issued.timestamp())}'.encode('ascii')).decode('ascii')
+
+
+def decode_cursor(cursor):
+    """Return the event id of ``cursor``, raise ValueError when it is invalid and CursorExpired when too old."""
+    try:
+        event_id, issued = b64decode(cursor.encode('ascii'), validate=True).decode('ascii').split('|')
+        event_id, issued = int(event_id), int(issued)
+    except (TypeError, ValueError, UnicodeError):
+        raise ValueError('Invalid cursor')
+    if event_id < 0:
+        raise ValueError('Invalid cursor')
+    if issued < (timezone.now() - timedelta(days=get_settings()['RETENTION_DAYS'])).timestamp():
+        raise CursorExpired()
+    return event_id
+
+
+def current_cursor(user):
+    """Cursor of the latest event of ``user``, for a client that has just loaded everything."""
+    last_id = SyncEvent.objects.filter(user=user).order_by('-id').values_list('id', flat=True).first()
+    return encode_cursor(last_id or 0, timezone.now())
+
+
+def fetch(user, after, limit):
+    """Up to ``limit`` events of ``user`` after the event id ``after``: ``(events, cursor, has_more)``."""
+    rows = list(SyncEvent.objects.filter(user=user, id__gt=after).order_by('id').values_list(
+        'id', 'kind', 'thread_id', 'message_id', 'reader_id', 'created'
+    )[:limit + 1])
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+
+    message_ids = [message_id for _, kind, _, message_id, _, _ in rows if kind == SyncEvent.MESSAGE]
+    messages = {}
+    if message_ids:
+        message_rows = list(Message.objects.filter(id__in=message_ids).values_list(*MESSAGE_ROW_FIELDS, named=True))
+        watermarks = reads.thread_watermarks({row.thread_id for row in message_rows})
+        messages = {data['id']: data for data in serialize_message_rows(message_rows, watermarks)}
+
+    events = []
+    for event_id, kind, thread_id, message_id, reader_id, _ in rows:
+        if kind == SyncEvent.MESSAGE:
+            if message_id not in messages:  # Deleted since
+                continue
+            data = messages[message_id]
+        elif kind == SyncEvent.READ:
+            data = {'thread': thread_id, 'user': reader_id, 'last_read_message_id': message_id}
+        else:
+            data = {'thread': thread_id}
+        events.append({'id': event_id, 'type': kind, 'data': data})
+
+    if has_more:
+        # Dated like the last event returned: the events after it may be pruned from then on
+        cursor = encode_cursor(rows[-1][0], rows[-1][5])
+    else:
+        cursor = encode_cursor(rows[-1][0] if rows else after, timezone.now())
+    return events, cursor, has_more
+
+
+def prune(before, batch_size=1000):
+    """Delete the events created before ``before``, oldest first, return how many were deleted."""
+    deleted = 0
+    while True:
+        # Ids grow with the creation time, so the oldest events are the first rows of the table
+        ids = SyncEvent.objects.filter(created__lt=before).order_by('id').values_list('id', flat=True)[:batch_size]
+        ids = list(ids)
+        if not ids:
+            return deleted
+        deleted += SyncEvent.objects.filter(id__in=ids).delete()[0]
@@ -1,8 +1,44 @@
+import os
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+from datetime import datetime, timedelta, timezone as dt_timezone
+from decimal import Decimal
+from io import StringIO
+from pathlib import Path
+from unittest import mock
+from django.core.cache import caches
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.db import IntegrityError, connection, transaction
+from django.db.models import F
+from django.utils.connection import ConnectionDoesNotExist
+from asgiref.sync import async_to_sync, sync_to_async
+from django.test import override_settings
+from django.test.utils import CaptureQueriesContext
 from django.urls import reverse
+from django.utils import timezone
+from django.utils.http import http_date
 from rest_framework import status
+from rest_framework.renderers import JSONRenderer
 from rest_framework.test import APITestCase, APIClient
 from django.contrib.auth.models import User
-from chat.models import Thread, Message
+from rest_framework.authtoken.models import Token
+from chat import (
+    admission, archive, counters, jobs, membership, metrics, page_cache, purge, reads, renderers, routers, schema,
+    search, sync
+)
+from chat import urls as chat_urls
+from chat.admin import EstimatedCountPaginator
+from chat.authentication import token_cache
+from chat.benchmarks import QUERY_BUDGETS, UNBUDGETED, build_scenarios, run_scenario
+from chat.cache import LRUCache
+from chat.models import Thread, ArchivedMessage, Job, Message, ReadWatermark, SyncEvent, UnreadCounter
+from chat.renderers import FastJSONRenderer
+from chat.serializers import MessageSerializer
+from chat.pubsub import InMemoryBroker, get_broker, user_channel
 
 
 class ChatAPITestCase(APITestCase):
@@ -94,3 +130,1547 @@ class ChatAPITestCase(APITestCase):
         self.client.credentials(HTTP_AUTHORIZATION=f'Token {self.token}')
         response = self.client.delete(self.thread_delete_url)
         self.assertEqual(response.status_code, status.HTTP_204_NO_CONTENT)
+
+
+class MessagePaginationTestCase(APITestCase):
+
+    def setUp(self):
+        self.user1 = User.objects.create_user(username='user1')
+        self.user2 = User.objects.create_user(username='user2')
+        self.thread = Thread.objects.create()
+        self.thread.participants.set([self.user1, self.user2])
+        self.messages = [
+            Message.objects.create(sender=self.user1, text=f'Message {i}', thread=self.thread) for i in range(25)
+        ]
+        self.message_list_url = reverse('messages_list', kwargs={'thread_id': self.thread.id})
+        self.client.force_authenticate(self.user1)
+
+    def ids(self, response):
+        return [item['id'] for item in response.data['results']]
+
+    def test_first_page_is_latest(self):
+        response = self.client.get(self.message_list_url, {'limit': 10})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(self.ids(response), [m.id for m in self.messages[15:]])
+        self.assertIsNone(response.data['next'])
+        self.assertIsNotNone(response.data['previous'])
+
+    def test_scroll_back_and_forward(self):
+        response = self.client.get(self.message_list_url, {'limit': 10})
+        seen = self.ids(response)
+        while response.data['previous']:
+            response = self.client.get(response.data['previous'])
+            seen = self.ids(response) + seen
+        self.assertEqual(seen, [m.id for m in self.messages])
+
+        seen = self.ids(response)
+        while response.data['next']:
+            response = self.client.get(response.data['next'])
+            seen += self.ids(response)
+        self.assertEqual(seen, [m.id for m in self.messages])
+
+    def test_same_created_timestamp(self):
+        Message.objects.filter(thread=self.thread).update(created=self.messages[0].created)
+        response = self.client.get(self.message_list_url, {'limit': 7})
+        seen = self.ids(response)
+        while response.data['previous']:
+            response = self.client.get(response.data['previous'])
+            seen = self.ids(response) + seen
+        self.assertEqual(seen, [m.id for m in self.messages])
+
+    def test_invalid_cursor(self):
+        response = self.client.get(self.message_list_url, {'before': 'not-a-cursor'})
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+
+class UnreadCounterTestCase(APITestCase):
+
+    def setUp(self):
+        self.user1 = User.objects.create_user(username='user1')
+        self.user2 = User.objects.create_user(username='user2')
+        self.user3 = User.objects.create_user(username='user3')
+        self.client.force_authenticate(self.user1)
+        response = self.client.post(reverse('thread_create'),
+                                    {'participants': [self.user1.pk, self.user2.pk]},
+                                    format='json')
+        self.thread = Thread.objects.get(pk=response.data['id'])
+
+    def post_message(self, user, text='Hello'):
+        self.client.force_authenticate(user)
+        response = self.client.post(reverse('message_create'), {'text': text, 'thread': self.thread.id}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        return response.data['id']
+
+    def unread_count(self, user):
+        self.client.force_authenticate(user)
+        response = self.client.get(reverse('unread_messages_count'))
+        return response.data['unread_messages_count']
+
+    def test_counters_follow_messages_and_reads(self):
+        message_id = self.post_message(self.user1)
+        self.post_message(self.user1)
+        self.post_message(self.user2)
+        self.assertEqual(self.unread_count(self.user2), 2)
+        self.assertEqual(self.unread_count(self.user1), 1)
+
+        url = reverse('message_read_change', kwargs={'pk': message_id})
+        self.client.force_authenticate(self.user2)
+        self.client.patch(url, {'is_read': True}, format='json')
+        self.client.patch(url, {'is_read': True}, format='json')
+        self.assertEqual(self.unread_count(self.user2), 1)
+
+        self.client.patch(url, {'is_read': False}, format='json')
+        self.assertEqual(self.unread_count(self.user2), 2)
+        self.assertEqual(counters.diff_counters(), {})
+
+    def test_deleted_messages_are_no_longer_unread(self):
+        message_ids = [self.post_message(self.user1) for _ in range(3)]
+        self.assertEqual(self.unread_count(self.user2), 3)
+        self.client.force_login(User.objects.create_superuser(username='admin', password='password'))
+        self.client.post(reverse('admin:chat_message_changelist'),
+                         {'action': 'delete_selected', '_selected_action': message_ids[1:], 'post': 'yes'})
+        self.assertEqual(self.unread_count(self.user2), 1)
+        self.client.post(reverse('admin:chat_message_delete', args=[message_ids[0]]), {'post': 'yes'})
+        self.assertEqual(self.unread_count(self.user2), 0)
+        self.assertEqual(counters.diff_counters(), {})
+
+    def test_unread_count_is_single_query(self):
+        self.post_message(self.user1)
+        self.client.force_authenticate(self.user2)
+        with self.assertNumQueries(1):
+            response = self.client.get(reverse('unread_messages_count'))
+        self.assertEqual(response.data['unread_messages_count'], 1)
+
+    def test_rebuild_command(self):
+        thread = Thread.objects.create()
+        thread.participants.set([self.user2, self.user3])
+        Message.objects.create(sender=self.user2, text='Hello', thread=thread)
+        UnreadCounter.objects.filter(thread=self.thread).update(count=5)
+
+        with self.assertRaises(CommandError):
+            call_command('rebuild_unread_counters', '--verify', stdout=StringIO())
+        call_command('rebuild_unread_counters', stdout=StringIO())
+        call_command('rebuild_unread_counters', '--verify', stdout=StringIO())
+        self.assertEqual(counters.unread_total(self.user3), 1)
+        self.assertEqual(counters.unread_total(self.user2), 0)
+
+
+class ReadWatermarkTestCase(APITestCase):
+
+    def setUp(self):
+        self.user1 = User.objects.create_user(username='user1')
+        self.user2 = User.objects.create_user(username='user2')
+        self.client.force_authenticate(self.user1)
+        response = self.client.post(reverse('thread_create'),
+                                    {'participants': [self.user1.pk, self.user2.pk]},
+                                    format='json')
+        self.thread = Thread.objects.get(pk=response.data['id'])
+        self.message_ids = [
+            self.client.post(reverse('message_create'), {'text': f'Message {i}', 'thread': self.thread.id},
+                             format='json').data['id']
+            for i in range(5)
+        ]
+        self.thread_read_url = reverse('thread_read', kwargs={'thread_id': self.thread.id})
+
+    def test_mark_thread_read_up_to_message(self):
+        self.client.force_authenticate(self.user2)
+        response = self.client.post(self.thread_read_url, {'message_id': self.message_ids[2]}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data, {'last_read_message_id': self.message_ids[2], 'unread_count': 2})
+
+        response = self.client.get(reverse('messages_list', kwargs={'thread_id': self.thread.id}))
+        self.assertEqual([m['is_read'] for m in response.data['results']], [True, True, True, False, False])
+
+    def test_mark_whole_thread_read(self):
+        self.client.force_authenticate(self.user2)
+        response = self.client.post(self.thread_read_url, format='json')
+        self.assertEqual(response.data, {'last_read_message_id': self.message_ids[-1], 'unread_count': 0})
+        self.assertEqual(counters.unread_total(self.user2), 0)
+
+    def test_watermark_never_moves_back(self):
+        self.client.force_authenticate(self.user2)
+        self.client.post(self.thread_read_url, format='json')
+        response = self.client.post(self.thread_read_url, {'message_id': self.message_ids[0]}, format='json')
+        self.assertEqual(response.data['last_read_message_id'], self.message_ids[-1])
+
+    def test_foreign_message(self):
+        other = Thread.objects.create()
+        message = Message.objects.create(sender=self.user2, text='Hello', thread=other)
+        self.client.force_authenticate(self.user2)
+        response = self.client.post(self.thread_read_url, {'message_id': message.id}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_non_participant(self):
+        self.client.force_authenticate(User.objects.create_user(username='user3'))
+        response = self.client.post(self.thread_read_url, format='json')
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+
+
+class ThreadCreateTestCase(APITestCase):
+
+    def setUp(self):
+        self.user1 = User.objects.create_user(username='user1')
+        self.user2 = User.objects.create_user(username='user2')
+        self.client.force_authenticate(self.user1)
+        self.thread_create_url = reverse('thread_create')
+
+    def test_existing_thread_is_returned(self):
+        response = self.client.post(self.thread_create_url, {'participants': [self.user1.pk, self.user2.pk]},
+                                    format='json')
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(set(response.data), {'id', 'created', 'updated', 'participants'})
+
+        response_again = self.client.post(self.thread_create_url, {'participants': [self.user2.pk, self.user1.pk]},
+                                          format='json')
+        self.assertEqual(response_again.status_code, status.HTTP_200_OK)
+        self.assertEqual(response_again.data['id'], response.data['id'])
+        self.assertEqual(Thread.objects.count(), 1)
+
+    def test_participants_key_is_unique(self):
+        key = Thread.make_participants_key([self.user2.pk, self.user1.pk])
+        self.assertEqual(key, f'{self.user1.pk}:{self.user2.pk}')
+        Thread.objects.create(participants_key=key)
+        with self.assertRaises(IntegrityError):
+            Thread.objects.create(participants_key=key)
+
+    def test_lost_race_returns_existing_thread(self):
+        key = Thread.make_participants_key([self.user1.pk, self.user2.pk])
+        original_filter = Thread.objects.filter
+
+        def stale_filter(*args, **kwargs):
+            # Simulate a concurrent request that created the thread right after the lookup
+            if kwargs == {'participants_key': key}:
+                Thread.objects.get_or_create(participants_key=key)
+                return Thread.objects.none()
+            return original_filter(*args, **kwargs)
+
+        with mock.patch.object(Thread.objects, 'filter', stale_filter):
+            response = self.client.post(self.thread_create_url, {'participants': [self.user1.pk, self.user2.pk]},
+                                        format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(Thread.objects.count(), 1)
+
+
+class EventStreamTestCase(APITestCase):
+
+    def setUp(self):
+        self.user1 = User.objects.create_user(username='user1')
+        self.user2 = User.objects.create_user(username='user2')
+        self.client.force_authenticate(self.user1)
+        response = self.client.post(reverse('thread_create'),
+                                    {'participants': [self.user1.pk, self.user2.pk]},
+                                    format='json')
+        self.thread = Thread.objects.get(pk=response.data['id'])
+        self.token = Token.objects.create(user=self.user2)
+
+    def post_message(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post(reverse('message_create'), {'text': 'Hello', 'thread': self.thread.id},
+                                        format='json')
+        return response.data
+
+    def test_broker_fanout(self):
+        async def scenario():
+            broker = InMemoryBroker()
+            subscription = broker.subscribe(['user:1'])
+            broker.publish('user:1', {'type': 'message'})
+            broker.publish('user:2', {'type': 'message'})
+            self.assertEqual(await subscription.get(timeout=1), {'type': 'message'})
+            self.assertIsNone(await subscription.get(timeout=0.01))
+            subscription.close()
+            self.assertEqual(broker.subscribed(['user:1', 'user:2']), [])
+
+        async_to_sync(scenario)()
+
+    def test_message_create_pushes_events(self):
+        broker = InMemoryBroker()
+
+        async def scenario():
+            subscription = broker.subscribe([user_channel(self.user2.id)])
+            message = await sync_to_async(self.post_message)()
+            self.assertEqual(await subscription.get(timeout=1), {'type': 'message', 'data': message})
+            self.assertEqual(await subscription.get(timeout=1),
+                             {'type': 'unread_count', 'data': {'unread_messages_count': 1}})
+            subscription.close()
+
+        with mock.patch('chat.events.get_broker', return_value=broker):
+            async_to_sync(scenario)()
+
+    async def test_stream(self):
+        response = await self.async_client.get(reverse('event_stream'), {'token': self.token.key})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response['Content-Type'], 'text/event-stream')
+
+        chunks = aiter(response.streaming_content)
+        self.assertEqual(await anext(chunks), b'event: unread_count\ndata: {"unread_messages_count":0}\n\n')
+        get_broker().publish(user_channel(self.user2.id), {'type': 'message', 'data': {'id': 1}})
+        self.assertEqual(await anext(chunks), b'event: message\ndata: {"id":1}\n\n')
+        await chunks.aclose()
+
+    async def test_stream_requires_token(self):
+        response = await self.async_client.get(reverse('event_stream'))
+        self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
+        response = await self.async_client.get(reverse('event_stream'), {'token': 'invalid'})
+        self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
+
+
+class ThreadInboxTestCase(APITestCase):
+
+    def setUp(self):
+        self.user = User.objects.create_user(username='user')
+        self.threads = []
+        for i in range(5):
+            other = User.objects.create_user(username=f'other{i}')
+            self.client.force_authenticate(self.user)
+            thread_id = self.client.post(reverse('thread_create'), {'participants': [self.user.pk, other.pk]},
+                                         format='json').data['id']
+            self.client.force_authenticate(other)
+            for j in range(i + 1):
+                self.client.post(reverse('message_create'), {'text': f'Message {j}', 'thread': thread_id},
+                                 format='json')
+            self.threads.append(Thread.objects.get(pk=thread_id))
+        self.client.force_authenticate(self.user)
+        self.inbox_url = reverse('thread_inbox')
+
+    def test_inbox(self):
+        response = self.client.get(self.inbox_url, {'limit': 3})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        results = response.data['results']
+        self.assertEqual([t['id'] for t in results], [t.id for t in reversed(self.threads)][:3])
+        self.assertEqual(results[0]['unread_count'], 5)
+        self.assertEqual(results[0]['last_message']['text'], 'Message 4')
+        self.assertFalse(results[0]['last_message']['is_read'])
+        self.assertIn(self.user.id, results[0]['participants'])
+
+        response = self.client.get(response.data['next'])
+        self.assertEqual([t['id'] for t in response.data['results']], [self.threads[1].id, self.threads[0].id])
+        self.assertIsNone(response.data['next'])
+
+    def test_new_message_moves_thread_to_top(self):
+        self.client.post(reverse('message_create'), {'text': 'Bump', 'thread': self.threads[0].id}, format='json')
+        response = self.client.get(self.inbox_url)
+        self.assertEqual(response.data['results'][0]['id'], self.threads[0].id)
+        self.assertEqual(response.data['results'][0]['unread_count'], 1)
+
+    def test_query_count_does_not_grow_with_threads(self):
+        with self.assertNumQueries(3):
+            self.client.get(self.inbox_url)
+
+
+class MembershipTestCase(APITestCase):
+
+    def setUp(self):
+        self.user1 = User.objects.create_user(username='user1')
+        self.user2 = User.objects.create_user(username='user2')
+        self.user3 = User.objects.create_user(username='user3')
+        self.thread = Thread.objects.create()
+        self.thread.participants.set([self.user1, self.user2])
+        # Ids are reused once a test rolls back, the cached participants of its threads would be stale
+        membership.get_local_cache().clear()
+
+    def test_lru_cache(self):
+        cache = LRUCache(max_entries=2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        cache.get('a')
+        cache.set('c', 3)
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(cache.get('a'), 1)
+        self.assertEqual(cache.stats(), {'hits': 2, 'misses': 1, 'hit_rate': 2 / 3, 'size': 2})
+
+        cache = LRUCache(timeout=-1)
+        cache.set('a', 1)
+        self.assertIsNone(cache.get('a'))
+
+    def test_participants_are_cached(self):
+        self.assertTrue(membership.is_participant(self.user1.id, self.thread.id))
+        with self.assertNumQueries(0):
+            self.assertTrue(membership.is_participant(self.user2.id, self.thread.id))
+            self.assertFalse(membership.is_participant(self.user3.id, self.thread.id))
+
+    def test_missing_thread_is_not_cached(self):
+        self.assertFalse(membership.is_participant(self.user1.id, self.thread.id + 1))
+        thread = Thread.objects.create()
+        thread.participants.set([self.user1, self.user3])
+        self.assertTrue(membership.is_participant(self.user1.id, thread.id))
+
+    def test_invalidated_on_delete(self):
+        self.assertTrue(membership.is_participant(self.user1.id, self.thread.id))
+        thread_id = self.thread.id
+        self.thread.delete()
+        self.assertFalse(membership.is_participant(self.user1.id, thread_id))
+
+    def test_message_create_checks_membership(self):
+        self.client.force_authenticate(self.user3)
+        response = self.client.post(reverse('message_create'), {'text': 'Hello', 'thread': self.thread.id},
+                                    format='json')
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+
+    def test_message_list_status_codes(self):
+        self.client.force_authenticate(self.user3)
+        response = self.client.get(reverse('messages_list', kwargs={'thread_id': self.thread.id}))
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+        response = self.client.get(reverse('messages_list', kwargs={'thread_id': self.thread.id + 1}))
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+
+class CachedTokenAuthenticationTestCase(APITestCase):
+
+    def setUp(self):
+        self.user = User.objects.create_user(username='user')
+        self.token = Token.objects.create(user=self.user)
+        self.url = reverse('unread_messages_count')
+        self.client.credentials(HTTP_AUTHORIZATION=f'Token {self.token.key}')
+
+    def test_resolved_token_is_cached(self):
+        self.assertEqual(self.client.get(self.url).status_code, status.HTTP_200_OK)
+        hits = token_cache.hits
+        with self.assertNumQueries(1):  # Only the unread counters query
+            self.assertEqual(self.client.get(self.url).status_code, status.HTTP_200_OK)
+        self.assertEqual(token_cache.hits, hits + 1)
+
+    def test_deleted_token_is_rejected(self):
+        self.client.get(self.url)
+        self.token.delete()
+        self.assertEqual(self.client.get(self.url).status_code, status.HTTP_401_UNAUTHORIZED)
+
+    def test_deactivated_user_is_rejected(self):
+        self.client.get(self.url)
+        self.user.is_active = False
+        self.user.save()
+        self.assertEqual(self.client.get(self.url).status_code, status.HTTP_401_UNAUTHORIZED)
+
+    @override_settings(CHAT_TOKEN_CACHE={'CACHE_ALIAS': 'default'})
+    def test_shared_cache_sees_other_processes_invalidate(self):
+        self.addCleanup(caches['default'].clear)
+        self.client.get(self.url)
+        with self.assertNumQueries(1):
+            self.assertEqual(self.client.get(self.url).status_code, status.HTTP_200_OK)
+        # Deactivated through another process: its signal only reached the shared cache
+        User.objects.filter(pk=self.user.pk).update(is_active=False)
+        caches['default'].delete(token_cache.cache_key(self.token.key))
+        self.assertEqual(self.client.get(self.url).status_code, status.HTTP_401_UNAUTHORIZED)
+
+    def test_issued_token_is_cached(self):
+        user = User.objects.create_user(username='user2', password='password')
+        response = self.client.post(reverse('api_token_auth'), {'username': 'user2', 'password': 'password'},
+                                    format='json')
+        self.assertEqual(response.data['user_id'], user.id)
+        self.client.credentials(HTTP_AUTHORIZATION=f'Token {response.data["token"]}')
+        with self.assertNumQueries(1):
+            self.assertEqual(self.client.get(self.url).status_code, status.HTTP_200_OK)
+
+
+class MessageBatchCreateTestCase(APITestCase):
+
+    def setUp(self):
+        self.user1 = User.objects.create_user(username='user1')
+        self.user2 = User.objects.create_user(username='user2')
+        self.user3 = User.objects.create_user(username='user3')
+        self.client.force_authenticate(self.user1)
+        self.threads = [
+            Thread.objects.get(pk=self.client.post(reverse('thread_create'), {'participants': [self.user1.pk, user.pk]},
+                                                   format='json').data['id'])
+            for user in (self.user2, self.user3)
+        ]
+        self.foreign_thread = Thread.objects.create()
+        self.foreign_thread.participants.set([self.user2, self.user3])
+        self.url = reverse('message_batch_create')
+
+    def test_batch_across_threads(self):
+        payload = {'messages': [
+            {'thread': self.threads[0].id, 'text': 'One'},
+            {'thread': self.threads[1].id, 'text': 'Two'},
+            {'thread': self.threads[0].id, 'text': 'Three'},
+        ]}
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post(self.url, payload, format='json')
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual([r['status'] for r in response.data], [201, 201, 201])
+        self.assertEqual([r['message']['text'] for r in response.data], ['One', 'Two', 'Three'])
+
+        self.assertEqual(counters.unread_total(self.user2), 2)
+        self.assertEqual(counters.unread_total(self.user3), 1)
+        self.threads[0].refresh_from_db()
+        self.assertEqual(self.threads[0].last_message_id, response.data[2]['message']['id'])
+
+    def test_per_item_errors(self):
+        payload = {'messages': [
+            {'thread': self.threads[0].id, 'text': 'One'},
+            {'thread': self.foreign_thread.id, 'text': 'Two'},
+            {'thread': self.threads[0].id},
+            {'thread': self.foreign_thread.id + 1, 'text': 'Four'},
+        ]}
+        response = self.client.post(self.url, payload, format='json')
+        self.assertEqual(response.status_code, status.HTTP_207_MULTI_STATUS)
+        self.assertEqual([r['status'] for r in response.data], [201, 403, 400, 403])
+        self.assertIn('text', response.data[2]['errors'])
+        self.assertEqual(Message.objects.count(), 1)
+
+    def test_query_count_does_not_grow_with_batch(self):
+        payload = {'messages': [{'thread': self.threads[i % 2].id, 'text': f'Message {i}'} for i in range(50)]}
+        # membership, savepoint, insert, watermarks, per thread: activity and counters, participants and sync log,
+        # savepoint release
+        with self.assertNumQueries(11):
+            self.client.post(self.url, payload, format='json')
+
+    def test_empty_batch(self):
+        response = self.client.post(self.url, {'messages': []}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+
+class QueryBudgetTestCase(APITestCase):
+
+    def setUp(self):
+        self.user = User.objects.create_user(username='user', password='password')
+        self.other_user = User.objects.create_user(username='other')
+        self.client.force_authenticate(self.user)
+        for i in range(20):
+            peer = User.objects.create_user(username=f'peer{i}')
+            thread_id = self.client.post(reverse('thread_create'), {'participants': [self.user.pk, peer.pk]},
+                                         format='json').data['id']
+            self.client.post(reverse('message_create'), {'text': 'Hello', 'thread': thread_id}, format='json')
+        thread_id = self.client.post(reverse('thread_create'), {'participants': [self.user.pk, self.other_user.pk]},
+                                     format='json').data['id']
+        self.thread = Thread.objects.get(pk=thread_id)
+        self.client.force_authenticate(self.other_user)
+        for i in range(60):
+            self.client.post(reverse('message_create'), {'text': f'Message {i}', 'thread': thread_id}, format='json')
+        self.message = Message.objects.filter(thread=self.thread).latest('id')
+
+        self.client.force_authenticate(None)
+        self.client.credentials(HTTP_AUTHORIZATION=f'Token {Token.objects.create(user=self.user).key}')
+
+    def test_query_budgets(self):
+        scenarios = build_scenarios(self.user, 'password', self.thread, self.message, self.other_user)
+        self.assertEqual({scenario.name for scenario in scenarios}, set(QUERY_BUDGETS))
+        for scenario in scenarios:
+            run_scenario(self.client, scenario, 1)  # Warm up the caches
+            result = run_scenario(self.client, scenario, 2)
+            with self.subTest(endpoint=scenario.name):
+                self.assertTrue(all(200 <= code < 300 for code in result['statuses']), result['statuses'])
+                self.assertLessEqual(result['queries'], QUERY_BUDGETS[scenario.name])
+
+    def test_every_route_has_a_budget(self):
+        names = {pattern.name for pattern in chat_urls.urlpatterns}
+        self.assertEqual(names - set(QUERY_BUDGETS), set(UNBUDGETED))
+
+
+class MetricsTestCase(APITestCase):
+
+    def setUp(self):
+        self.user = User.objects.create_user(username='user')
+        self.client.force_authenticate(self.user)
+
+    def test_requests_are_measured_by_view(self):
+        self.client.get(reverse('unread_messages_count'))
+        self.client.get(reverse('unread_messages_count'))
+        response = self.client.get('/metrics')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        body = response.content.decode()
+        self.assertIn('chat_http_requests_total{view="unread_messages_count",method="GET",status="200"}', body)
+        self.assertIn('chat_db_queries_per_request_count{view="unread_messages_count"}', body)
+        self.assertIn('chat_http_response_size_bytes_sum{view="unread_messages_count"}', body)
+        self.assertIn('chat_cache_hits_total{cache="membership"}', body)
+
+    def test_queries_are_counted(self):
+        def observed():
+            series = metrics.request_queries.values.get(('unread_messages_count',), [0, 0])
+            return series[-2], series[-1]
+
+        queries, requests = observed()
+        self.client.get(reverse('unread_messages_count'))
+        self.assertEqual(observed(), (queries + 1, requests + 1))
+
+    def test_slow_requests_are_logged(self):
+        with self.settings(CHAT_METRICS={'SLOW_REQUEST_THRESHOLD': 0}), \
+                self.assertLogs('chat.slow_requests', 'WARNING') as logs:
+            self.client.get(reverse('unread_messages_count'))
+        self.assertIn('unread_messages_count', logs.output[0])
+        self.assertIn('chat_unreadcounter', logs.output[0])
+
+
+class ProductionSQLiteTestCase(APITestCase):
+
+    def setUp(self):
+        from config.settings_production import DATABASES
+        from config.sqlite3.base import DatabaseWrapper
+
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = Path(directory.name) / 'db.sqlite3'
+        self.wrapper = DatabaseWrapper({**connection.settings_dict, **DATABASES['default'], 'NAME': self.path}, 'bench')
+        self.addCleanup(self.wrapper.close)
+
+    def test_pragmas_are_applied(self):
+        with self.wrapper.cursor() as cursor:
+            cursor.execute('PRAGMA journal_mode')
+            self.assertEqual(cursor.fetchone()[0], 'wal')
+            cursor.execute('PRAGMA synchronous')
+            self.assertEqual(cursor.fetchone()[0], 1)
+            cursor.execute('PRAGMA temp_store')
+            self.assertEqual(cursor.fetchone()[0], 2)
+
+    def test_transactions_take_the_write_lock(self):
+        self.wrapper.ensure_connection()
+        self.wrapper._start_transaction_under_autocommit()
+        other = sqlite3.connect(self.path, timeout=0, isolation_level=None)
+        self.addCleanup(other.close)
+        with self.assertRaisesMessage(sqlite3.OperationalError, 'database is locked'):
+            other.execute('BEGIN IMMEDIATE')
+        self.wrapper.connection.rollback()
+
+    def test_page_cache_is_shared(self):
+        from config.settings_production import CACHES, CHAT_MESSAGE_PAGE_CACHE
+
+        # Thread versions in process memory would differ between the workers, a file cache scans its directory
+        backend = CACHES[CHAT_MESSAGE_PAGE_CACHE['CACHE_ALIAS']]['BACKEND']
+        self.assertEqual(backend, 'django.core.cache.backends.redis.RedisCache')
+
+
+class SchemaTestCase(APITestCase):
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = Path(directory.name) / 'openapi.yml'
+
+    def test_built_schema_is_served(self):
+        generated = {accept: self.client.get(reverse('schema'), HTTP_ACCEPT=accept).content
+                     for accept in [schema.YAML_CONTENT_TYPE, schema.JSON_CONTENT_TYPE]}
+        with self.settings(CHAT_SCHEMA={'FILE': self.path}):
+            response = self.client.get(reverse('schema'))  # Generated until it is built
+            self.assertEqual(response.content, generated[schema.YAML_CONTENT_TYPE])
+            out = StringIO()
+            call_command('build_schema', validate=True, stdout=out)
+            self.assertIn(f'Wrote {self.path}', out.getvalue())
+
+            with mock.patch('drf_spectacular.views.SpectacularAPIView.get') as generate:
+                for accept, content in generated.items():
+                    response = self.client.get(reverse('schema'), HTTP_ACCEPT=accept)
+                    self.assertEqual(response['Content-Type'], accept)
+                    self.assertEqual(response.content, content)
+                response = self.client.get(reverse('schema'), {'format': 'json'})
+                self.assertEqual(response.content, generated[schema.JSON_CONTENT_TYPE])
+            generate.assert_not_called()
+
+    def test_build_needs_a_file(self):
+        with self.assertRaisesMessage(CommandError, 'CHAT_SCHEMA["FILE"] is not set.'):
+            call_command('build_schema')
+
+    def test_api_profile(self):
+        from config import settings, settings_api
+
+        self.assertIn('chat', settings_api.INSTALLED_APPS)
+        for app in ['jazzmin', 'django.contrib.admin', 'drf_spectacular']:
+            self.assertNotIn(app, settings_api.INSTALLED_APPS)
+        self.assertIn('django.contrib.messages.context_processors.messages',
+                      settings.TEMPLATES[0]['OPTIONS']['context_processors'])
+        result = subprocess.run([sys.executable, 'manage.py', 'check'], cwd=settings.BASE_DIR, capture_output=True,
+                                text=True, env={**os.environ, 'DJANGO_SETTINGS_MODULE': 'config.settings_api'})
+        self.assertEqual(result.returncode, 0, result.stderr)
+
+
+@override_settings(CHAT_ADMISSION={'ENABLED': True, 'USER_RATE': 0.01, 'USER_BURST': 2, 'GLOBAL_RATE': 0.01,
+                                   'GLOBAL_BURST': 3, 'MAX_IN_FLIGHT': 1, 'QUEUE_TIMEOUT': 0})
+class AdmissionTestCase(APITestCase):
+
+    def setUp(self):
+        self.user = User.objects.create_user(username='user')
+        self.other_user = User.objects.create_user(username='other')
+        self.thread = Thread.objects.create()
+        self.thread.participants.set([self.user, self.other_user])
+        self.tokens = {user: f'Token {Token.objects.create(user=user).key}' for user in [self.user, self.other_user]}
+
+    def post_message(self, user, name='message_create'):
+        return self.client.post(reverse(name), {'text': 'Hi', 'thread': self.thread.id}, format='json',
+                                HTTP_AUTHORIZATION=self.tokens[user])
+
+    def test_user_and_global_rates(self):
+        rejected = metrics.admission_rejected.values.get(('message_create', 'user_rate'), 0)
+        self.assertEqual([self.post_message(self.user).status_code for _ in range(2)], [201, 201])
+        with self.assertNumQueries(0):  # The token is cached
+            response = self.post_message(self.user)
+        self.assertEqual(response.status_code, status.HTTP_429_TOO_MANY_REQUESTS)
+        self.assertEqual(response['Retry-After'], '100')
+        self.assertEqual(metrics.admission_rejected.values[('message_create', 'user_rate')], rejected + 1)
+        self.assertIn('chat_http_requests_total{view="message_create",method="POST",status="429"}',
+                      metrics.registry.render())
+
+        response = self.client.get(reverse('thread_list'), HTTP_AUTHORIZATION=self.tokens[self.user])
+        self.assertEqual(response.status_code, status.HTTP_200_OK)  # Reads are not limited
+        self.assertEqual(self.post_message(self.other_user).status_code, status.HTTP_201_CREATED)
+        response = self.post_message(self.other_user, 'async_message_create')  # Out of the global bucket
+        self.assertEqual(response.status_code, status.HTTP_429_TOO_MANY_REQUESTS)
+        self.assertEqual(metrics.admission_rejected.values[('async_message_create', 'global_rate')], 1)
+        self.assertEqual(Message.objects.count(), 3)
+
+    def test_unauthenticated_writes_take_no_tokens(self):
+        for credentials in [{}, *({'HTTP_AUTHORIZATION': f'Token junk{i}'} for i in range(5))]:
+            response = self.client.post(reverse('message_create'), {'text': 'Hi', 'thread': self.thread.id},
+                                        format='json', **credentials)
+            self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
+        self.assertEqual(self.post_message(self.user).status_code, status.HTTP_201_CREATED)
+        self.assertEqual(self.post_message(self.other_user).status_code, status.HTTP_201_CREATED)
+
+    def test_token_bucket_refills(self):
+        buckets = admission.TokenBuckets('test', rate=1, burst=2, max_entries=10)
+        with mock.patch('chat.admission.time.time', side_effect=[100, 100, 100, 100.25, 101.5]):
+            self.assertEqual([buckets.take('key') for _ in range(2)], [0, 0])
+            self.assertEqual(buckets.take('key'), 1)
+            self.assertEqual(buckets.take('key'), 0.75)
+            self.assertEqual(buckets.take('key'), 0)
+
+    def test_writes_in_flight_are_capped(self):
+        controller = admission.Controller(admission.get_settings())
+        self.assertTrue(controller.acquire('view'))
+        self.assertFalse(controller.acquire('view'))
+        self.assertIn('chat_admission_in_flight 1', ''.join(admission.collect()))
+        controller.queue_timeout = 1
+        threading.Timer(0.05, controller.release).start()
+        self.assertTrue(controller.acquire('view'))  # Waited for the first one to finish
+        self.assertFalse(async_to_sync(controller.aacquire)('view'))
+        controller.release()
+        self.assertTrue(async_to_sync(controller.aacquire)('view'))
+        controller.release()
+
+        with mock.patch.object(admission.Controller, 'acquire', return_value=False):
+            response = self.post_message(self.user)
+        self.assertEqual(response.status_code, status.HTTP_429_TOO_MANY_REQUESTS)
+        self.assertEqual(response['Retry-After'], '1')
+        self.assertFalse(Message.objects.exists())
+
+
+@override_settings(CHAT_READ_REPLICAS={'ALIASES': ['replica']})
+class ReadReplicaRouterTestCase(APITestCase):
+
+    def setUp(self):
+        self.user = User.objects.create_user(username='user')
+        self.other_user = User.objects.create_user(username='other')
+        self.thread = Thread.objects.create()
+        self.thread.participants.set([self.user, self.other_user])
+        self.client.force_authenticate(self.user)
+        self.router = routers.ReadReplicaRouter()
+        routers.get_local_cache().clear()
+        self.addCleanup(routers.get_local_cache().clear)
+
+    def test_routing(self):
+        self.assertIsNone(self.router.db_for_read(Message))
+        with routers.reading_from_replica(self.user.pk) as alias:
+            self.assertEqual(alias, 'replica')
+            self.assertEqual(self.router.db_for_read(Message), 'replica')
+            self.assertEqual(self.router.db_for_write(Message), 'default')
+        self.assertIsNone(self.router.db_for_read(Message))
+
+    def test_stickiness(self):
+        routers.stick(self.user.pk)
+        self.assertIsNone(routers.choose_read_alias(self.user.pk))
+        self.assertEqual(routers.choose_read_alias(self.other_user.pk), 'replica')
+        with override_settings(CHAT_READ_REPLICAS={}):
+            self.assertIsNone(routers.choose_read_alias(self.other_user.pk))
+
+    def test_read_endpoints_use_the_replica_until_the_user_writes(self):
+        aliases = []
+
+        def unread_total(user):
+            aliases.append(self.router.db_for_read(UnreadCounter))
+            return 0
+
+        with mock.patch('chat.counters.unread_total', side_effect=unread_total):
+            self.client.get(reverse('unread_messages_count'))
+            self.client.get(reverse('unread_messages_count'))  # A read does not make the user sticky
+            self.client.post(reverse('message_create'), {'text': 'Hello', 'thread': self.thread.id}, format='json')
+            self.client.get(reverse('unread_messages_count'))
+        self.assertEqual(aliases, ['replica', 'replica', None])
+        self.assertIsNone(self.router.db_for_read(UnreadCounter))
+
+    def test_replica_is_released_on_errors(self):
+        with self.assertRaises(ConnectionDoesNotExist):
+            self.client.get(reverse('thread_list'))
+        self.assertIsNone(self.router.db_for_read(Thread))
+
+
+class MessageSearchTestCase(APITestCase):
+
+    def setUp(self):
+        self.user = User.objects.create_user(username='user')
+        self.other_user = User.objects.create_user(username='other')
+        self.stranger = User.objects.create_user(username='stranger')
+        self.thread = Thread.objects.create()
+        self.thread.participants.set([self.user, self.other_user])
+        self.other_thread = Thread.objects.create()
+        self.other_thread.participants.set([self.other_user, self.stranger])
+        self.first = Message.objects.create(sender=self.user, thread=self.thread, text='Lunch at <noon>?')
+        self.second = Message.objects.create(sender=self.other_user, thread=self.thread, text='Lunch, lunch, lunch!')
+        Message.objects.create(sender=self.stranger, thread=self.other_thread, text='Lunch is secret')
+        self.client.force_authenticate(self.user)
+        self.url = reverse('message_search')
+
+    def search(self, **params):
+        response = self.client.get(self.url, params)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        return response.data
+
+    def test_search_in_user_threads(self):
+        results = self.search(q='lunch')['results']
+        self.assertEqual([message['id'] for message in results], [self.second.id, self.first.id])
+        self.assertEqual(results[1]['snippet'], '<mark>Lunch</mark> at &lt;noon&gt;?')
+        self.assertEqual(self.search(q='secret')['results'], [])
+        self.assertEqual(self.search(q='noo*')['results'][0]['id'], self.first.id)
+
+    def test_index_follows_changes(self):
+        Message.objects.filter(pk=self.first.pk).update(text='Dinner then')
+        self.assertEqual([message['id'] for message in self.search(q='dinner')['results']], [self.first.id])
+        self.assertEqual(len(self.search(q='lunch')['results']), 1)
+        self.second.delete()
+        self.assertEqual(self.search(q='lunch')['results'], [])
+
+    def test_pagination(self):
+        first_page = self.search(q='lunch', limit=1)
+        self.assertEqual(first_page['results'][0]['id'], self.second.id)
+        response = self.client.get(first_page['next'])
+        self.assertEqual([message['id'] for message in response.data['results']], [self.first.id])
+        self.assertIsNone(response.data['next'])
+
+    def test_thread_filter_and_validation(self):
+        self.assertEqual(self.search(q='lunch', thread=self.other_thread.id)['results'], [])
+        self.assertEqual(self.client.get(self.url, {'q': ' ?! '}).status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(self.client.get(self.url, {'q': 'lunch', 'cursor': 'x'}).status_code,
+                         status.HTTP_404_NOT_FOUND)
+
+    def test_admin_search(self):
+        admin = User.objects.create_superuser(username='admin')
+        self.client.force_login(admin)
+        response = self.client.get(reverse('admin:chat_message_changelist'), {'q': 'secret'})
+        self.assertEqual([message.text for message in response.context['cl'].result_list], ['Lunch is secret'])
+
+    def test_triggers_are_restored(self):
+        with connection.cursor() as cursor:
+            cursor.execute(f'DROP TRIGGER {search.TABLE}_insert')
+        Message.objects.create(sender=self.user, thread=self.thread, text='Breakfast')
+        search.restore_triggers('default')
+        Message.objects.create(sender=self.user, thread=self.thread, text='Breakfast again')
+        self.assertEqual(len(self.search(q='breakfast')['results']), 2)
+
+
+class AsyncViewsTestCase(APITestCase):
+
+    def setUp(self):
+        self.user = User.objects.create_user(username='user')
+        self.other_user = User.objects.create_user(username='other')
+        self.stranger = User.objects.create_user(username='stranger')
+        self.client.force_authenticate(self.user)
+        self.thread = Thread.objects.get(pk=self.client.post(
+            reverse('thread_create'), {'participants': [self.user.pk, self.other_user.pk]}, format='json'
+        ).data['id'])
+        for i in range(3):
+            self.client.post(reverse('message_create'), {'text': f'Message {i}', 'thread': self.thread.id},
+                             format='json')
+        self.client.force_authenticate(None)
+        self.headers = {'Authorization': f'Token {Token.objects.create(user=self.user).key}'}
+        self.client.credentials(HTTP_AUTHORIZATION=self.headers['Authorization'])
+
+    def async_request(self, method, name, data=None, **kwargs):
+        request = getattr(self.async_client, method)
+        url = reverse(name, kwargs=kwargs)
+        if method == 'get':
+            return async_to_sync(request)(url, data, headers=self.headers)
+        return async_to_sync(request)(url, data, content_type='application/json', headers=self.headers)
+
+    def test_reads_match_the_sync_views(self):
+        for name, kwargs, data in [
+            ('thread_list', {}, {'limit': 1}),
+            ('messages_list', {'thread_id': self.thread.id}, {'limit': 2}),
+            ('unread_messages_count', {}, None),
+        ]:
+            with self.subTest(endpoint=name):
+                expected = self.client.get(reverse(name, kwargs=kwargs), data)
+                response = self.async_request('get', f'async_{name}', data, **kwargs)
+                self.assertEqual(response.status_code, status.HTTP_200_OK)
+                # Pagination links point at the async routes
+                self.assertEqual(response.content.decode().replace('/async/', '/'), expected.content.decode())
+
+    def test_writes(self):
+        response = self.async_request('post', 'async_message_create', {'text': 'Async', 'thread': self.thread.id})
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(response.json()['text'], 'Async')
+        self.assertEqual(counters.unread_total(self.other_user), 4)
+        self.assertEqual(Thread.objects.get(pk=self.thread.pk).last_message_id, response.json()['id'])
+
+        participants = {'participants': [self.user.pk, self.other_user.pk]}
+        response = self.async_request('post', 'async_thread_create', participants)
+        self.assertEqual((response.status_code, response.json()['id']), (status.HTTP_200_OK, self.thread.id))
+        response = self.async_request('post', 'async_thread_create', {'participants': [self.user.pk, self.stranger.pk]})
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(sorted(response.json()['participants']), [self.user.pk, self.stranger.pk])
+
+        response = self.async_request('delete', 'async_thread_delete', pk=self.thread.id)
+        self.assertEqual(response.status_code, status.HTTP_204_NO_CONTENT)
+        self.assertFalse(Thread.objects.filter(pk=self.thread.pk).exists())
+
+    @override_settings(CHAT_JOBS={'LOCAL_WORKER': False})
+    def test_message_in_a_deleted_thread(self):
+        self.assertTrue(membership.is_participant(self.user.pk, self.thread.id))
+        purge.soft_delete(self.thread)
+        # As another process would, still caching the participants of the deleted thread
+        self.addCleanup(membership.get_local_cache().clear)
+        membership.get_local_cache().set(self.thread.id, frozenset([self.user.pk, self.other_user.pk]))
+        for name in ['message_create', 'async_message_create']:
+            with self.subTest(endpoint=name):
+                response = self.async_request('post', name, {'text': 'Late', 'thread': self.thread.id})
+                self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertFalse(Message.objects.filter(text='Late').exists())
+
+    def test_errors_match_the_sync_views(self):
+        stranger_thread = Thread.objects.create()
+        stranger_thread.participants.set([self.other_user, self.stranger])
+        for method, name, data, kwargs in [
+            ('get', 'messages_list', None, {'thread_id': stranger_thread.id}),
+            ('get', 'messages_list', None, {'thread_id': 0}),
+            ('post', 'message_create', {'text': 'Hi', 'thread': stranger_thread.id}, {}),
+            ('post', 'message_create', {'text': '', 'thread': self.thread.id}, {}),
+            ('post', 'thread_create', {'participants': [self.other_user.pk, self.stranger.pk]}, {}),
+            ('delete', 'thread_delete', None, {'pk': stranger_thread.id}),
+        ]:
+            with self.subTest(endpoint=name, data=data, kwargs=kwargs):
+                expected = getattr(self.client, method)(reverse(name, kwargs=kwargs), data, format='json')
+                response = self.async_request(method, f'async_{name}', data, **kwargs)
+                self.assertEqual(response.status_code, expected.status_code)
+                self.assertEqual(response.json(), expected.json())
+
+    def test_authentication(self):
+        for headers in ({}, {'Authorization': 'Token invalid'}):
+            self.client.credentials(**{f'HTTP_{name.upper()}': value for name, value in headers.items()})
+            expected = self.client.get(reverse('unread_messages_count'))
+            response = async_to_sync(self.async_client.get)(reverse('async_unread_messages_count'), headers=headers)
+            self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
+            self.assertEqual(response.json(), expected.json())
+            self.assertEqual(response['WWW-Authenticate'], expected['WWW-Authenticate'])
+        response = async_to_sync(self.async_client.post)(reverse('async_unread_messages_count'), headers=self.headers)
+        self.assertEqual(response.status_code, status.HTTP_405_METHOD_NOT_ALLOWED)
+
+
+class MessagePageSerializationTestCase(APITestCase):
+
+    def setUp(self):
+        self.user = User.objects.create_user(username='user')
+        self.other_user = User.objects.create_user(username='other')
+        self.thread = Thread.objects.create()
+        self.thread.participants.set([self.user, self.other_user])
+        ReadWatermark.objects.create(user=self.other_user, thread=self.thread)
+        texts = ['Hello', 'Quotes " and \\ backslash', 'Ünïcödé 😀', 'Line\u2028separator', '<b>&</b>']
+        for i, text in enumerate(texts):
+            Message.objects.create(sender=self.user if i % 2 else self.other_user, thread=self.thread, text=text)
+        reads.advance_watermark(self.other_user.id, self.thread.id, Message.objects.order_by('id')[2].id)
+        self.client.force_authenticate(self.user)
+
+    def test_same_bytes_as_the_model_serializer(self):
+        response = self.client.get(reverse('messages_list', kwargs={'thread_id': self.thread.id}), {'limit': 4})
+        messages = list(Message.objects.order_by('created', 'id'))[1:]
+        expected = JSONRenderer().render({
+            'next': None,
+            'previous': response.data['previous'],
+            'results': MessageSerializer(messages, many=True).data,
+        })
+        self.assertEqual(response.content, expected)
+        self.assertIn(b'\\u2028', response.content)
+
+    def test_renderer_without_orjson(self):
+        data = {'text': 'Ünïcödé \u2029', 'created': timezone.now(), 'amount': Decimal('1.50')}
+        with mock.patch('chat.renderers.orjson', None):
+            self.assertEqual(FastJSONRenderer().render(data), JSONRenderer().render(data))
+        if renderers.orjson is not None:
+            self.assertEqual(FastJSONRenderer().render(data), JSONRenderer().render(data))
+
+
+class MessagePageCacheTestCase(APITestCase):
+
+    def setUp(self):
+        self.user = User.objects.create_user(username='user')
+        self.other_user = User.objects.create_user(username='other')
+        self.thread = Thread.objects.create()
+        self.thread.participants.set([self.user, self.other_user])
+        reads.ensure_watermarks(self.thread, [self.user.id, self.other_user.id])
+        for i in range(15):
+            Message.objects.create(sender=self.other_user, thread=self.thread, text=f'Message {i}')
+        self.url = reverse('messages_list', kwargs={'thread_id': self.thread.id})
+        self.client.force_authenticate(self.user)
+
+    def test_pages_are_cached(self):
+        first = self.client.get(self.url, {'limit': 10})
+        older = self.client.get(first.data['previous'])
+        hits = page_cache.stats()['hits']
+        with self.assertNumQueries(0):
+            self.assertEqual(self.client.get(self.url, {'limit': 10}).content, first.content)
+            self.assertEqual(self.client.get(first.data['previous']).content, older.content)
+        self.assertEqual(page_cache.stats()['hits'], hits + 2)
+        self.assertNotEqual(self.client.get(self.url, {'limit': 5}).data, first.data)
+
+    def test_new_message_changes_the_page(self):
+        self.client.get(self.url)
+        response = self.client.post(reverse('message_create'), {'text': 'New', 'thread': self.thread.id},
+                                    format='json')
+        self.assertEqual(self.client.get(self.url).data['results'][-1]['id'], response.data['id'])
+
+    def test_read_status_change_changes_the_page(self):
+        self.assertFalse(self.client.get(self.url).data['results'][-1]['is_read'])
+        self.client.post(reverse('thread_read', kwargs={'thread_id': self.thread.id}))
+        self.assertTrue(self.client.get(self.url).data['results'][-1]['is_read'])
+
+    def test_deleted_thread_is_not_served(self):
+        self.client.get(self.url)
+        thread_id = self.thread.id
+        self.thread.delete()
+        self.assertEqual(self.client.get(self.url).status_code, status.HTTP_404_NOT_FOUND)
+        thread = Thread.objects.create(id=thread_id)
+        thread.participants.set([self.user, self.other_user])
+        self.assertEqual(self.client.get(self.url).data['results'], [])
+
+    def test_shared_cache(self):
+        with self.settings(CHAT_MESSAGE_PAGE_CACHE={'CACHE_ALIAS': 'default'}):
+            self.client.get(self.url)
+            with self.assertNumQueries(0):
+                self.client.get(self.url)
+            page_cache.invalidate(self.thread.id)
+            with self.assertNumQueries(2):
+                self.client.get(self.url)
+
+    def test_disabled(self):
+        self.client.get(self.url)
+        with self.settings(CHAT_MESSAGE_PAGE_CACHE={'ENABLED': False}), self.assertNumQueries(2):
+            self.client.get(self.url)
+
+
+class ConditionalGetTestCase(APITestCase):
+
+    def setUp(self):
+        self.user = User.objects.create_user(username='user')
+        self.other_user = User.objects.create_user(username='other')
+        self.client.force_authenticate(self.user)
+        self.thread = Thread.objects.get(pk=self.client.post(
+            reverse('thread_create'), {'participants': [self.user.pk, self.other_user.pk]}, format='json'
+        ).data['id'])
+        self.client.post(reverse('message_create'), {'text': 'Hello', 'thread': self.thread.id}, format='json')
+        self.messages_url = reverse('messages_list', kwargs={'thread_id': self.thread.id})
+
+    def assertNotModified(self, url, response, queries):
+        with self.assertNumQueries(queries):
+            not_modified = self.client.get(url, HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(not_modified.status_code, status.HTTP_304_NOT_MODIFIED)
+        self.assertEqual(not_modified.content, b'')
+        self.assertEqual(not_modified['ETag'], response['ETag'])
+
+    def assertModified(self, url, response):
+        modified = self.client.get(url, HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(modified.status_code, status.HTTP_200_OK)
+        self.assertNotEqual(modified['ETag'], response['ETag'])
+        return modified
+
+    def later(self, seconds):
+        # The clock of the validators only, the thread keeps the time of its last message
+        return mock.patch('chat.conditional.timezone.now', return_value=timezone.now() + timedelta(seconds=seconds))
+
+    def test_messages_list(self):
+        with self.later(2):
+            response = self.client.get(self.messages_url)
+        self.assertIn('Last-Modified', response)
+        self.assertNotModified(self.messages_url, response, 0)  # The validators are cached with the page
+        not_modified = self.client.get(self.messages_url, HTTP_IF_MODIFIED_SINCE=response['Last-Modified'])
+        self.assertEqual(not_modified.status_code, status.HTTP_304_NOT_MODIFIED)
+
+        self.client.post(reverse('message_create'), {'text': 'Again', 'thread': self.thread.id}, format='json')
+        response = self.assertModified(self.messages_url, response)
+        self.client.force_authenticate(self.other_user)
+        self.client.post(reverse('thread_read', kwargs={'thread_id': self.thread.id}))
+        response = self.assertModified(self.messages_url, response)
+
+        message = Message.objects.latest('id')
+        message.text = 'Edited'
+        message.save()
+        response = self.assertModified(self.messages_url, response)
+        self.assertEqual(response.data['results'][-1]['text'], 'Edited')
+
+    def test_last_modified_waits_for_the_end_of_its_second(self):
+        second = int(Thread.objects.get(pk=self.thread.pk).updated.timestamp())
+        clock = datetime.fromtimestamp(second, tz=dt_timezone.utc)
+        with mock.patch('chat.conditional.timezone.now', return_value=clock + timedelta(seconds=0.5)):
+            response = self.client.get(self.messages_url)
+        self.assertNotIn('Last-Modified', response)  # Another message may still come in this second
+
+        self.client.post(reverse('message_create'), {'text': 'Same second', 'thread': self.thread.id}, format='json')
+        Thread.objects.filter(pk=self.thread.pk).update(updated=clock + timedelta(seconds=0.9))
+        with mock.patch('chat.conditional.timezone.now', return_value=clock + timedelta(seconds=1.5)):
+            response = self.client.get(self.messages_url)
+            self.assertEqual(response['Last-Modified'], http_date(second))
+            self.assertEqual(response.data['results'][-1]['text'], 'Same second')
+            not_modified = self.client.get(self.messages_url, HTTP_IF_MODIFIED_SINCE=response['Last-Modified'])
+        self.assertEqual(not_modified.status_code, status.HTTP_304_NOT_MODIFIED)
+
+    def test_edit_is_not_activity(self):
+        other_thread = self.client.post(
+            reverse('thread_create'), {'participants': [self.user.pk, User.objects.create_user('third').pk]},
+            format='json'
+        ).data['id']
+        self.client.post(reverse('message_create'), {'text': 'Newer', 'thread': other_thread}, format='json')
+        response = self.client.get(self.messages_url)
+        self.thread.refresh_from_db()
+        updated = self.thread.updated
+
+        message = Message.objects.filter(thread=self.thread).get()
+        message.text = 'Edited'
+        message.save()
+        self.thread.refresh_from_db()
+        self.assertEqual(self.thread.updated, updated)
+        self.assertIsNotNone(self.thread.changed)
+        inbox = self.client.get(reverse('thread_inbox')).data['results']
+        self.assertEqual([thread['id'] for thread in inbox], [other_thread, self.thread.id])
+        response = self.assertModified(self.messages_url, response)
+        self.assertEqual(response.data['results'][-1]['text'], 'Edited')
+
+    def test_thread_list(self):
+        url = reverse('thread_list')
+        response = self.client.get(url)
+        self.assertNotModified(url, response, 1)
+        self.client.post(reverse('message_create'), {'text': 'Again', 'thread': self.thread.id}, format='json')
+        response = self.assertModified(url, response)
+        self.thread.delete()
+        self.assertEqual(self.assertModified(url, response).data['count'], 0)
+
+    def test_unread_count(self):
+        url = reverse('unread_messages_count')
+        self.client.force_authenticate(self.other_user)
+        response = self.client.get(url)
+        self.assertNotModified(url, response, 1)
+        self.client.force_authenticate(self.user)
+        self.client.post(reverse('message_create'), {'text': 'Again', 'thread': self.thread.id}, format='json')
+        self.client.force_authenticate(self.other_user)
+        self.assertEqual(self.assertModified(url, response).data['unread_messages_count'], 2)
+
+    def test_message_added_in_admin(self):
+        response = self.client.get(self.messages_url)
+        admin = User.objects.create_superuser(username='admin', password='password')
+        self.client.force_login(admin)
+        self.client.post(reverse('admin:chat_message_add'),
+                         {'sender': self.other_user.id, 'thread': self.thread.id, 'text': 'From the admin'})
+        self.thread.refresh_from_db()
+        self.assertEqual(self.thread.last_message.text, 'From the admin')
+        self.client.force_authenticate(self.user)
+        self.assertEqual(self.assertModified(self.messages_url, response).data['results'][-1]['text'],
+                         'From the admin')
+
+
+class SyncTestCase(APITestCase):
+
+    def setUp(self):
+        self.user = User.objects.create_user(username='user')
+        self.other_user = User.objects.create_user(username='other')
+        self.stranger = User.objects.create_user(username='stranger')
+        self.threads = []
+        for peer in (self.other_user, self.stranger):
+            self.client.force_authenticate(peer)
+            self.threads.append(self.client.post(
+                reverse('thread_create'), {'participants': [self.user.pk, peer.pk]}, format='json'
+            ).data['id'])
+        self.client.force_authenticate(self.user)
+        self.url = reverse('sync')
+        self.cursor = self.client.get(self.url).data['cursor']
+
+    def post(self, user, thread_id, text):
+        self.client.force_authenticate(user)
+        response = self.client.post(reverse('message_create'), {'text': text, 'thread': thread_id}, format='json')
+        self.client.force_authenticate(self.user)
+        return response.data
+
+    def test_catch_up_in_batches(self):
+        first = self.post(self.other_user, self.threads[0], 'Hello')
+        self.post(self.stranger, self.threads[1], 'Hi')
+        self.client.post(reverse('thread_read', kwargs={'thread_id': self.threads[0]}))
+        Thread.objects.get(pk=self.threads[1]).delete()
+        Thread.objects.create().participants.set([self.other_user, self.stranger])
+        self.post(self.other_user, Thread.objects.latest('id').id, 'Not for user')
+
+        events, cursor = [], self.cursor
+        while True:
+            response = self.client.get(self.url, {'cursor': cursor, 'limit': 2})
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            events += response.data['events']
+            cursor = response.data['cursor']
+            if not response.data['has_more']:
+                break
+        self.assertEqual([event['type'] for event in events], ['message', 'read', 'thread_deleted'])
+        self.assertEqual(events[0]['data'], {**first, 'is_read': True})
+        self.assertEqual(events[1]['data'], {'thread': self.threads[0], 'user': self.user.id,
+                                             'last_read_message_id': first['id']})
+        self.assertEqual(events[2]['data'], {'thread': self.threads[1]})
+
+        self.assertEqual(self.client.get(self.url, {'cursor': cursor}).data['events'], [])
+        self.post(self.other_user, self.threads[0], 'Later')
+        self.assertEqual(self.client.get(self.url, {'cursor': cursor}).data['events'][0]['data']['text'], 'Later')
+
+    def test_invalid_and_expired_cursors(self):
+        response = self.client.get(self.url, {'cursor': 'not-a-cursor'})
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+        expired = sync.encode_cursor(0, timezone.now() - timedelta(days=31))
+        response = self.client.get(self.url, {'cursor': expired})
+        self.assertEqual(response.status_code, status.HTTP_410_GONE)
+
+    def test_pruned_between_two_pages(self):
+        for text in ['First', 'Second', 'Third']:
+            self.post(self.other_user, self.threads[0], text)
+        SyncEvent.objects.update(created=timezone.now() - timedelta(days=29))
+        response = self.client.get(self.url, {'cursor': self.cursor, 'limit': 1})
+        self.assertTrue(response.data['has_more'])
+
+        later = timezone.now() + timedelta(days=2)
+        sync.prune(later - timedelta(days=30))
+        with mock.patch('django.utils.timezone.now', return_value=later):
+            response = self.client.get(self.url, {'cursor': response.data['cursor']})
+        self.assertEqual(response.status_code, status.HTTP_410_GONE)
+
+    def test_prune(self):
+        self.post(self.other_user, self.threads[0], 'Old')
+        self.post(self.other_user, self.threads[0], 'New')
+        old = SyncEvent.objects.order_by('id').first()
+        SyncEvent.objects.filter(message_id=old.message_id).update(created=timezone.now() - timedelta(days=31))
+        out = StringIO()
+        call_command('prune_sync_events', batch_size=1, stdout=out)
+        self.assertIn('Deleted 2 sync events', out.getvalue())
+        self.assertFalse(SyncEvent.objects.filter(message_id=old.message_id).exists())
+
+
+class AdminTestCase(APITestCase):
+
+    def setUp(self):
+        self.admin = User.objects.create_superuser(username='admin', password='password')
+        self.users = [User.objects.create_user(username=f'user{i}') for i in range(6)]
+        self.client.force_login(self.admin)
+
+    def create_threads(self, count):
+        for i in range(count):
+            thread = Thread.objects.create()
+            thread.participants.set([self.users[i % 6], self.users[(i + 1) % 6]])
+
+    def queries(self, url, data=None):
+        with CaptureQueriesContext(connection) as context:
+            self.assertEqual(self.client.get(url, data).status_code, status.HTTP_200_OK)
+        return [query['sql'] for query in context.captured_queries]
+
+    def test_thread_changelist_does_not_query_per_row(self):
+        self.create_threads(2)
+        few = len(self.queries(reverse('admin:chat_thread_changelist')))
+        self.create_threads(10)
+        self.assertEqual(len(self.queries(reverse('admin:chat_thread_changelist'))), few)
+
+    def test_message_changelist_does_not_count_the_table(self):
+        self.create_threads(1)
+        thread = Thread.objects.get()
+        Message.objects.bulk_create([Message(sender=self.users[0], thread=thread, text=f'M {i}') for i in range(30)])
+        url = reverse('admin:chat_message_changelist')
+        self.assertFalse([sql for sql in self.queries(url) if 'COUNT(' in sql])
+        self.assertEqual(self.client.get(url).context['cl'].result_count, Message.objects.latest('id').id)
+
+        with mock.patch('chat.admin.EstimatedCountPaginator.max_count', 10):
+            response = self.client.get(url, {'thread': thread.id})
+        self.assertEqual(response.context['cl'].result_count, 10)
+        with mock.patch('chat.admin.MessageAdmin.list_per_page', 10):
+            response = self.client.get(url, {'p': 5})  # Past the estimate
+        self.assertEqual((response.status_code, list(response.context['cl'].result_list)), (200, []))
+
+    def test_thread_inline_shows_the_latest_messages(self):
+        self.create_threads(1)
+        thread = Thread.objects.get()
+        Message.objects.bulk_create([Message(sender=self.users[0], thread=thread, text=f'M {i}') for i in range(30)])
+        response = self.client.get(reverse('admin:chat_thread_change', args=[thread.id]))
+        formset = response.context['inline_admin_formsets'][0].formset
+        self.assertEqual([message.text for message in formset.queryset], [f'M {i}' for i in range(29, 9, -1)])
+        self.assertContains(response, f'?thread={thread.id}')
+
+
+@override_settings(CHAT_THREAD_PURGE={'BATCH_SIZE': 2, 'PAUSE': 0}, CHAT_JOBS={'LOCAL_WORKER': False})
+class ThreadPurgeTestCase(APITestCase):
+
+    def setUp(self):
+        self.user = User.objects.create_user(username='user')
+        self.other_user = User.objects.create_user(username='other')
+        self.client.force_authenticate(self.other_user)
+        self.thread_id = self.client.post(
+            reverse('thread_create'), {'participants': [self.user.pk, self.other_user.pk]}, format='json'
+        ).data['id']
+        self.message_ids = [
+            self.client.post(
+                reverse('message_create'), {'text': f'M {i}', 'thread': self.thread_id}, format='json'
+            ).data['id']
+            for i in range(5)
+        ]
+        self.client.force_authenticate(self.user)
+
+    def test_deleted_thread_is_hidden_at_once(self):
+        cursor = self.client.get(reverse('sync')).data['cursor']
+        response = self.client.delete(reverse('thread_delete', kwargs={'pk': self.thread_id}))
+        self.assertEqual(response.status_code, status.HTTP_204_NO_CONTENT)
+        self.assertEqual(list(Job.objects.values_list('name', 'payload')), [('purge_thread', self.thread_id)])
+        self.assertEqual(Message.objects.filter(thread_id=self.thread_id).count(), 5)  # Left to the purge
+        self.assertIsNotNone(Thread.all_objects.get(pk=self.thread_id).deleted_at)
+        self.assertFalse(Thread.objects.filter(pk=self.thread_id).exists())
+
+        self.assertEqual(self.client.get(reverse('thread_list')).data['results'], [])
+        self.assertEqual(self.client.get(reverse('thread_inbox')).data['results'], [])
+        self.assertEqual(self.client.get(reverse('unread_messages_count')).data['unread_messages_count'], 0)
+        for response in [
+            self.client.get(reverse('messages_list', kwargs={'thread_id': self.thread_id})),
+            self.client.post(reverse('thread_read', kwargs={'thread_id': self.thread_id})),
+            self.client.patch(reverse('message_read_change', kwargs={'pk': self.message_ids[0]}), {'is_read': True},
+                              format='json'),
+            self.client.delete(reverse('thread_delete', kwargs={'pk': self.thread_id})),
+        ]:
+            self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+        response = self.client.post(
+            reverse('message_create'), {'text': 'Late', 'thread': self.thread_id}, format='json'
+        )
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        events = self.client.get(reverse('sync'), {'cursor': cursor}).data['events']
+        self.assertEqual([(event['type'], event['data']) for event in events],
+                         [('thread_deleted', {'thread': self.thread_id})])
+
+        response = self.client.post(
+            reverse('thread_create'), {'participants': [self.user.pk, self.other_user.pk]}, format='json'
+        )
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertNotEqual(response.data['id'], self.thread_id)
+
+        self.assertEqual(jobs.run_batch(), 1)
+        self.assertFalse(Thread.all_objects.filter(pk=self.thread_id).exists())
+        self.assertFalse(Job.objects.exists())
+
+    def test_purge_in_batches(self):
+        purge.soft_delete(Thread.objects.get(pk=self.thread_id))
+        self.assertEqual(purge.status(), (1, 5))
+        with CaptureQueriesContext(connection) as context:
+            self.assertEqual(purge.purge_batch(self.thread_id, 2), 2)
+        deletes = [query['sql'] for query in context.captured_queries if query['sql'].startswith('DELETE')]
+        self.assertEqual(len(deletes), 1)
+        self.assertEqual(purge.status(), (1, 3))
+
+        purged = metrics.purged_messages.values.get((), 0)
+        self.assertEqual(purge.purge(), (1, 3))
+        self.assertEqual(metrics.purged_messages.values[()], purged + 3)
+        self.assertEqual(purge.status(), (0, 0))
+        self.assertFalse(Thread.all_objects.filter(pk=self.thread_id).exists())
+        self.assertEqual(search.MessageSearch('M', [self.thread_id]).fetch(10), [])
+
+    def test_purge_threads_command(self):
+        purge.soft_delete(Thread.objects.get(pk=self.thread_id))
+        out = StringIO()
+        call_command('purge_threads', status=True, stdout=out)
+        self.assertIn('1 deleted threads with 5 messages left to purge', out.getvalue())
+        call_command('purge_threads', stdout=out)
+        self.assertIn(f'Purged thread {self.thread_id}: 5 messages', out.getvalue())
+
+        purged = metrics.purged_threads.values[()]
+        self.assertEqual(jobs.run_batch(), 1)  # The job of the thread purged by the command
+        self.assertEqual(metrics.purged_threads.values[()], purged)
+        self.assertFalse(Job.objects.exists())
+        self.assertEqual(purge.status(), (0, 0))
+
+
+@override_settings(CHAT_MESSAGE_PAGE_CACHE={'ENABLED': False},
+                   CHAT_ARCHIVE={'ENABLED': True, 'BATCH_SIZE': 3, 'PAUSE': 0},
+                   CHAT_THREAD_PURGE={'BATCH_SIZE': 2, 'PAUSE': 0}, CHAT_JOBS={'LOCAL_WORKER': False})
+class ArchiveTestCase(APITestCase):
+
+    def setUp(self):
+        self.user = User.objects.create_user(username='user')
+        self.other_user = User.objects.create_user(username='other')
+        self.client.force_authenticate(self.other_user)
+        self.thread_id = self.client.post(
+            reverse('thread_create'), {'participants': [self.user.pk, self.other_user.pk]}, format='json'
+        ).data['id']
+        self.message_ids = [
+            self.client.post(
+                reverse('message_create'), {'text': f'Message {i} ' * (i + 1) * 10, 'thread': self.thread_id},
+                format='json'
+            ).data['id']
+            for i in range(7)
+        ]
+        Message.objects.update(created=F('created') - timedelta(days=100))
+        self.client.force_authenticate(self.user)
+        self.url = reverse('messages_list', kwargs={'thread_id': self.thread_id})
+
+    def pages(self, limit):
+        pages, response = [], self.client.get(self.url, {'limit': limit})
+        while True:
+            pages.append(response.content)
+            if not response.data['previous']:
+                break
+            response = self.client.get(response.data['previous'])
+        return pages
+
+    def test_pack_round_trip(self):
+        for text in ['', 'Hi', 'ÿ' * 3, 'Long message ' * 100]:
+            self.assertEqual(archive.unpack(archive.pack(text)), text)
+        self.assertEqual(archive.pack('Hi'), b'rHi')
+        self.assertLess(len(archive.pack('Long message ' * 100)), 100)
+
+    def test_only_old_messages_read_by_every_recipient(self):
+        self.assertEqual(archive.archive(), 0)  # Unread by the recipient
+        self.client.post(reverse('thread_read', kwargs={'thread_id': self.thread_id}), format='json')
+        self.assertEqual(archive.archive(age_days=101), 0)
+        self.assertEqual(archive.archive(), 6)
+        self.assertEqual(list(Message.objects.values_list('id', flat=True)), self.message_ids[-1:])  # The last one
+        self.assertEqual(list(ArchivedMessage.objects.order_by('id').values_list('id', flat=True)),
+                         self.message_ids[:-1])
+        self.assertEqual(archive.archive(), 0)
+
+    def test_archived_messages_are_listed_as_before(self):
+        self.client.post(reverse('thread_read', kwargs={'thread_id': self.thread_id}), format='json')
+        before = {limit: self.pages(limit) for limit in [1, 2, 5, 10]}
+        Message.objects.filter(id__in=self.message_ids[1:3]).update(created=F('created') + timedelta(days=99))
+        archive.archive()
+        self.assertEqual(list(Message.objects.values_list('id', flat=True)),
+                         self.message_ids[1:3] + self.message_ids[-1:])  # Interleaved with the archived ones
+        Message.objects.filter(id__in=self.message_ids[1:3]).update(created=F('created') - timedelta(days=99))
+        for limit, pages in before.items():
+            with self.subTest(limit=limit):
+                self.assertEqual(self.pages(limit), pages)
+
+        response = self.client.get(self.client.get(self.url, {'limit': 4}).data['previous'])
+        self.assertEqual([item['id'] for item in response.data['results']], self.message_ids[:3])
+        response = self.client.get(response.data['next'])  # Forward from the archive
+        self.assertEqual([item['id'] for item in response.data['results']], self.message_ids[3:])
+        self.assertEqual(response.data['results'][0]['text'], ('Message 3 ' * 40).strip())
+        token = Token.objects.create(user=self.user).key
+        response = async_to_sync(self.async_client.get)(
+            reverse('async_messages_list', kwargs={'thread_id': self.thread_id}), {'limit': 10},
+            headers={'Authorization': f'Token {token}'}
+        )
+        self.assertEqual(response.content.decode().replace('/async/', '/'), before[10][0].decode())
+
+        response = self.client.post(reverse('thread_read', kwargs={'thread_id': self.thread_id}),
+                                    {'message_id': self.message_ids[0]}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+    def test_archive_messages_command(self):
+        self.client.post(reverse('thread_read', kwargs={'thread_id': self.thread_id}), format='json')
+        out = StringIO()
+        call_command('archive_messages', age_days=50, verbosity=2, stdout=out)
+        self.assertIn(f'Up to message {self.message_ids[2]}: 3 archived.', out.getvalue())
+        self.assertIn('Archived 6 messages.', out.getvalue())
+
+        with override_settings(CHAT_ARCHIVE={}), self.assertRaisesMessage(CommandError, 'no longer found by search'):
+            call_command('archive_messages', stdout=out)
+
+    def test_admin_estimate_follows_the_archive(self):
+        self.client.post(reverse('thread_read', kwargs={'thread_id': self.thread_id}), format='json')
+        self.assertEqual(EstimatedCountPaginator(Message.objects.all(), 10).count, self.message_ids[-1])
+        archive.archive()
+        self.assertEqual(EstimatedCountPaginator(Message.objects.all(), 10).count, 1)  # From the ANALYZE
+
+    def test_purge_removes_archived_messages(self):
+        self.client.post(reverse('thread_read', kwargs={'thread_id': self.thread_id}), format='json')
+        archive.archive()
+        purge.soft_delete(Thread.objects.get(pk=self.thread_id))
+        self.assertEqual(purge.status(), (1, 7))
+        self.assertEqual(purge.purge(), (1, 7))
+        self.assertFalse(ArchivedMessage.objects.exists())
+        self.assertFalse(Thread.all_objects.filter(pk=self.thread_id).exists())
+
+
+@override_settings(CHAT_JOBS={'LOCAL_WORKER': False, 'MAX_ATTEMPTS': 2})
+class JobQueueTestCase(APITestCase):
+
+    def setUp(self):
+        self.batches = []
+        jobs.register('test_record')(self.batches.append)
+        self.addCleanup(jobs.handlers.pop, 'test_record')
+
+    def test_enqueued_with_the_transaction_and_run_in_batches(self):
+        with self.assertRaises(ValueError), transaction.atomic():
+            jobs.enqueue('test_record', 1, 2)
+            raise ValueError()
+        self.assertFalse(Job.objects.exists())  # Rolled back with the transaction
+        with self.captureOnCommitCallbacks() as callbacks:
+            jobs.enqueue('test_record', 1, 2)
+            jobs.enqueue('purge_thread', 0)
+            jobs.enqueue('test_record', {'id': 3})
+        self.assertEqual(callbacks, [jobs.wake] * 3)
+
+        self.assertEqual(jobs.run_batch(), 3)
+        self.assertEqual(self.batches, [[1, 2, {'id': 3}]])
+        self.assertEqual(list(Job.objects.values_list('name', flat=True)), ['purge_thread'])
+        self.assertEqual(jobs.run_batch(), 1)
+        self.assertEqual(jobs.run_batch(), 0)
+
+    def test_retry_then_fail(self):
+        jobs.register('test_record')(mock.Mock(side_effect=ValueError('boom')))
+        jobs.enqueue('test_record', 1)
+        with self.assertLogs('chat.jobs', 'ERROR'):
+            jobs.run_batch()
+        job = Job.objects.get()
+        self.assertEqual((job.attempts, job.claimed_at, job.failed_at), (1, None, None))
+        self.assertGreater(job.run_after, timezone.now())
+        self.assertIn('ValueError: boom', job.last_error)
+        self.assertEqual(jobs.run_batch(), 0)  # Not due yet
+
+        Job.objects.update(run_after=timezone.now())
+        with self.assertLogs('chat.jobs', 'ERROR'):
+            jobs.run_batch()
+        self.assertIsNotNone(Job.objects.get().failed_at)
+        self.assertIn('chat_jobs_failed{name="test_record"} 1', metrics.registry.render())
+
+    def test_a_bad_payload_fails_alone(self):
+        def handler(payloads):
+            if 2 in payloads:
+                raise ValueError('boom')
+            self.batches.append(payloads)
+
+        jobs.register('test_record')(handler)
+        jobs.enqueue('test_record', 1, 2, 3)
+        with self.assertLogs('chat.jobs', 'ERROR') as logs:
+            self.assertEqual(jobs.run_batch(), 3)
+        self.assertEqual(len(logs.records), 2)  # The batch, then the bad payload on its own
+        self.assertEqual(self.batches, [[1], [3]])
+        job = Job.objects.get()
+        self.assertEqual((job.payload, job.attempts, job.claimed_at), (2, 1, None))
+
+    @override_settings(CHAT_JOBS={'LOCAL_WORKER': False, 'CLAIM_TIMEOUT': 0})
+    def test_heartbeat_renews_the_claim(self):
+        stale = timezone.now() - timedelta(hours=1)
+
+        def handler(payloads):
+            Job.objects.update(claimed_at=stale)
+            jobs.heartbeat()
+            self.batches.append(Job.objects.get().claimed_at)
+
+        jobs.register('test_record')(handler)
+        jobs.enqueue('test_record', 1)
+        jobs.heartbeat()  # Outside of a job
+        self.assertIsNone(Job.objects.get().claimed_at)
+        jobs.run_batch()
+        self.assertGreater(self.batches[0], stale)
+
+    def test_jobs_of_a_dead_worker_are_claimed_again(self):
+        jobs.enqueue('test_record', 1)
+        Job.objects.update(claimed_at=timezone.now(), claimed_by='dead')
+        self.assertEqual(jobs.run_batch(), 0)
+        Job.objects.update(claimed_at=timezone.now() - timedelta(seconds=301))
+        self.assertEqual(jobs.run_batch(), 1)
+        self.assertEqual(self.batches, [[1]])
+
+    @override_settings(CHAT_JOBS={'LOCAL_WORKER': False, 'DEFER_UNREAD_COUNTERS': True})
+    def test_deferred_unread_counters_are_coalesced(self):
+        user, other_user = User.objects.create_user(username='user'), User.objects.create_user(username='other')
+        self.client.force_authenticate(user)
+        thread_id = self.client.post(
+            reverse('thread_create'), {'participants': [user.pk, other_user.pk]}, format='json'
+        ).data['id']
+        for i in range(3):
+            self.client.post(reverse('message_create'), {'text': f'M {i}', 'thread': thread_id}, format='json')
+        self.assertEqual(counters.unread_total(other_user), 0)  # Not counted yet
+        self.assertEqual(Job.objects.filter(name='refresh_unread_counters').count(), 3)
+
+        with CaptureQueriesContext(connection) as context:
+            self.assertEqual(jobs.run_batch(), 3)
+        updates = [query['sql'] for query in context.captured_queries if query['sql'].startswith('UPDATE "chat_unread')]
+        self.assertEqual(len(updates), 1)
+        self.assertEqual((counters.unread_total(other_user), counters.unread_total(user)), (3, 0))
+        self.assertEqual(counters.diff_counters(), {})
@@ -1,7 +1,10 @@
 from django.urls import path
+from chat import async_views
+from chat.streams import event_stream
 from chat.views import (
-    ThreadCreateView, ThreadDestroyView, ThreadListView,
-    MessageCreateView, MessageListView, MessageReadChangeView, UnreadMessageCountView
+    ThreadCreateView, ThreadDestroyView, ThreadListView, ThreadInboxView,
+    MessageCreateView, MessageBatchCreateView, MessageListView, MessageSearchView, MessageReadChangeView,
+    ThreadReadView, UnreadMessageCountView, SyncView
 )
 
 urlpatterns = [
@@ -9,9 +12,24 @@ urlpatterns = [
     path('threads/create/', ThreadCreateView.as_view(), name='thread_create'),
     path('threads/<int:pk>/delete/', ThreadDestroyView.as_view(), name='thread_delete'),
     path('threads/list/', ThreadListView.as_view(), name='thread_list'),
+    path('threads/inbox/', ThreadInboxView.as_view(), name='thread_inbox'),
     # messages
     path('messages/create/', MessageCreateView.as_view(), name='message_create'),
+    path('messages/batch/', MessageBatchCreateView.as_view(), name='message_batch_create'),
     path('threads/<int:thread_id>/messages/', MessageListView.as_view(), name='messages_list'),
+    path('messages/search/', MessageSearchView.as_view(), name='message_search'),
     path('messages/<int:pk>/read/', MessageReadChangeView.as_view(), name='message_read_change'),
+    path('threads/<int:thread_id>/read/', ThreadReadView.as_view(), name='thread_read'),
     path('messages/unread/', UnreadMessageCountView.as_view(), name='unread_messages_count'),
+    # sync
+    path('sync/', SyncView.as_view(), name='sync'),
+    # events
+    path('stream/', event_stream, name='event_stream'),
+    # async versions, for ASGI servers
+    path('async/threads/create/', async_views.thread_create, name='async_thread_create'),
+    path('async/threads/<int:pk>/delete/', async_views.thread_delete, name='async_thread_delete'),
+    path('async/threads/list/', async_views.thread_list, name='async_thread_list'),
+    path('async/messages/create/', async_views.message_create, name='async_message_create'),
+    path('async/threads/<int:thread_id>/messages/', async_views.messages_list, name='async_messages_list'),
+    path('async/messages/unread/', async_views.unread_messages_count, name='async_unread_messages_count'),
 ]
@@ -1,14 +1,111 @@
-from drf_spectacular.utils import extend_schema
+from collections import Counter
+from drf_spectacular.utils import OpenApiParameter, extend_schema
+from django.contrib.auth.models import User
+from django.db import IntegrityError, transaction
+from django.db.models import Count, Max, OuterRef, Prefetch, Subquery, Value
+from django.db.models.functions import Coalesce
+from django.http import HttpResponse
 from django.shortcuts import get_object_or_404
+from django.utils import timezone
 from rest_framework import status
 from rest_framework.views import APIView
 from rest_framework.permissions import IsAuthenticated
-from rest_framework.generics import CreateAPIView, DestroyAPIView, ListAPIView, UpdateAPIView
+from rest_framework.exceptions import APIException, NotFound, ValidationError
+from rest_framework.pagination import _positive_int
+from rest_framework.generics import CreateAPIView, DestroyAPIView, GenericAPIView, ListAPIView, UpdateAPIView
+from rest_framework.renderers import BrowsableAPIRenderer
 from rest_framework.response import Response
-from django.contrib.auth.models import User
-from chat.models import Thread, Message
-from chat.pagination import DefaultSetPagination
-from chat.serializers import ThreadSerializer, MessageSerializer, MessageReadSerializer
+from chat import counters, events, jobs, membership, metrics, page_cache, purge, reads, routers, search, sync
+from chat.conditional import ConditionalGetMixin, make_etag
+from chat.models import Thread, ArchivedMessage, Message, ReadWatermark, UnreadCounter
+from chat.pagination import (
+    DefaultSetPagination, MessageCursorPagination, MessageSearchPagination, ThreadInboxPagination
+)
+from chat.renderers import FastJSONRenderer
+from chat.serializers import (
+    ThreadSerializer, InboxThreadSerializer, MessageSerializer, MessageBatchSerializer, MessageBatchItemSerializer,
+    MessageBatchResultSerializer, MessageReadSerializer, MessageSearchResultSerializer, ThreadReadSerializer,
+    SyncSerializer, MESSAGE_ROW_FIELDS, serialize_message_rows
+)
+
+
+def messages_posted(messages, messages_data):
+    """Update thread activity and unread counters and schedule the push events of new messages."""
+    last_messages = {}
+    for message in sorted(messages, key=lambda message: message.id):
+        last_messages[message.thread_id] = message
+    for thread_id, last_message in last_messages.items():
+        Thread.objects.filter(pk=thread_id).update(last_message=last_message, updated=last_message.created)
+    page_cache.invalidate(*last_messages)
+
+    defer_counters = jobs.get_settings()['DEFER_UNREAD_COUNTERS']
+    if defer_counters:
+        jobs.enqueue('refresh_unread_counters', *last_messages)
+    else:
+        for (thread_id, sender_id), count in Counter((m.thread_id, m.sender_id) for m in messages).items():
+            counters.messages_created(thread_id, sender_id, count)
+    sync.messages_created(messages)
+
+    def publish():
+        for message_data in messages_data:
+            events.message_created(message_data, unread_counts=not defer_counters)
+
+    transaction.on_commit(publish)
+
+
+@jobs.register('refresh_unread_counters')
+def refresh_unread_counters(thread_ids):
+    """Job of the new messages counted as unread after the response, once per thread however many there were."""
+    thread_ids = set(thread_ids)
+    counters.refresh(thread_ids)
+    events.unread_count_changed(set().union(*membership.participants_of(thread_ids).values()))
+
+
+def thread_read(thread_id, user_id, last_read_message_id):
+    """Log and schedule the push event of a moved read watermark."""
+    sync.thread_read(thread_id, user_id, last_read_message_id)
+    transaction.on_commit(lambda: events.thread_read(thread_id, user_id, last_read_message_id))
+
+
+def messages_changed(thread_ids):
+    """
+    Refresh the last message, the change time and the unread counters of threads whose messages
+    were edited or deleted. ``updated`` is left alone: it is their last activity, which orders the inbox.
+    """
+    last_message = Message.objects.filter(thread=OuterRef('pk')).order_by('-id').values('id')[:1]
+    Thread.objects.filter(pk__in=thread_ids).update(last_message=Subquery(last_message), changed=timezone.now())
+    counters.refresh(thread_ids)
+    page_cache.invalidate(*thread_ids)
+
+
+def create_thread(participants_ids):
+    """Create the thread of ``participants_ids``, return ``(thread, created)``."""
+    participants_key = Thread.make_participants_key(participants_ids)
+    try:
+        with transaction.atomic():
+            thread = Thread.objects.create(participants_key=participants_key)
+            thread.participants.add(*participants_ids)
+            counters.ensure_counters(thread, participants_ids)
+            reads.ensure_watermarks(thread, participants_ids)
+        return thread, True
+    except IntegrityError:  # A concurrent request created the thread first
+        return Thread.objects.get(participants_key=participants_key), False
+
+
+class ReplicaReadMixin:
+    """Read from a replica once the user is authenticated, unless they have just written something."""
+
+    def initial(self, request, *args, **kwargs):
+        super().initial(request, *args, **kwargs)
+        self.read_alias_token = routers.use_replica(request.user.pk)
+
+    def dispatch(self, request, *args, **kwargs):
+        try:
+            return super().dispatch(request, *args, **kwargs)
+        finally:
+            token = self.__dict__.pop('read_alias_token', None)  # Not set when authentication failed
+            if token is not None:
+                routers.release(token)
 
 
 @extend_schema(
@@ -27,23 +124,19 @@ class ThreadCreateView(CreateAPIView):
         serializer.is_valid(raise_exception=True)
 
         participants_ids = serializer.data['participants']
-        participants = User.objects.filter(id__in=participants_ids).all()
 
-        if request.user not in participants:
+        if request.user.id not in participants_ids:
             message = 'One of participants must be user that made request.'
             return Response({'detail': message}, status=status.HTTP_400_BAD_REQUEST)
 
-        existing_thread = Thread.objects.filter(participants__in=participants)
-        for p in participants:
-            existing_thread = existing_thread.filter(participants=p)
+        participants_key = Thread.make_participants_key(participants_ids)
+        thread = Thread.objects.filter(participants_key=participants_key).first()
 
-        if existing_thread.exists():
-            thread = existing_thread.first()
+        if thread is not None:
             response_status = status.HTTP_200_OK
         else:
-            thread = Thread.objects.create()
-            thread.participants.add(*participants)
-            response_status = status.HTTP_201_CREATED
+            thread, created = create_thread(participants_ids)
+            response_status = status.HTTP_201_CREATED if created else status.HTTP_200_OK
 
         serializer = self.get_serializer(thread)
 
@@ -62,19 +155,57 @@ class ThreadDestroyView(DestroyAPIView):
     def get_queryset(self):
         return Thread.objects.filter(participants=self.request.user)  # User can only delete his own threads
 
+    def perform_destroy(self, instance):
+        purge.soft_delete(instance)  # The messages are purged in the background
+
 
 @extend_schema(
     tags=['Chat, Threads'],
     summary='Get user threads',
     description='Endpoint to get users threads.'
 )
-class ThreadListView(ListAPIView):
+class ThreadListView(ReplicaReadMixin, ConditionalGetMixin, ListAPIView):
     serializer_class = ThreadSerializer
     permission_classes = [IsAuthenticated]
     pagination_class = DefaultSetPagination
 
     def get_queryset(self):
-        return Thread.objects.filter(participants=self.request.user)  # User can get only his own threads
+        # User can get only his own threads
+        return Thread.objects.filter(participants=self.request.user).prefetch_related(
+            Prefetch('participants', queryset=User.objects.only('id'))
+        )
+
+    def get_validators(self):
+        # A new thread raises the last id, a deleted one lowers the count, activity moves the last update
+        threads = Thread.objects.filter(participants=self.request.user).aggregate(
+            count=Count('id'), last_id=Max('id'), last_updated=Max('updated')
+        )
+        self.result_count = threads['count']  # Spares the pagination its count query
+        return make_etag(self.request, threads['count'], threads['last_id'], threads['last_updated']), None
+
+
+@extend_schema(
+    tags=['Chat, Threads'],
+    summary='Get user inbox',
+    description='Endpoint to get users threads with the last message and unread count, recently active first.'
+)
+class ThreadInboxView(ListAPIView):
+    serializer_class = InboxThreadSerializer
+    permission_classes = [IsAuthenticated]
+    pagination_class = ThreadInboxPagination
+
+    def get_queryset(self):
+        unread_count = UnreadCounter.objects.filter(thread=OuterRef('pk'), user=self.request.user).values('count')[:1]
+        return Thread.objects.filter(participants=self.request.user).select_related('last_message').prefetch_related(
+            Prefetch('participants', queryset=User.objects.only('id'))
+        ).annotate(unread_count=Coalesce(Subquery(unread_count), Value(0)))
+
+    def list(self, request, *args, **kwargs):
+        page = self.paginate_queryset(self.filter_queryset(self.get_queryset()))
+        context = self.get_serializer_context()
+        context['watermarks'] = reads.thread_watermarks([thread.id for thread in page])
+        serializer = self.get_serializer_class()(page, many=True, context=context)
+        return self.get_paginated_response(serializer.data)
 
 
 @extend_schema(
@@ -93,35 +224,192 @@ class MessageCreateView(CreateAPIView):
 
         thread = serializer.validated_data['thread']
 
-        if request.user not in thread.participants.all():
+        if not membership.is_participant(request.user.id, thread.id):
             message = 'You do not have permission to post in this thread.'
             self.permission_denied(self.request, message=message)
 
-        self.perform_create(serializer)
+        with transaction.atomic():
+            self.perform_create(serializer)
+            messages_posted([serializer.instance], [serializer.data])
         headers = self.get_success_headers(serializer.data)
 
         return Response(serializer.data, status=status.HTTP_201_CREATED, headers=headers)
 
 
+@extend_schema(
+    tags=['Chat, Messages'],
+    summary='Create messages in batch',
+    description='Endpoint to create many messages, possibly in several threads, in one transaction. '
+                'Every message gets its own result, in the order of the request.',
+    responses={
+        status.HTTP_201_CREATED: MessageBatchResultSerializer(many=True),
+        status.HTTP_207_MULTI_STATUS: MessageBatchResultSerializer(many=True),
+    }
+)
+class MessageBatchCreateView(GenericAPIView):
+    serializer_class = MessageBatchSerializer
+    permission_classes = [IsAuthenticated]
+
+    def post(self, request, *args, **kwargs):
+        serializer = self.get_serializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        items = serializer.validated_data['messages']
+
+        results = [None] * len(items)
+        valid_items = []
+        for index, item in enumerate(items):
+            item_serializer = MessageBatchItemSerializer(data=item)
+            if item_serializer.is_valid():
+                valid_items.append((index, item_serializer.validated_data))
+            else:
+                results[index] = {'status': status.HTTP_400_BAD_REQUEST, 'errors': item_serializer.errors}
+
+        thread_ids = {data['thread'] for _, data in valid_items}
+        allowed_thread_ids = set(Thread.participants.through.objects.filter(
+            user_id=request.user.id, thread_id__in=thread_ids
+        ).values_list('thread_id', flat=True))
+
+        indexes, messages = [], []
+        for index, data in valid_items:
+            if data['thread'] in allowed_thread_ids:
+                indexes.append(index)
+                messages.append(Message(sender=request.user, thread_id=data['thread'], text=data['text']))
+            else:
+                message = 'You do not have permission to post in this thread.'
+                results[index] = {'status': status.HTTP_403_FORBIDDEN, 'errors': {'detail': message}}
+
+        with transaction.atomic():
+            Message.objects.bulk_create(messages)
+            context = self.get_serializer_context()
+            context['watermarks'] = reads.thread_watermarks({message.thread_id for message in messages})
+            messages_data = MessageSerializer(messages, many=True, context=context).data
+            messages_posted(messages, messages_data)
+
+        for index, message_data in zip(indexes, messages_data):
+            results[index] = {'status': status.HTTP_201_CREATED, 'message': message_data}
+
+        response_status = status.HTTP_201_CREATED if len(messages) == len(items) else status.HTTP_207_MULTI_STATUS
+        return Response(results, status=response_status)
+
+
 @extend_schema(
     tags=['Chat, Messages'],
     summary='Get thread messages',
     description='Endpoint to get thread messages.'
 )
-class MessageListView(ListAPIView):
-    serializer_class = MessageSerializer
+class MessageListView(ReplicaReadMixin, ConditionalGetMixin, ListAPIView):
+    serializer_class = MessageSerializer  # Documents the rows built by serialize_message_rows
     permission_classes = [IsAuthenticated]
-    pagination_class = DefaultSetPagination
+    pagination_class = MessageCursorPagination
+    renderer_classes = [FastJSONRenderer, BrowsableAPIRenderer]
 
     def get_queryset(self):
         thread_id = self.kwargs['thread_id']
-        thread = get_object_or_404(Thread, id=thread_id)
 
-        if self.request.user not in thread.participants.all():
+        if not membership.is_participant(self.request.user.id, thread_id):
+            get_object_or_404(Thread, id=thread_id)
             message = 'You do not have permission to access messages in this thread.'
             self.permission_denied(self.request, message=message)
 
-        return Message.objects.filter(thread=thread).order_by('created')
+        return Message.objects.filter(thread_id=thread_id)  # Ordered by the keyset pagination
+
+    def get_validators(self):
+        self.get_queryset()  # Checks the permission first
+        thread_id = self.kwargs['thread_id']
+        self.page_key = page_cache.get_key(thread_id, self.paginator, self.request)  # Before any query
+        self.cached_page = page_cache.get_page(self.page_key)
+        if self.cached_page is not None:
+            self.page_version = self.cached_page[2]
+        else:
+            self.page_version = self.get_page_version(thread_id)
+        if self.page_version is None:
+            return None, None
+        updated, _, changed, _, read_updated = self.page_version
+        return make_etag(self.request, *self.page_version), max(filter(None, (updated, changed, read_updated)))
+
+    def get_page_version(self, thread_id):
+        """
+        What the page depends on besides its messages: posting messages moves Thread.updated, editing
+        and deleting them Thread.changed, marking them read or unread the watermarks. The watermarks
+        are kept for the page.
+        """
+        rows = ReadWatermark.objects.filter(thread_id=thread_id).values_list(
+            'user_id', 'last_read_message_id', 'updated', 'thread__updated', 'thread__last_message_id',
+            'thread__changed'
+        )
+        self.watermarks = {thread_id: {user_id: last_read for user_id, last_read, *_ in rows}}
+        if rows:
+            thread = rows[0][3:]
+        else:
+            thread = Thread.objects.filter(pk=thread_id).values_list('updated', 'last_message_id', 'changed').first()
+            if thread is None:
+                return None
+        read = tuple(sorted(self.watermarks[thread_id].items()))
+        return *thread, read, max((row[2] for row in rows), default=None)
+
+    def list(self, request, *args, **kwargs):
+        if self.cached_page is not None:
+            results, state, _ = self.cached_page
+            self.paginator.restore_page(request, state)
+            return self.get_paginated_response(results)
+
+        # Plain rows instead of model instances through MessageSerializer, the response is the same
+        archived = ArchivedMessage.objects.filter(thread_id=self.kwargs['thread_id'])
+        page = self.paginator.paginate_queryset(
+            self.get_queryset().values_list(*MESSAGE_ROW_FIELDS, named=True), request, view=self,
+            tiers=[archived.values_list(*MESSAGE_ROW_FIELDS, named=True)]
+        )
+        watermarks = getattr(self, 'watermarks', None) or reads.thread_watermarks([self.kwargs['thread_id']])
+        results = serialize_message_rows(page, watermarks)
+        # The validators stay with the page, they hold as long as it is served
+        page_cache.set_page(self.page_key, (results, self.paginator.get_page_state(), self.page_version))
+        return self.get_paginated_response(results)
+
+
+class SearchUnavailable(APIException):
+    status_code = status.HTTP_501_NOT_IMPLEMENTED
+    default_detail = 'Message search needs the SQLite full-text index.'
+    default_code = 'search_unavailable'
+
+
+@extend_schema(
+    tags=['Chat, Messages'],
+    summary='Search messages',
+    description='Endpoint to search the messages of user threads by words, most relevant first. '
+                'A word ending with * matches as a prefix.',
+    parameters=[
+        OpenApiParameter('q', str, required=True, description='Words to search for.'),
+        OpenApiParameter('thread', int, description='Only search this thread.'),
+    ]
+)
+class MessageSearchView(ReplicaReadMixin, ListAPIView):
+    serializer_class = MessageSearchResultSerializer
+    permission_classes = [IsAuthenticated]
+    pagination_class = MessageSearchPagination
+
+    def get_queryset(self):
+        if not search.is_supported():
+            raise SearchUnavailable()
+        terms = self.request.query_params.get('q', '')
+        if search.build_query(terms) is None:
+            raise ValidationError({'q': 'Enter at least one word to search for.'})
+
+        thread_ids = Thread.participants.through.objects.filter(user_id=self.request.user.id).values_list(
+            'thread_id', flat=True
+        )
+        thread = self.request.query_params.get('thread')
+        if thread is not None:
+            if not thread.isdigit():
+                raise ValidationError({'thread': 'A valid integer is required.'})
+            thread_ids = thread_ids.filter(thread_id=thread)
+        return search.MessageSearch(terms, thread_ids)
+
+    def list(self, request, *args, **kwargs):
+        page = self.paginate_queryset(self.get_queryset())
+        context = self.get_serializer_context()
+        context['watermarks'] = reads.thread_watermarks({message.thread_id for message in page})
+        serializer = self.get_serializer_class()(page, many=True, context=context)
+        return self.get_paginated_response(serializer.data)
 
 
 @extend_schema(
@@ -133,32 +421,137 @@ class MessageReadChangeView(UpdateAPIView):
     serializer_class = MessageReadSerializer
     permission_classes = [IsAuthenticated]
     http_method_names = ['patch']
-    queryset = Message.objects.all()
+    queryset = Message.objects.filter(thread__deleted_at=None)  # Messages of deleted threads wait for their purge
 
     def update(self, request, *args, **kwargs):
         message = self.get_object()
 
-        if request.user not in message.thread.participants.all():
+        if not membership.is_participant(request.user.id, message.thread_id):
             message = 'You do not have permission to mark this message as read.'
             self.permission_denied(self.request, message=message)
 
-        serializer = self.get_serializer(message, data=request.data, partial=True)
+        serializer = self.get_serializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+
+        with transaction.atomic():
+            if serializer.validated_data['is_read']:
+                moved = reads.advance_watermark(request.user.id, message.thread_id, message.id)
+                last_read_message_id = message.id
+            else:
+                moved = reads.rewind_watermark(request.user.id, message.thread_id, message.id)
+                last_read_message_id = message.id - 1
+            if moved:
+                thread_read(message.thread_id, request.user.id, last_read_message_id)
+
+        watermarks = reads.thread_watermarks([message.thread_id])[message.thread_id]
+        serializer = self.get_serializer({'is_read': reads.is_read(message.id, message.sender_id, watermarks)})
+
+        return Response(serializer.data, status=status.HTTP_200_OK)
+
+
+@extend_schema(
+    tags=['Chat, Messages'],
+    summary='Mark thread messages as read',
+    description='Endpoint to mark all thread messages up to the given one (the latest by default) as read.'
+)
+class ThreadReadView(GenericAPIView):
+    serializer_class = ThreadReadSerializer
+    permission_classes = [IsAuthenticated]
+
+    def post(self, request, *args, **kwargs):
+        thread_id = self.kwargs['thread_id']
+
+        if not membership.is_participant(request.user.id, thread_id):
+            get_object_or_404(Thread, id=thread_id)
+            message = 'You do not have permission to mark messages in this thread as read.'
+            self.permission_denied(self.request, message=message)
+
+        serializer = self.get_serializer(data=request.data)
         serializer.is_valid(raise_exception=True)
-        self.perform_update(serializer)
 
+        messages = Message.objects.filter(thread_id=thread_id)
+        message_id = serializer.validated_data.get('message_id')
+        if message_id is None:
+            message_id = messages.order_by('-id').values_list('id', flat=True).first() or 0
+        elif not messages.filter(id=message_id).exists() and not ArchivedMessage.objects.filter(
+            thread_id=thread_id, id=message_id
+        ).exists():
+            raise ValidationError({'message_id': 'The message does not belong to this thread.'})
+
+        with transaction.atomic():
+            if reads.advance_watermark(request.user.id, thread_id, message_id):
+                thread_read(thread_id, request.user.id, message_id)
+            watermark = ReadWatermark.objects.get(user=request.user, thread_id=thread_id)
+            unread_count = UnreadCounter.objects.filter(user=request.user, thread_id=thread_id).values_list(
+                'count', flat=True
+            ).first() or 0
+
+        serializer = self.get_serializer({
+            'last_read_message_id': watermark.last_read_message_id,
+            'unread_count': unread_count,
+        })
         return Response(serializer.data, status=status.HTTP_200_OK)
 
 
+class SyncExpired(APIException):
+    status_code = status.HTTP_410_GONE
+    default_detail = 'The cursor is too old, load the threads again and start over without a cursor.'
+    default_code = 'sync_expired'
+
+
+@extend_schema(
+    tags=['Chat, Sync'],
+    summary='Catch up with changes',
+    description='Endpoint to get the new messages, read status changes and deleted threads of all user threads '
+                'since the cursor, oldest first. Without a cursor, returns no events and the current cursor.',
+    parameters=[
+        OpenApiParameter('cursor', str, description='Cursor of the previous response.'),
+        OpenApiParameter('limit', int, description='Number of events to return at most.'),
+    ]
+)
+class SyncView(GenericAPIView):
+    serializer_class = SyncSerializer
+    permission_classes = [IsAuthenticated]
+    renderer_classes = [FastJSONRenderer, BrowsableAPIRenderer]
+
+    def get(self, request, *args, **kwargs):
+        cursor = request.query_params.get('cursor')
+        if cursor is None:
+            return Response({'events': [], 'cursor': sync.current_cursor(request.user), 'has_more': False})
+        try:
+            after = sync.decode_cursor(cursor)
+        except ValueError:
+            raise NotFound('Invalid cursor')
+        except sync.CursorExpired:
+            raise SyncExpired()
+
+        max_events = sync.get_settings()['MAX_EVENTS']
+        try:
+            limit = _positive_int(request.query_params['limit'], strict=True, cutoff=max_events)
+        except (KeyError, ValueError):
+            limit = max_events
+        events, cursor, has_more = sync.fetch(request.user, after, limit)
+        return Response({'events': events, 'cursor': cursor, 'has_more': has_more})
+
+
 @extend_schema(
     tags=['Chat, Messages'],
     summary='Get unread messages count',
     description='Endpoint to get unread messages count for all user threads.'
 )
-class UnreadMessageCountView(APIView):
+class UnreadMessageCountView(ReplicaReadMixin, ConditionalGetMixin, APIView):
     permission_classes = [IsAuthenticated]
     serializer_class = MessageSerializer
 
-    def get(self, request, *args, **kwargs):
-        user = self.request.user
-        unread_count = Message.objects.filter(thread__participants=user, is_read=False).exclude(sender=user).count()
-        return Response({'unread_messages_count': unread_count}, status=status.HTTP_200_OK)
+    def get_validators(self):
+        # The count is the whole response, computing it is as cheap as any validator
+        self.unread_count = counters.unread_total(self.request.user)
+        return make_etag(self.request, self.unread_count), None
+
+    def get_modified_response(self, request, *args, **kwargs):
+        return Response({'unread_messages_count': self.unread_count}, status=status.HTTP_200_OK)
+
+
+def metrics_view(request):
+    """Request, SQL and cache metrics of this process in the Prometheus text format."""
+    return HttpResponse(metrics.registry.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
@@ -26,11 +26,14 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'chat.middleware.MetricsMiddleware',
+    'chat.middleware.AdmissionMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
+    'chat.middleware.ReplicaStickinessMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
 ]
@@ -59,8 +62,15 @@ DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3',
         'NAME': BASE_DIR / 'db.sqlite3',
-    }
+    },
+    # A read replica, e.g. a copy of the database file to try the routing locally:
+    # 'replica': {
+    #     'ENGINE': 'django.db.backends.sqlite3',
+    #     'NAME': BASE_DIR / 'replica.sqlite3',
+    #     'TEST': {'MIRROR': 'default'},
+    # },
 }
+DATABASE_ROUTERS = ['chat.routers.ReadReplicaRouter']
 
 AUTH_PASSWORD_VALIDATORS = [
     {
@@ -92,13 +102,79 @@ REST_FRAMEWORK = {
         'rest_framework.permissions.IsAuthenticated',
     ],
     'DEFAULT_AUTHENTICATION_CLASSES': [
-        'rest_framework.authentication.TokenAuthentication',
+        'chat.authentication.CachedTokenAuthentication',
     ],
     'DEFAULT_PARSER_CLASSES': [
         'rest_framework.parsers.JSONParser',
     ]
 }
 
+CHAT_METRICS = {
+    'ENABLED': True,
+    'SLOW_REQUEST_THRESHOLD': 1.0,  # seconds, requests this slow are logged with their queries, None to disable
+}
+CHAT_READ_REPLICAS = {
+    'ALIASES': [],  # DATABASES aliases the thread list, messages list and unread count read from
+    'STICKINESS': 5,  # seconds users keep reading from the primary after a write
+    'CACHE_ALIAS': None,  # Django cache shared by all processes, local memory only when None
+}
+CHAT_MEMBERSHIP_CACHE = {
+    'MAX_ENTRIES': 10000,
+    'TIMEOUT': 60,  # seconds other processes may keep participants of a deleted thread
+    'CACHE_ALIAS': None,  # Django cache shared by all processes, local memory only when None
+}
+CHAT_TOKEN_CACHE = {
+    'MAX_ENTRIES': 10000,
+    'TIMEOUT': 300,  # seconds other processes may keep accepting a deleted token without a shared cache
+    'CACHE_ALIAS': None,  # Django cache shared by all processes, instead of local memory
+}
+CHAT_MESSAGE_PAGE_CACHE = {
+    'ENABLED': True,
+    'MAX_ENTRIES': 10000,  # cached pages, and thread versions, per process
+    'TIMEOUT': 300,  # seconds a page stays cached when its thread does not change
+    'CACHE_ALIAS': None,  # Django cache shared by all processes, local memory only when None
+}
+CHAT_SYNC = {
+    'RETENTION_DAYS': 30,  # days sync events are kept by prune_sync_events, older cursors have to start over
+    'MAX_EVENTS': 500,  # events per sync response
+}
+CHAT_THREAD_PURGE = {
+    'BATCH_SIZE': 500,  # messages of a deleted thread deleted per transaction
+    'PAUSE': 0.05,  # seconds between batches, other writers take the lock meanwhile
+}
+CHAT_ARCHIVE = {
+    'ENABLED': False,  # archived messages are no longer found by search
+    'AGE_DAYS': 90,  # messages this old and read by every recipient are moved to the archive
+    'BATCH_SIZE': 1000,  # messages looked at per transaction by archive_messages
+    'PAUSE': 0.05,  # seconds between batches, other writers take the lock meanwhile
+    'ANALYSIS_LIMIT': 1000,  # rows sampled per index by the ANALYZE after archiving, 0 reads them all
+}
+CHAT_JOBS = {
+    'LOCAL_WORKER': True,  # run jobs in a thread of the process that queued them, besides any run_jobs worker
+    'BATCH_SIZE': 100,  # jobs of the same name handed to their handler at once
+    'MAX_ATTEMPTS': 5,
+    'RETRY_DELAY': 10,  # seconds before the first retry, doubled on every attempt
+    'CLAIM_TIMEOUT': 300,  # seconds after which the jobs of a worker that died are claimed again
+    'POLL_INTERVAL': 1.0,  # seconds run_jobs waits when the queue is empty
+    'DEFER_UNREAD_COUNTERS': False,  # count new messages as unread in a job, coalesced per thread
+}
+CHAT_ADMISSION = {
+    'ENABLED': False,  # on in config.settings_production
+    'USER_RATE': 5,  # writes per second of one user, sustained
+    'USER_BURST': 20,  # writes one user can make at once
+    'GLOBAL_RATE': 200,  # writes per second of all users, what the database sustains
+    'GLOBAL_BURST': 400,
+    'MAX_IN_FLIGHT': 4,  # writes served at once per process, SQLite runs one at a time anyway
+    'QUEUE_TIMEOUT': 0.5,  # seconds a write waits for one of them before it gets a 429
+    'CACHE_ALIAS': None,  # Django cache shared by all processes for the buckets, per process when None
+}
+CHAT_SCHEMA = {
+    'FILE': None,  # OpenAPI schema written by build_schema and served as is, generated per request when None
+}
+CHAT_MESSAGE_BATCH_MAX_SIZE = 500
+CHAT_PUBSUB_BROKER = 'chat.pubsub.InMemoryBroker'
+CHAT_STREAM_KEEPALIVE = 15  # seconds between keep-alive comments on idle event streams
+
 SPECTACULAR_SETTINGS = {
     'TITLE': 'iSi Simple chat API',
     'DESCRIPTION': 'iSi Simple chat API',
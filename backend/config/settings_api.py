@@ -0,0 +1,41 @@
+from config.settings_production import *  # noqa: F401, F403
+
+# API workers: the production settings without the admin, its sessions and messages, and the docs tooling.
+# The schema is served from the file written by build_schema. Run the admin and the docs on workers with
+# config.settings_production.
+INSTALLED_APPS = [
+    app for app in INSTALLED_APPS  # noqa: F405
+    if app not in [
+        'jazzmin',
+        'django.contrib.admin',
+        'django.contrib.sessions',
+        'django.contrib.messages',
+        'django.contrib.staticfiles',
+        'drf_spectacular',
+    ]
+]
+
+# DRF sets request.user itself, these only serve the admin's session login
+MIDDLEWARE = [
+    middleware for middleware in MIDDLEWARE  # noqa: F405
+    if middleware not in [
+        'django.contrib.sessions.middleware.SessionMiddleware',
+        'django.contrib.auth.middleware.AuthenticationMiddleware',
+        'django.contrib.messages.middleware.MessageMiddleware',
+    ]
+]
+TEMPLATES = [{
+    **TEMPLATES[0],  # noqa: F405
+    'OPTIONS': {
+        'context_processors': [
+            processor for processor in TEMPLATES[0]['OPTIONS']['context_processors']  # noqa: F405
+            if processor != 'django.contrib.messages.context_processors.messages'
+        ],
+    },
+}]
+
+REST_FRAMEWORK = {
+    **REST_FRAMEWORK,  # noqa: F405
+    # Subclassed by the views' extend_schema at import time, DRF's own is loaded anyway, drf_spectacular's is not
+    'DEFAULT_SCHEMA_CLASS': 'rest_framework.schemas.openapi.AutoSchema',
+}
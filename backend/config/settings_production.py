@@ -0,0 +1,52 @@
+import os
+from config.settings import *  # noqa: F401, F403
+
+DATABASES = {
+    'default': {
+        'ENGINE': 'config.sqlite3',
+        'NAME': BASE_DIR / 'db.sqlite3',  # noqa: F405
+        # Keep connections open between requests, checked before reuse
+        'CONN_MAX_AGE': None,
+        'CONN_HEALTH_CHECKS': True,
+        'OPTIONS': {
+            'timeout': 20,  # seconds to wait for a lock before "database is locked"
+            'transaction_mode': 'IMMEDIATE',
+            'init_command': (
+                # Readers and the writer no longer block each other
+                'PRAGMA journal_mode=WAL;'
+                # Durable at WAL checkpoints, safe against corruption in WAL mode
+                'PRAGMA synchronous=NORMAL;'
+                'PRAGMA cache_size=-65536;'  # 64 MiB page cache per connection
+                'PRAGMA mmap_size=268435456;'  # 256 MiB of the file read through mmap
+                'PRAGMA temp_store=MEMORY;'
+            ),
+        },
+    }
+}
+
+# Shared by all worker processes, needs a Redis server and `pip install redis`. The page cache keeps its thread
+# versions here: in process memory every worker has its own and keeps serving pages, and 304s, of threads changed
+# in another. A file or database cache would put a directory scan or an SQLite write on every message posted.
+CACHES = {
+    'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'},
+    'shared': {
+        'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+        'LOCATION': os.environ.get('REDIS_URL', 'redis://127.0.0.1:6379/1'),
+        'TIMEOUT': 300,
+    },
+}
+CHAT_MESSAGE_PAGE_CACHE = {
+    **CHAT_MESSAGE_PAGE_CACHE,  # noqa: F405
+    'CACHE_ALIAS': 'shared',
+}
+CHAT_TOKEN_CACHE = {
+    **CHAT_TOKEN_CACHE,  # noqa: F405
+    'CACHE_ALIAS': 'shared',  # a deleted token or deactivated user is rejected by every worker at once
+}
+CHAT_SCHEMA = {
+    'FILE': BASE_DIR / 'schema' / 'openapi.yml',  # noqa: F405, build it on deploy: manage.py build_schema
+}
+CHAT_ADMISSION = {
+    **CHAT_ADMISSION,  # noqa: F405
+    'ENABLED': True,  # 429 with Retry-After instead of lock timeouts when writes come faster than SQLite takes them
+}
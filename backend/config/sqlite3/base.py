@@ -0,0 +1,43 @@
+"""
+SQLite backend with the ``init_command`` and ``transaction_mode`` options of Django 5.1.
+
+``init_command`` holds ``;`` separated statements, typically ``PRAGMA`` ones, run on every
+new connection. ``transaction_mode`` (``DEFERRED``, ``IMMEDIATE`` or ``EXCLUSIVE``) is used by
+``transaction.atomic()``: with ``IMMEDIATE`` a write transaction takes the write lock when it
+begins and waits for it up to the busy ``timeout``, instead of failing with "database is locked"
+when two transactions that started by reading both try to write.
+
+Once on Django 5.1 the ENGINE can go back to ``django.db.backends.sqlite3`` with the same OPTIONS.
+"""
+from django.core.exceptions import ImproperlyConfigured
+from django.db.backends.sqlite3 import base
+
+TRANSACTION_MODES = {'DEFERRED', 'EXCLUSIVE', 'IMMEDIATE'}
+
+
+class DatabaseWrapper(base.DatabaseWrapper):
+
+    def get_connection_params(self):
+        kwargs = super().get_connection_params()
+        transaction_mode = kwargs.pop('transaction_mode', None)
+        if transaction_mode is not None and transaction_mode.upper() not in TRANSACTION_MODES:
+            raise ImproperlyConfigured(
+                f'settings.DATABASES["{self.alias}"]["OPTIONS"]["transaction_mode"] must be one of '
+                f'{", ".join(sorted(TRANSACTION_MODES))}.'
+            )
+        self.transaction_mode = transaction_mode.upper() if transaction_mode else None
+        self.init_commands = [command.strip() for command in kwargs.pop('init_command', '').split(';')]
+        return kwargs
+
+    def get_new_connection(self, conn_params):
+        conn = super().get_new_connection(conn_params)
+        for command in self.init_commands:
+            if command:
+                conn.execute(command)
+        return conn
+
+    def _start_transaction_under_autocommit(self):
+        if self.transaction_mode is None:
+            super()._start_transaction_under_autocommit()
+        else:
+            self.cursor().execute(f'BEGIN {self.transaction_mode}')
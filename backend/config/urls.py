@@ -1,21 +1,36 @@
-from django.contrib import admin
+from django.apps import apps
 from django.urls import path, include
 from rest_framework.authtoken.views import ObtainAuthToken
 from rest_framework.authtoken.models import Token
 from rest_framework.response import Response
 from rest_framework.parsers import JSONParser
-from drf_spectacular.views import SpectacularAPIView, SpectacularRedocView, SpectacularSwaggerView
 from drf_spectacular.utils import extend_schema
+from chat.authentication import token_cache
+from chat.schema import schema_view
+from chat.views import metrics_view
 
 
 urlpatterns = [
-    path('admin/', admin.site.urls),
-    path('api/schema/', SpectacularAPIView.as_view(), name='schema'),
-    path('api/schema/swagger/', SpectacularSwaggerView.as_view(url_name='schema'), name='swagger-ui'),
-    path('api/schema/redoc/', SpectacularRedocView.as_view(url_name='schema'), name='redoc'),
-    path('api/chat/', include('chat.urls'))
+    path('api/schema/', schema_view, name='schema'),
+    path('api/chat/', include('chat.urls')),
+    path('metrics', metrics_view, name='metrics'),
 ]
 
+# Left out of the API workers of config.settings_api, imported only when installed
+if apps.is_installed('django.contrib.admin'):
+    from django.contrib import admin
+
+    urlpatterns += [
+        path('admin/', admin.site.urls),
+    ]
+if apps.is_installed('drf_spectacular'):
+    from drf_spectacular.views import SpectacularRedocView, SpectacularSwaggerView
+
+    urlpatterns += [
+        path('api/schema/swagger/', SpectacularSwaggerView.as_view(url_name='schema'), name='swagger-ui'),
+        path('api/schema/redoc/', SpectacularRedocView.as_view(url_name='schema'), name='redoc'),
+    ]
+
 
 @extend_schema(
     tags=['Users'],
@@ -26,12 +41,15 @@ class CustomAuthToken(ObtainAuthToken):
     parser_classes = [JSONParser]
 
     def post(self, request, *args, **kwargs):
-        response = super(CustomAuthToken, self).post(request, *args, **kwargs)
-        token = Token.objects.get(key=response.data['token'])
+        serializer = self.get_serializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        user = serializer.validated_data['user']
+        token, created = Token.objects.get_or_create(user=user)
+        token_cache.set(token.key, user, token)
         return Response({
             'token': token.key,
             'user_id': token.user_id,
-            'email': token.user.email
+            'email': user.email
         })
 
 